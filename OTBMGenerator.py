@@ -1,5 +1,19 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import traceback
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from lib import compressed_io
 from lib import json2otbm
+from lib import map_stitcher
 from lib import otbm2json
+from lib.parse_stats import ParseStats
 
 
 __author__ = "EnriqueMoran"
@@ -7,11 +21,339 @@ __author__ = "EnriqueMoran"
 __version__ = "v0.1.1"
 
 
+Conversion = namedtuple('Conversion', [
+    'input_file',
+    'output_file',
+    'seconds',      # Conversion time, None if skipped
+    'error',        # Error message, None if converted
+])
+
+
 class OTBMGenerator:
     """
     Open Tibia Bit Map and respawn files generator.
     """
+    # Output file suffix of each output format, and input files it is
+    # converted from
+    FORMATS = {
+        'json': ('.json', ('.otbm',)),
+        'ndjson': ('.ndjson', ('.otbm',)),
+        'otbmb': ('.otbmb', ('.otbm',)),
+        'otbmdb': ('.otbmdb', ('.otbm',)),
+        'otbm': ('.otbm', ('.json', '.otbmb')),
+    }
 
     def __init__(self):
         self.otbm2json_parser = otbm2json.Otbm2Json()
-        self.json2otbm_parser = json2otbm.Json2Otbm()
\ No newline at end of file
+        self.json2otbm_parser = json2otbm.Json2Otbm()
+        self.items = None    # ItemTypes, see load_items
+
+    @property
+    def stats(self):
+        """
+        Parse statistics of each parser (None if disabled).
+        """
+        return dict(otbm2json=self.otbm2json_parser.stats,
+                    json2otbm=self.json2otbm_parser.stats)
+
+    def enable_stats(self, progress_callback=None, progress_interval=1.0):
+        """
+        Collect parse statistics (node counts and times, throughput, peak
+        memory, malformed nodes) in both parsers. progress_callback is
+        called with the parser's ParseStats every progress_interval seconds.
+        """
+        self.otbm2json_parser.stats = ParseStats(progress_callback,
+                                                 progress_interval)
+        self.json2otbm_parser.stats = ParseStats(progress_callback,
+                                                 progress_interval)
+
+    def disable_stats(self):
+        self.otbm2json_parser.stats = None
+        self.json2otbm_parser.stats = None
+
+    def load_items(self, file_path, cache=True):
+        """
+        Load item types of an items.otb file (see lib.item_types, requires
+        numpy), used by the OTBM to JSON parser and the generators. They are
+        cached next to the file unless cache is False. Returns them.
+        """
+        from lib.item_types import ItemTypes
+
+        self.items = ItemTypes.open(file_path, cache)
+        self.otbm2json_parser.items = self.items
+        return self.items
+
+    def generate_map(self, output_file, **options):
+        """
+        Generate a procedural map and write it to an otbm file, see
+        lib.map_generator for options (size, floors, seed, towns...).
+        Requires numpy. Returns the number of tiles.
+        """
+        from lib.map_generator import MapGenerator
+
+        options.setdefault('items', self.items)
+        return MapGenerator(**options).generate(output_file)
+
+    def generate_spawns(self, otbm_file, output_file=None, **options):
+        """
+        Place monster spawns over the walkable tiles of an otbm map and write
+        them to a spawn xml file, see lib.spawn_generator for options
+        (distance, monsters...). Output file is the map's spawn file (next
+        to the map) by default. Requires numpy. Returns the number of
+        spawns.
+        """
+        from lib.spawn_generator import SpawnGenerator
+
+        parser = otbm2json.Otbm2Json()
+        parser.otbm_file_path = otbm_file
+        parser.stats = self.otbm2json_parser.stats
+        parser.items = self.items
+        model = parser.generate_model()
+        if output_file is None:
+            spawn_file = model.map_data.get('SPAWN_FILE') \
+                or f"{os.path.splitext(os.path.basename(otbm_file))[0]}-spawn.xml"
+            output_file = os.path.join(os.path.dirname(os.path.abspath(otbm_file)),
+                                       spawn_file)
+        options.setdefault('items', self.items)
+        return SpawnGenerator(**options).generate(model, output_file)
+
+    def crop_map(self, otbm_file, output_file, x0, y0, x1, y1, z0=0, z1=15,
+                 offset=(0, 0, 0)):
+        """
+        Write the region of an otbm map inside the given (inclusive) limits
+        to another otbm file, moved by offset (dx, dy, dz). Towns and
+        waypoints inside the region are kept. Tile areas are copied without
+        decoding them, see lib.map_stitcher. Returns the number of tiles.
+        """
+        stitcher = map_stitcher.MapStitcher(self.otbm2json_parser.index_cache)
+        stitcher.add(otbm_file, (x0, y0, x1, y1, z0, z1), offset)
+        return stitcher.write(output_file)
+
+    def merge_maps(self, otbm_files, output_file, offsets=None):
+        """
+        Stitch otbm maps, each one moved by its offset (dx, dy, dz), into a
+        single otbm file. Maps are drawn in order, tiles, towns (by id) and
+        waypoints (by name) of later maps replace earlier ones. Tile areas
+        are copied without decoding them, see lib.map_stitcher. Returns the
+        number of tiles.
+        """
+        stitcher = map_stitcher.MapStitcher(self.otbm2json_parser.index_cache)
+        for otbm_file, offset in zip(otbm_files, offsets or [(0, 0, 0)] * len(otbm_files)):
+            stitcher.add(otbm_file, offset=offset)
+        return stitcher.write(output_file)
+
+    def convert(self, input_file, output_file, compact=False):
+        """
+        Convert a single file, formats are given by file suffixes (see
+        FORMATS). Json output is written while the map is parsed. Files
+        other than map model binary files and map stores can be compressed
+        (.gz, .xz or .bz2 suffix after the format's). Raises ValueError if
+        an otbm input is not a map or has nodes that can not be read, or a
+        json or binary input has nodes that can not be encoded.
+        """
+        suffix = compressed_io.base_suffix(output_file)
+        if compressed_io.compression(output_file) and suffix in ('.otbmb', '.otbmdb'):
+            raise ValueError(f"Map model and map store files can not be compressed: "
+                             f"{output_file}")
+        if suffix == '.otbm':
+            parser = json2otbm.Json2Otbm()
+            parser.stats = self.json2otbm_parser.stats
+            parser.file_path = input_file
+            parser.process_file()
+            parser.generate_otbm(output_file)
+            if parser.malformed_nodes:
+                raise ValueError(f"{input_file} has {parser.malformed_nodes} nodes "
+                                 f"that can not be encoded!")
+            return
+        parser = otbm2json.Otbm2Json()
+        parser.stats = self.otbm2json_parser.stats
+        parser.items = self.items
+        parser.otbm_file_path = input_file
+        if suffix == '.json':
+            parser.json_file_path = output_file
+            parser.generate_json(compact=compact, streaming=True)
+        elif suffix == '.ndjson':
+            parser.generate_ndjson(output_file)
+        elif suffix == '.otbmb':
+            parser.generate_binary(output_file)
+        elif suffix == '.otbmdb':
+            parser.generate_store(output_file).close()
+        else:
+            raise ValueError(f"Unknown output format: {output_file}")
+        if parser.malformed_nodes:
+            raise ValueError(f"{input_file} has {parser.malformed_nodes} malformed nodes!")
+
+    def find_files(self, inputs, output_format='json'):
+        """
+        Input files of output_format found in inputs (files, directories or
+        glob patterns), without duplicates.
+        """
+        suffixes = self.FORMATS[output_format][1]
+        found = dict()
+        for value in inputs:
+            if os.path.isdir(value):
+                paths = sorted(os.path.join(value, name) for name in os.listdir(value))
+            else:
+                paths = sorted(glob.glob(value, recursive=True))
+            for path in paths:
+                if os.path.isfile(path) and compressed_io.base_suffix(path) in suffixes:
+                    found.setdefault(os.path.abspath(path), None)
+        return list(found)
+
+    def convert_batch(self, inputs, output_dir, output_format='json',
+                      workers=None, force=False, compact=False, compression=None,
+                      callback=print):
+        """
+        Convert every input file found in inputs (see find_files) to
+        output_format, writing them in output_dir.
+
+        Files are converted in a process pool of workers processes (one per
+        CPU if None), biggest files first so the longest conversions do not
+        start last. Outputs newer than their input are skipped unless force
+        is True. A failed conversion does not stop the others, its partial
+        output is removed, and neither does a worker process that dies (see
+        _convert_jobs). Outputs are compressed if compression (.gz, .xz or
+        .bz2) is given. callback is called with a message for each file.
+
+        Returns a Conversion for each input file, in completion order.
+        """
+        suffix = self.FORMATS[output_format][0] + (compression or '')
+        jobs = list()
+        results = list()
+        outputs = dict()    # Output file -> input file
+        for input_file in self.find_files(inputs, output_format):
+            name = os.path.basename(input_file)
+            if compressed_io.compression(name):
+                name = os.path.splitext(name)[0]
+            name = os.path.splitext(name)[0]
+            output_file = os.path.join(os.path.abspath(output_dir), name + suffix)
+            if output_file in outputs:
+                error = f"Same output file as {outputs[output_file]}"
+                results.append(Conversion(input_file, output_file, 0.0, error))
+                callback(f"{input_file}: not converted, {error}")
+                continue
+            outputs[output_file] = input_file
+            if not force and os.path.isfile(output_file) \
+                    and os.path.getmtime(output_file) >= os.path.getmtime(input_file):
+                results.append(Conversion(input_file, output_file, None, None))
+                callback(f"{input_file}: up to date, skipped")
+                continue
+            jobs.append((os.path.getsize(input_file), input_file, output_file))
+        jobs.sort(reverse=True)    # Biggest first
+
+        workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+        if workers == 1:
+            done = (_convert_file(input_file, output_file, compact)
+                    for _, input_file, output_file in jobs)
+        else:
+            done = _convert_jobs(jobs, workers, compact)
+        try:
+            for result in done:
+                results.append(result)
+                if result.error is None:
+                    callback(f"{result.input_file} -> {result.output_file}: "
+                             f"{result.seconds:.2f} s")
+                else:
+                    callback(f"{result.input_file}: failed after {result.seconds:.2f} s\n"
+                             f"{result.error}")
+        finally:
+            done.close()
+        return results
+
+
+def _convert_jobs(jobs, workers, compact=False):
+    """
+    Convert jobs ((size, input file, output file) tuples) in a pool of
+    workers processes, yielding a Conversion for each one as it completes.
+
+    A worker process that dies (killed, out of memory...) breaks the pool
+    and every conversion that had not finished. Those are resubmitted to a
+    new pool, and the ones that were in a broken pool twice are then run
+    alone, one pool each. A conversion that still kills its worker fails.
+    """
+    broken = set()    # Jobs that were in a broken pool
+    pools = [jobs]
+    while pools:
+        pool_jobs = pools.pop(0)
+        retry = list()
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=min(workers, len(pool_jobs))) as executor:
+            futures = dict()
+            for job in pool_jobs:
+                _, input_file, output_file = job
+                futures[executor.submit(_convert_file, input_file, output_file, compact)] = job
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    yield future.result()
+                    continue
+                except BrokenProcessPool as e:
+                    error = f"Worker process died: {e}"
+                if len(pool_jobs) > 1:
+                    retry.append(job)
+                    continue
+                _, input_file, output_file = job
+                if os.path.isfile(output_file):
+                    os.remove(output_file)
+                yield Conversion(input_file, output_file,
+                                 time.perf_counter() - start, error)
+        again = sorted((job for job in retry if job in broken), reverse=True)
+        pools += [[job] for job in again]
+        retry = [job for job in retry if job not in broken]
+        broken.update(retry)
+        if retry:
+            pools.insert(0, sorted(retry, reverse=True))
+
+
+def _convert_file(input_file, output_file, compact=False):
+    """
+    Convert a file (worker process). Returns a Conversion, errors are
+    returned instead of raised.
+    """
+    start = time.perf_counter()
+    error = None
+    try:
+        OTBMGenerator().convert(input_file, output_file, compact)
+    except Exception:
+        error = traceback.format_exc()
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+    return Conversion(input_file, output_file, time.perf_counter() - start, error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert OTBM maps to json, ndjson or map model binary "
+                    "files, or json and binary files back to OTBM.")
+    parser.add_argument('inputs', nargs='+',
+                        help="Input files, directories or glob patterns.")
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help="Directory for output files.")
+    parser.add_argument('-t', '--to', default='json',
+                        choices=sorted(OTBMGenerator.FORMATS),
+                        help="Output format, json by default.")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Conversion processes, one per CPU by default.")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Convert files with up to date outputs too.")
+    parser.add_argument('--compact', action='store_true',
+                        help="Write json without indentation.")
+    parser.add_argument('-c', '--compress', choices=('gz', 'xz', 'bz2'),
+                        help="Compress output files (not otbmb or otbmdb ones).")
+    args = parser.parse_args()
+    if args.compress and args.to in ('otbmb', 'otbmdb'):
+        parser.error("map model and map store files can not be compressed")
+
+    start = time.perf_counter()
+    results = OTBMGenerator().convert_batch(args.inputs, args.output_dir, args.to,
+                                            args.workers, args.force, args.compact,
+                                            args.compress and f'.{args.compress}')
+    failed = sum(result.error is not None for result in results)
+    skipped = sum(result.seconds is None for result in results)
+    print(f"{len(results) - failed - skipped} converted, {skipped} skipped, "
+          f"{failed} failed in {time.perf_counter() - start:.2f} s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
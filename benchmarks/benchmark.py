@@ -0,0 +1,285 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(sys.path[0], '..'))    # noqa: E402
+
+import OTBMGenerator
+
+from lib.json2otbm import Json2Otbm
+from lib.otbm2json import Otbm2Json
+from lib.otbm_scanner import OtbmScanner
+
+try:
+    import resource
+except ImportError:    # Not available on Windows
+    resource = None
+
+
+# Synthetic map sizes
+SCALES = {
+    'small': dict(areas=4, tiles_per_area=1024, items_per_tile=2,
+                  towns=4, waypoints=8),
+    'medium': dict(areas=16, tiles_per_area=4096, items_per_tile=2,
+                   towns=16, waypoints=32),
+    'large': dict(areas=64, tiles_per_area=16384, items_per_tile=2,
+                  towns=64, waypoints=128),
+}
+
+# Probability of each property in generated tiles and items
+ATTRIBUTES = dict(house_tile=0.05, flags=0.1, action_id=0.02, unique_id=0.01,
+                  count=0.1, text=0.01, teleport=0.005, depot=0.001,
+                  house_door=0.002)
+
+
+class SyntheticMap:
+    """
+    Deterministic OTBM map generator, same parameters and seed always
+    produce the same file.
+    """
+    NODE_INIT = b'\xfe'
+    NODE_END = b'\xff'
+
+    def __init__(self, areas, tiles_per_area, items_per_tile, towns=0,
+                 waypoints=0, attributes=None, seed=0):
+        assert 0 < tiles_per_area <= 256 * 256, "Wrong number of tiles!"
+        self.areas = areas
+        self.tiles_per_area = tiles_per_area
+        self.items_per_tile = items_per_tile
+        self.towns = towns
+        self.waypoints = waypoints
+        self.attributes = dict(ATTRIBUTES if attributes is None else attributes)
+        self.seed = seed
+        self.tile_count = areas * tiles_per_area
+
+    def _node(self, file, node_type, byte_data):
+        file.write(self.NODE_INIT + bytes((node_type,)) + OtbmScanner.escape(byte_data))
+
+    @staticmethod
+    def _string(value):
+        data = value.encode('ascii')
+        return len(data).to_bytes(2, "little") + data
+
+    def _item(self, file, rand):
+        chance = self.attributes
+        byte_data = rand.randrange(100, 8000).to_bytes(2, "little")
+        if rand.random() < chance['count']:
+            byte_data += b'\x0f' + rand.randrange(1, 100).to_bytes(1, "little")
+        if rand.random() < chance['action_id']:
+            byte_data += b'\x04' + rand.randrange(1000, 65535).to_bytes(2, "little")
+        if rand.random() < chance['unique_id']:
+            byte_data += b'\x05' + rand.randrange(1000, 65535).to_bytes(2, "little")
+        if rand.random() < chance['text']:
+            byte_data += b'\x06' + self._string(f"Text {rand.randrange(10000)}")
+        if rand.random() < chance['teleport']:
+            byte_data += (b'\x08' + rand.randrange(65536).to_bytes(2, "little")
+                          + rand.randrange(65536).to_bytes(2, "little")
+                          + rand.randrange(16).to_bytes(1, "little"))
+        if rand.random() < chance['depot']:
+            byte_data += b'\x0a' + rand.randrange(1, 20).to_bytes(2, "little")
+        if rand.random() < chance['house_door']:
+            byte_data += b'\x0e' + rand.randrange(1, 255).to_bytes(1, "little")
+        self._node(file, 0x06, byte_data)
+        file.write(self.NODE_END)
+
+    def _tile(self, file, rand, x, y):
+        chance = self.attributes
+        house = rand.random() < chance['house_tile']
+        byte_data = bytes((x, y))
+        if house:
+            byte_data += rand.randrange(1, 1000).to_bytes(4, "little")
+        if house or rand.random() < chance['flags']:
+            flags = 0x01 if house else rand.choice((0x01, 0x04, 0x08, 0x10))
+            byte_data += b'\x03' + flags.to_bytes(4, "little")
+        byte_data += b'\x09' + rand.randrange(100, 8000).to_bytes(2, "little")
+        self._node(file, 0x0e if house else 0x05, byte_data)
+        for _ in range(self.items_per_tile):
+            self._item(file, rand)
+        file.write(self.NODE_END)
+
+    def write(self, file_path):
+        """
+        Write map to an .otbm file. Returns the file size in bytes.
+        """
+        rand = random.Random(self.seed)
+        side = max(1, int(self.areas ** 0.5))
+        with open(file_path, 'wb', buffering=1 << 20) as file:
+            file.write(bytes(4))    # Identifier
+            header = ((2).to_bytes(4, "little")
+                      + (side * 256).to_bytes(2, "little")
+                      + (side * 256).to_bytes(2, "little")
+                      + (3).to_bytes(4, "little")
+                      + (57).to_bytes(4, "little"))
+            self._node(file, 0x00, header)
+            self._node(file, 0x02, b'\x01' + self._string("Synthetic benchmark map")
+                                   + b'\x0b' + self._string("synthetic-spawn.xml")
+                                   + b'\x0d' + self._string("synthetic-house.xml"))
+            for area in range(self.areas):
+                base_x = (area % side) * 256
+                base_y = (area // side) * 256
+                z = 7 - (area // (side * side)) % 8
+                self._node(file, 0x04, base_x.to_bytes(2, "little")
+                                       + base_y.to_bytes(2, "little")
+                                       + z.to_bytes(1, "little"))
+                for tile in range(self.tiles_per_area):
+                    self._tile(file, rand, tile % 256, tile // 256)
+                file.write(self.NODE_END)
+            self._node(file, 0x0c, bytes())
+            for town in range(1, self.towns + 1):
+                self._node(file, 0x0d, town.to_bytes(4, "little")
+                                       + self._string(f"Town {town}")
+                                       + rand.randrange(side * 256).to_bytes(2, "little")
+                                       + rand.randrange(side * 256).to_bytes(2, "little")
+                                       + (7).to_bytes(1, "little"))
+                file.write(self.NODE_END)
+            file.write(self.NODE_END)
+            self._node(file, 0x0f, bytes())
+            for waypoint in range(self.waypoints):
+                self._node(file, 0x10, self._string(f"Waypoint {waypoint}")
+                                       + rand.randrange(side * 256).to_bytes(2, "little")
+                                       + rand.randrange(side * 256).to_bytes(2, "little")
+                                       + (7).to_bytes(1, "little"))
+                file.write(self.NODE_END)
+            file.write(self.NODE_END)
+            file.write(self.NODE_END)    # Map node
+            file.write(self.NODE_END)    # Root node
+        return os.path.getsize(file_path)
+
+
+def _peak_memory(children=False):
+    """
+    Peak resident memory of this process in MB, None if not available. With
+    children, peak of its biggest finished child process (parallel decoding
+    workers) instead.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                              else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20    # Bytes
+    return peak / 2 ** 10        # KB
+
+
+def _run(case, otbm_file, json_file, output_file, workers, binary_file):
+    """
+    Run a single conversion (in its own process). Returns elapsed seconds,
+    peak memory and peak memory of a worker process.
+    """
+    start_memory = _peak_memory()
+    start = time.perf_counter()
+    if case == 'otbm2binary':
+        parser = Otbm2Json()
+        parser.otbm_file_path = otbm_file
+        parser.index_cache = False
+        parser.generate_binary(binary_file)
+    elif case.startswith('otbm2json'):
+        parser = Otbm2Json()
+        parser.otbm_file_path = otbm_file
+        parser.index_cache = False
+        parser.workers = workers if case == 'otbm2json_parallel' else 1
+        parser.json_file_path = json_file
+        if case in ('otbm2json_streaming', 'otbm2json_parallel'):
+            parser.generate_json(compact=True, streaming=True)
+        else:
+            parser.process_file()
+            parser.generate_json()
+    elif case in ('json2otbm', 'binary2otbm'):
+        parser = Json2Otbm()
+        parser.file_path = json_file if case == 'json2otbm' else binary_file
+        parser.process_file()
+        parser.generate_otbm(output_file)
+    return (time.perf_counter() - start, start_memory, _peak_memory(),
+            _peak_memory(children=True))
+
+
+def benchmark(scales, workdir, repeat=1, workers=None, seed=0):
+    """
+    Generate a synthetic map for each scale and measure every conversion.
+    """
+    context = multiprocessing.get_context('spawn')
+    workers = workers or os.cpu_count() or 1
+    results = list()
+    for scale in scales:
+        synthetic = SyntheticMap(seed=seed, **SCALES[scale])
+        otbm_file = os.path.join(workdir, f"{scale}.otbm")
+        json_file = os.path.join(workdir, f"{scale}.json")
+        output_file = os.path.join(workdir, f"{scale}_output.otbm")
+        binary_file = os.path.join(workdir, f"{scale}.otbmb")
+        start = time.perf_counter()
+        otbm_size = synthetic.write(otbm_file)
+        print(f"{scale}: {synthetic.tile_count} tiles, {otbm_size / 2 ** 20:.1f} MB "
+              f"generated in {time.perf_counter() - start:.2f} s")
+
+        for case in ('otbm2json', 'otbm2json_streaming', 'otbm2json_parallel',
+                     'json2otbm', 'otbm2binary', 'binary2otbm'):
+            runs = list()
+            for _ in range(repeat):
+                # Executor processes are not daemonic, they can start the
+                # parallel case workers (pool processes can not)
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    runs.append(executor.submit(_run, case, otbm_file, json_file,
+                                                output_file, workers,
+                                                binary_file).result())
+            seconds = min(run[0] for run in runs)
+            input_size = os.path.getsize({'json2otbm': json_file,
+                                          'binary2otbm': binary_file}.get(case, otbm_file))
+            result = dict(scale=scale, case=case, **SCALES[scale],
+                          tiles=synthetic.tile_count, input_bytes=input_size,
+                          seconds=seconds,
+                          mb_per_s=input_size / 2 ** 20 / seconds,
+                          tiles_per_s=synthetic.tile_count / seconds,
+                          baseline_memory_mb=runs[0][1],
+                          peak_memory_mb=max((run[2] for run in runs
+                                              if run[2] is not None), default=None),
+                          worker_peak_memory_mb=max((run[3] for run in runs
+                                                     if run[3]), default=None),
+                          workers=workers if case == 'otbm2json_parallel' else 1)
+            results.append(result)
+            print(f"  {case:<20} {seconds:8.2f} s {result['mb_per_s']:8.2f} MB/s "
+                  f"{result['tiles_per_s']:10.0f} tiles/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Otbm2Json / Json2Otbm benchmark.")
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'],
+                        choices=sorted(SCALES))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Runs per case, the fastest one is kept.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes for the parallel case, one per CPU by default.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None,
+                        help="Directory for generated files, temporary by default.")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="Json results file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        os.makedirs(workdir, exist_ok=True)
+        results = benchmark(args.scales, workdir, args.repeat, args.workers,
+                            args.seed)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(dict(version=OTBMGenerator.__version__,
+                       python=platform.python_version(),
+                       platform=platform.platform(),
+                       cpus=os.cpu_count(),
+                       date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       seed=args.seed,
+                       results=results), f, indent=4)
+    print(f"Results saved in {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,10 +31,10 @@ def main(example):
     otbm_generator.otbm2json_parser.json_file_path = json_file
 
     # Process OTBM file, parsing its data to json
-    otb2json.process_file()
+    otbm_generator.otbm2json_parser.process_file()
 
     # Save generated json with map data.
-    otb2json.generate_json()
+    otbm_generator.otbm2json_parser.generate_json()
 
     elapsed = time.process_time() - start_time
     path = os.path.abspath(json_file)
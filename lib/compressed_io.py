@@ -0,0 +1,271 @@
+import atexit
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from pathlib import Path
+
+
+BUFFER_SIZE = 1 << 20    # Chunk size, in bytes
+QUEUE_SIZE = 8           # Chunks kept ahead by background threads
+
+# Compression file suffixes and file objects wrapping a raw file
+CODECS = {
+    '.gz': lambda file, mode: gzip.GzipFile(fileobj=file, mode=mode, compresslevel=6),
+    '.xz': lambda file, mode: lzma.LZMAFile(file, mode),
+    '.bz2': lambda file, mode: bz2.BZ2File(file, mode),
+}
+
+# Compressed file path -> [(size, mtime), decompressed copy path, users]
+_copies = dict()
+
+
+def compression(file_path):
+    """
+    Compression suffix of a file (.gz, .xz or .bz2), None if it is not
+    compressed.
+    """
+    suffix = Path(file_path).suffix
+    return suffix if suffix in CODECS else None
+
+
+def base_suffix(file_path):
+    """
+    File suffix without compression suffix (map.otbm.gz -> .otbm).
+    """
+    path = Path(file_path)
+    if compression(path):
+        path = path.with_suffix('')
+    return path.suffix
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reader of a compressed file, decompressed by a background thread.
+
+    The thread reads and decompresses chunks of BUFFER_SIZE bytes ahead of
+    the reader (up to QUEUE_SIZE of them), stdlib codecs release the GIL
+    while they work so decompression overlaps with parsing.
+
+    tell() is the position in the compressed file, to report progress
+    against its size.
+    """
+
+    def __init__(self, file_path):
+        self._codec = CODECS[compression(file_path)]
+        self._file = open(file_path, 'rb', buffering=BUFFER_SIZE)
+        self._chunks = queue.Queue(QUEUE_SIZE)
+        self._chunk = memoryview(b'')
+        self._position = 0       # Compressed bytes read by the thread
+        self._done = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            with self._codec(self._file, 'rb') as f:
+                while not self._stop.is_set():
+                    chunk = f.read(BUFFER_SIZE)
+                    self._position = self._file.tell()
+                    self._chunks.put(chunk)
+                    if not chunk:
+                        return
+        except Exception as e:
+            self._chunks.put(e)
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        """
+        Get next decompressed chunk, False at the end of the file.
+        """
+        while not self._chunk and not self._done:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                self._done = True
+                raise chunk
+            if not chunk:
+                self._done = True
+            self._chunk = memoryview(chunk)
+        return bool(self._chunk)
+
+    def readinto(self, buffer):
+        if not self._next_chunk():
+            return 0
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        if not self._next_chunk():
+            return b''
+        data = bytes(self._chunk[:size])
+        self._chunk = self._chunk[len(data):]
+        return data
+
+    def readall(self):
+        data = bytearray()
+        while self._next_chunk():
+            data += self._chunk
+            self._chunk = memoryview(b'')
+        return data
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            while self._thread.is_alive():    # Unblock the thread
+                try:
+                    self._chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._file.close()
+        super().close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    """
+    Writer of a compressed file, compressed by a background thread.
+
+    Written data is gathered in chunks of BUFFER_SIZE bytes that the thread
+    compresses and writes while the writer keeps producing the next ones.
+    """
+
+    def __init__(self, file_path):
+        self._codec = CODECS[compression(file_path)]
+        self._file = open(file_path, 'wb', buffering=BUFFER_SIZE)
+        self._chunks = queue.Queue(QUEUE_SIZE)
+        self._buffer = bytearray()
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        chunk = b''
+        try:
+            with self._codec(self._file, 'wb') as f:
+                while True:
+                    chunk = self._chunks.get()
+                    if chunk is None:
+                        break
+                    f.write(chunk)
+        except Exception as e:
+            self._error = e
+            while chunk is not None:    # Unblock the writer
+                chunk = self._chunks.get()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._check()
+        self._buffer += data
+        if len(self._buffer) >= BUFFER_SIZE:
+            self._chunks.put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._chunks.put(bytes(self._buffer))
+                    self._buffer.clear()
+                self._chunks.put(None)
+                self._thread.join()
+            finally:
+                self._file.close()
+            self._check()
+        super().close()
+
+
+def open_file(file_path, mode='rb', encoding=None, newline=None):
+    """
+    Open a file for sequential reading or writing ('rb', 'wb', 'r' or 'w'
+    mode), compressed files (see CODECS) are decompressed or compressed
+    transparently in a background thread. Other files are opened with a
+    BUFFER_SIZE buffer.
+    """
+    if compression(file_path) is None:
+        if 'b' in mode:
+            return open(file_path, mode, buffering=BUFFER_SIZE)
+        return open(file_path, mode, buffering=BUFFER_SIZE, encoding=encoding,
+                    newline=newline)
+    if mode.startswith('r'):
+        file = ThreadedReader(file_path)
+    else:
+        file = ThreadedWriter(file_path)
+    if 'b' in mode:
+        return file
+    return io.TextIOWrapper(file, encoding=encoding, newline=newline)
+
+
+def decompressed_copy(file_path):
+    """
+    Path of a temporary decompressed copy of a compressed file, so it can be
+    memory mapped. Users of the same file version (size and modification
+    time) share the copy, each must call release_copy once done with it.
+    """
+    key = os.path.abspath(file_path)
+    stat = os.stat(key)
+    version = (stat.st_size, stat.st_mtime_ns)
+    copy = _copies.get(key)
+    if copy is not None:
+        if copy[0] == version and os.path.isfile(copy[1]):
+            copy[2] += 1
+            return copy[1]
+        _remove_copy(key)
+    handle, copy_path = tempfile.mkstemp(suffix=base_suffix(file_path))
+    try:
+        with os.fdopen(handle, 'wb') as f, ThreadedReader(file_path) as reader:
+            shutil.copyfileobj(reader, f, BUFFER_SIZE)
+    except BaseException:
+        os.remove(copy_path)
+        raise
+    _copies[key] = [version, copy_path, 1]
+    return copy_path
+
+
+def release_copy(file_path, copy_path):
+    """
+    Release a copy got with decompressed_copy, it is removed once it has no
+    users left (or when the process exits).
+    """
+    key = os.path.abspath(file_path)
+    copy = _copies.get(key)
+    if copy is None or copy[1] != copy_path:
+        return    # Replaced by a newer version, already removed
+    copy[2] -= 1
+    if copy[2] <= 0:
+        _remove_copy(key)
+
+
+def _remove_copy(key):
+    _, copy_path, _ = _copies.pop(key)
+    try:
+        os.remove(copy_path)
+    except OSError:
+        pass    # Still mapped (Windows) or already removed
+
+
+@atexit.register
+def _remove_copies():
+    for key in list(_copies):
+        _remove_copy(key)
@@ -0,0 +1,330 @@
+import numpy as np
+import os
+import struct
+
+from pathlib import Path
+
+from lib.otbm_scanner import OtbmScanner
+
+
+class ItemTypes:
+    """
+    Item types of an items.otb file, indexed by server item id.
+
+    Types are kept as columns (group, flags, client id and name offset into
+    a string blob) of one entry per item id, so any lookup is a single
+    array access. Ids without a type in the file have group NONE and no
+    flags.
+
+    items.otb files are parsed once and cached in a binary file (keyed by
+    the OTB version, see open()) that is memory mapped when loaded.
+    """
+    # Item groups (OTB node types)
+    NONE = 0
+    GROUND = 1
+    CONTAINER = 2
+    WEAPON = 3
+    AMMUNITION = 4
+    ARMOR = 5
+    CHARGES = 6
+    TELEPORT = 7
+    MAGIC_FIELD = 8
+    WRITEABLE = 9
+    KEY = 10
+    SPLASH = 11
+    FLUID = 12
+    DOOR = 13
+    DEPRECATED = 14
+
+    # Item flags
+    BLOCK_SOLID = 1 << 0
+    BLOCK_PROJECTILE = 1 << 1
+    BLOCK_PATHFIND = 1 << 2
+    HAS_HEIGHT = 1 << 3
+    USEABLE = 1 << 4
+    PICKUPABLE = 1 << 5
+    MOVEABLE = 1 << 6
+    STACKABLE = 1 << 7
+    FLOOR_CHANGE_DOWN = 1 << 8
+    FLOOR_CHANGE_NORTH = 1 << 9
+    FLOOR_CHANGE_EAST = 1 << 10
+    FLOOR_CHANGE_SOUTH = 1 << 11
+    FLOOR_CHANGE_WEST = 1 << 12
+    ALWAYS_ON_TOP = 1 << 13
+    READABLE = 1 << 14
+    ROTATABLE = 1 << 15
+    HANGABLE = 1 << 16
+    VERTICAL = 1 << 17
+    HORIZONTAL = 1 << 18
+    CANNOT_DECAY = 1 << 19
+    ALLOW_DIST_READ = 1 << 20
+    CLIENT_CHARGES = 1 << 22
+    LOOK_THROUGH = 1 << 23
+    ANIMATION = 1 << 24
+    FULL_TILE = 1 << 25
+    FORCE_USE = 1 << 26
+
+    # items.otb attributes (1 byte code, 2 bytes length, data)
+    ROOT_VERSION = 0x01      # Major, minor and build numbers, CSD version
+    SERVER_ID = 0x10
+    CLIENT_ID = 0x11
+    NAME = 0x12
+
+    # Cache file, little endian: file header, section table (offset and
+    # number of elements of each section) and 8 bytes aligned sections
+    SUFFIX = '.otbc'
+    MAGIC = b'OTBITEM\x00'
+    VERSION = 1
+
+    _FILE_HEADER = struct.Struct('<8sIIIIQQ')    # Magic, version, OTB version, size, mtime
+    _SECTION = struct.Struct('<QQ')              # Offset, number of elements
+    _SECTIONS = (('groups', np.dtype('u1')),
+                 ('flags', np.dtype('<u4')),
+                 ('client_ids', np.dtype('<u2')),
+                 ('name_offsets', np.dtype('<u4')),    # One more than ids
+                 ('names', np.dtype('u1')))            # Utf-8 names blob
+
+    _ATTRIBUTE = struct.Struct('<BH')    # Code, data length
+    _OTB_VERSION = struct.Struct('<III')
+
+    def __init__(self, version=(0, 0, 0)):
+        self.version = tuple(version)    # OTB major, minor and build numbers
+        self.cache_path = None           # Cache file, if loaded from one
+        self.groups = np.zeros(0, np.uint8)
+        self.flags = np.zeros(0, np.uint32)
+        self.client_ids = np.zeros(0, np.uint16)
+        self.name_offsets = np.zeros(1, np.uint32)
+        self.names = np.zeros(0, np.uint8)
+        self._set_lookups()
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, item_id):
+        return 0 <= item_id < len(self._groups) and self._client_ids[item_id] > 0
+
+    def __reduce__(self):
+        # Loaded types are sent to worker processes as their cache path
+        if self.cache_path is not None:
+            return type(self).load, (self.cache_path,)
+        return super().__reduce__()
+
+    def __getstate__(self):
+        # Lookup views can not be pickled, they are rebuilt from the columns
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ('_groups', '_flags', '_client_ids')}
+        for name, dtype in self._SECTIONS:
+            state[name] = np.array(state[name], dtype)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_lookups()
+
+    def _set_lookups(self):
+        """
+        Views of the columns that index as Python ints, for per item
+        lookups (numpy scalar access is much slower).
+        """
+        self._groups = memoryview(np.ascontiguousarray(self.groups, np.uint8))
+        self._flags = memoryview(np.ascontiguousarray(self.flags, np.uint32)).cast('B').cast('I')
+        self._client_ids = memoryview(np.ascontiguousarray(self.client_ids, np.uint16)).cast('B').cast('H')
+
+    def group(self, item_id):
+        return self._groups[item_id] if 0 <= item_id < len(self._groups) else self.NONE
+
+    def has_flags(self, item_id, flags):
+        """
+        True if item type has any of the given flag bits.
+        """
+        return 0 <= item_id < len(self._flags) and bool(self._flags[item_id] & flags)
+
+    def client_id(self, item_id):
+        return self._client_ids[item_id] if 0 <= item_id < len(self._client_ids) else 0
+
+    def name(self, item_id):
+        if not 0 <= item_id < len(self._groups):
+            return ''
+        start, end = self.name_offsets[item_id:item_id + 2].tolist()
+        return self.names[start:end].tobytes().decode('utf-8')
+
+    def is_ground(self, item_id):
+        return self.group(item_id) == self.GROUND
+
+    def has_subtype(self, item_id):
+        """
+        True for stackable, splash and fluid container items, their count or
+        fluid type follows the item id in OTBM version 1 maps.
+        """
+        return self.has_flags(item_id, self.STACKABLE) \
+            or self.group(item_id) in (self.SPLASH, self.FLUID)
+
+    def select(self, item_ids, flags=None, groups=None):
+        """
+        Mask of item_ids (array) whose type has any of the given flag bits
+        or is in one of the given groups. Unknown ids are never selected.
+        """
+        item_ids = np.asarray(item_ids, np.int64)
+        known = (item_ids >= 0) & (item_ids < len(self.groups))
+        ids = np.where(known, item_ids, 0)
+        mask = np.zeros(ids.shape, bool)
+        if flags is not None:
+            mask |= (self.flags[ids] & flags) != 0
+        if groups is not None:
+            mask |= np.isin(self.groups[ids], groups)
+        return mask & known
+
+    @classmethod
+    def read_version(cls, scanner):
+        """
+        OTB major, minor and build numbers of an items.otb file, from its
+        root node.
+        """
+        payload = scanner.read_payload(OtbmScanner.IDENTIFIER)
+        offset = 4    # Unused flags
+        while offset + cls._ATTRIBUTE.size <= len(payload):
+            code, length = cls._ATTRIBUTE.unpack_from(payload, offset)
+            offset += cls._ATTRIBUTE.size
+            if code == cls.ROOT_VERSION and length >= cls._OTB_VERSION.size:
+                return cls._OTB_VERSION.unpack_from(payload, offset)
+            offset += length
+        raise ValueError(f"{scanner.file_path} has no OTB version!")
+
+    @classmethod
+    def parse(cls, file_path):
+        """
+        Read item types from an items.otb file.
+        """
+        entries = dict()    # Server id -> (group, flags, client id, name)
+        with OtbmScanner(file_path) as scanner:
+            types = cls(cls.read_version(scanner))
+            depth = 0
+            for event, group, payload, _ in scanner.nodes():
+                if event == OtbmScanner.NODE_END:
+                    depth -= 1
+                    continue
+                depth += 1
+                if depth != 2:
+                    continue    # Root node
+                flags = int.from_bytes(payload[:4], "little")
+                server_id = client_id = 0
+                name = ''
+                offset = 4
+                while offset + cls._ATTRIBUTE.size <= len(payload):
+                    code, length = cls._ATTRIBUTE.unpack_from(payload, offset)
+                    offset += cls._ATTRIBUTE.size
+                    data = payload[offset:offset + length]
+                    if code == cls.SERVER_ID:
+                        server_id = int.from_bytes(data, "little")
+                    elif code == cls.CLIENT_ID:
+                        client_id = int.from_bytes(data, "little")
+                    elif code == cls.NAME:
+                        name = bytes(data).decode('latin-1')
+                    offset += length
+                entries[server_id] = (group, flags, client_id, name)
+
+        count = max(entries, default=-1) + 1
+        types.groups = np.zeros(count, np.uint8)
+        types.flags = np.zeros(count, np.uint32)
+        types.client_ids = np.zeros(count, np.uint16)
+        names = [b''] * count
+        for server_id, (group, flags, client_id, name) in entries.items():
+            types.groups[server_id] = group
+            types.flags[server_id] = flags
+            types.client_ids[server_id] = client_id
+            names[server_id] = name.encode('utf-8')
+        types.name_offsets = np.zeros(count + 1, np.uint32)
+        np.cumsum([len(name) for name in names], out=types.name_offsets[1:])
+        types.names = np.frombuffer(b''.join(names), np.uint8)
+        types._set_lookups()
+        return types
+
+    @staticmethod
+    def fingerprint(file_path):
+        """
+        Size and modification time of an items.otb file.
+        """
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def save(self, file_path, fingerprint=(0, 0)):
+        """
+        Write item types to a cache file, see load().
+        """
+        with open(file_path, 'wb') as f:
+            f.write(self._FILE_HEADER.pack(self.MAGIC, self.VERSION,
+                                           *self.version, *fingerprint))
+            table = f.tell()
+            f.write(bytes(self._SECTION.size * len(self._SECTIONS)))
+            sections = list()
+            for name, dtype in self._SECTIONS:
+                data = getattr(self, name)
+                f.write(bytes(-f.tell() % 8))
+                sections.append(self._SECTION.pack(f.tell(), len(data)))
+                f.write(np.ascontiguousarray(data, dtype).tobytes())
+            f.seek(table)
+            f.write(b''.join(sections))
+
+    @classmethod
+    def load(cls, file_path, version=None, fingerprint=None):
+        """
+        Memory map item types from a cache file. Returns None if the file
+        does not exist, is not valid or does not match the given OTB version
+        or items.otb fingerprint.
+        """
+        try:
+            data = np.memmap(file_path, dtype=np.uint8, mode='r')
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, cache_version, *header = cls._FILE_HEADER.unpack_from(data, 0)
+        except struct.error:
+            return None
+        otb_version, file_fingerprint = tuple(header[:3]), tuple(header[3:])
+        if (magic, cache_version) != (cls.MAGIC, cls.VERSION) \
+                or version is not None and otb_version != tuple(version) \
+                or fingerprint is not None and file_fingerprint != tuple(fingerprint):
+            return None
+
+        types = cls(otb_version)
+        offset = cls._FILE_HEADER.size
+        for name, dtype in cls._SECTIONS:
+            start, count = cls._SECTION.unpack_from(data, offset)
+            offset += cls._SECTION.size
+            end = start + count * dtype.itemsize
+            if end > len(data):
+                return None
+            setattr(types, name, data[start:end].view(dtype))
+        types.cache_path = str(file_path)
+        types._set_lookups()
+        return types
+
+    @classmethod
+    def open(cls, file_path, cache=True, cache_dir=None):
+        """
+        Get item types of an items.otb file.
+
+        The cache file (items-<major>.<minor>.<build>.otbc, in cache_dir or
+        next to the items.otb file) is loaded if it was built from the same
+        file. Otherwise the file is parsed and, if cache is True, the cache
+        file is written and memory mapped.
+        """
+        file_path = Path(file_path)
+        with OtbmScanner(file_path) as scanner:
+            version = cls.read_version(scanner)
+        fingerprint = cls.fingerprint(file_path)
+        cache_path = Path(cache_dir or file_path.parent) \
+            / f"items-{'.'.join(map(str, version))}{cls.SUFFIX}"
+        if cache:
+            types = cls.load(cache_path, version, fingerprint)
+            if types is not None:
+                return types
+        types = cls.parse(file_path)
+        if cache:
+            try:
+                types.save(cache_path, fingerprint)
+            except OSError as e:
+                print(f"Item types cache not saved: {e}")
+            else:
+                return cls.load(cache_path, version, fingerprint)
+        return types
@@ -1,20 +1,76 @@
 import ijson
 import os
+import time
 import traceback
 
 from pathlib import Path
 
+from lib import compressed_io
+from lib import otbm_attributes
+from lib.otbm_scanner import OtbmScanner
+from lib.parse_stats import ParseStats
+
 
 class Json2Otbm:
     """
     Json to OTBM parser.
+
+    The json file is read as a stream of ijson events and each node is
+    written as soon as its data is known (that is, when its first child
+    node or its end is reached), so memory use does not depend on the map
+    size.
+
+    Map model binary files (.otbmb, see Otbm2Json.generate_binary) are read
+    too, requires numpy.
+
+    Json input and otbm output can be compressed (.gz, .xz or .bz2 suffix),
+    they are decompressed and compressed in a background thread (see
+    lib.compressed_io).
     """
     NODE_INIT = b'\xfe'
     NODE_END = b'\xff'
     NODE_SKIP = b'\xfd'
 
+    # Node types
+    ROOT = b'\x00'
+    MAP_DATA = b'\x02'
+    TILE_AREA = b'\x04'
+    TILE = b'\x05'
+    ITEM = b'\x06'
+    TOWNS = b'\x0c'
+    TOWN = b'\x0d'
+    HOUSE_TILE = b'\x0e'
+    WAYPOINTS = b'\x0f'
+    WAYPOINT = b'\x10'
+
+    NODE_TYPES = {
+        'MAP': MAP_DATA,
+        'TILE_AREA': TILE_AREA,
+        'TILE': TILE,
+        'ITEM': ITEM,
+        'TOWNS': TOWNS,
+        'TOWN': TOWN,
+        'HOUSE_TILE': HOUSE_TILE,
+        'WAYPOINTS': WAYPOINTS,
+        'WAYPOINT': WAYPOINT,
+    }
+
+    HEADER = (('map_version', 4),
+              ('map_width', 2),
+              ('map_height', 2),
+              ('items_major_version', 4),
+              ('items_minor_version', 4))
+
+    MODEL_SUFFIX = '.otbmb'  # Map model binary files, see lib.map_model
+
+    _ATTRIBUTES = otbm_attributes.BY_KEY
+    _STRING_LENGTH = otbm_attributes.STRING_LENGTH
+
     def __init__(self):
         self._file_path = None
+        self._header = dict()
+        self._stats = None    # ParseStats, None if disabled
+        self._malformed_nodes = 0    # Nodes that could not be encoded
 
     @property
     def file_path(self):
@@ -24,24 +80,288 @@ class Json2Otbm:
     def file_path(self, value):
         new_path = Path(value)
         assert new_path.is_file(), "File not found!"
-        assert new_path.suffix == ".json", "Wrong file format!"
+        assert new_path.suffix == self.MODEL_SUFFIX \
+            or compressed_io.base_suffix(new_path) == ".json", "Wrong file format!"
         self._file_path = new_path
 
-    def _get_json_header(self, iterator):
-        pass
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def malformed_nodes(self):
+        """
+        Number of nodes that could not be encoded by the last generate_otbm
+        (their error is printed and they are left out with their children).
+        """
+        return self._malformed_nodes
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        """
+        ParseStats instance to collect parsing statistics, None to disable.
+        """
+        assert value is None or isinstance(value, ParseStats), "Wrong stats!"
+        self._stats = value
+
+    def _get_json_header(self, events):
+        """
+        Read top level values until map node and add them to header.
+        """
+        key = None
+        for event, value in events:
+            if event == 'map_key':
+                key = value
+                if key == 'MAP':
+                    return
+            elif event in ('number', 'string'):
+                self._header[key] = value
+
+    def _load_model(self):
+        from lib.map_model import MapModel
+
+        return MapModel.load(self.file_path)
+
+    @classmethod
+    def _get_json_events(cls, items):
+        """
+        ijson basic events of a json object given its (key, value) items.
+        """
+        yield 'start_map', None
+        for key, value in items:
+            yield 'map_key', key
+            if isinstance(value, dict):
+                yield from cls._get_json_events(value.items())
+            elif isinstance(value, str):
+                yield 'string', value
+            else:
+                yield 'number', value
+        yield 'end_map', None
+
+    def _get_model_events(self, model):
+        """
+        ijson basic events of a map model's json (see MapModel.to_json),
+        tile areas are created one at a time.
+        """
+        yield 'start_map', None
+        for key, value in model.header.items():
+            yield 'map_key', key
+            yield 'number', value
+        yield 'map_key', 'MAP'
+        yield from self._get_json_events(model.iter_map())
+        yield 'end_map', None
+
+    @staticmethod
+    def _node_type(key):
+        """
+        Remove node number from json key (TILE_AREA_1 -> TILE_AREA).
+        """
+        name, _, number = key.rpartition('_')
+        if number.isdigit():
+            return name
+        return key
+
+    def _get_node_properties(self, fields):
+        """
+        Encode node properties as OTBM attributes, see
+        lib/otbm_attributes.py. Fields without attribute are ignored.
+        """
+        byte_data = bytearray()
+        done = set()    # Attributes with several keys already encoded
+        for key, value in fields.items():
+            if key.startswith('DESCRIPTION_'):
+                key = 'DESCRIPTION'
+            attribute = self._ATTRIBUTES.get(key)
+            if attribute is None or attribute.code in done:
+                continue
+            byte_data.append(attribute.code)
+            if attribute.layout is None:
+                byte_data += self._string(value)
+                continue
+            if len(attribute.keys) > 1:
+                done.add(attribute.code)
+            if attribute.code == otbm_attributes.TILE_FLAGS:
+                values = (sum(bit for name, bit in otbm_attributes.FLAGS
+                              if fields.get(name))
+                          | int(fields.get(otbm_attributes.OTHER_FLAGS, 0)),)
+            else:
+                values = (int(fields.get(name, 0)) for name in attribute.keys)
+            byte_data += attribute.layout.pack(*values)
+        return bytes(byte_data)
+
+    @staticmethod
+    def _string(value):
+        """
+        Encode string with its 2 bytes length prefix.
+        """
+        data = str(value).encode('ascii')
+        return Json2Otbm._STRING_LENGTH.pack(len(data)) + data
+
+    def _get_node_data(self, node_type, fields):
+        """
+        Encode node data (position, ids, names and properties).
+        """
+        fields = dict(fields)
+        if node_type == 'MAP':
+            return self._get_node_properties(fields)
+        elif node_type == 'TILE_AREA':
+            return (int(fields.get('X', 0)).to_bytes(2, "little")
+                    + int(fields.get('Y', 0)).to_bytes(2, "little")
+                    + int(fields.get('Z', 0)).to_bytes(1, "little"))
+        elif node_type == 'TILE':
+            byte_data = (int(fields.pop('X', 0)).to_bytes(1, "little")
+                         + int(fields.pop('Y', 0)).to_bytes(1, "little"))
+            return byte_data + self._get_node_properties(fields)
+        elif node_type == 'HOUSE_TILE':
+            byte_data = (int(fields.pop('X', 0)).to_bytes(1, "little")
+                         + int(fields.pop('Y', 0)).to_bytes(1, "little")
+                         + int(fields.pop('HOUSE_ID', 0)).to_bytes(4, "little"))
+            return byte_data + self._get_node_properties(fields)
+        elif node_type == 'ITEM':
+            byte_data = int(fields.pop('IDENTIFIER', 0)).to_bytes(2, "little")
+            if 'SUBTYPE' in fields:    # OTBM version 1 maps count or fluid type
+                byte_data += int(fields.pop('SUBTYPE')).to_bytes(1, "little")
+            return byte_data + self._get_node_properties(fields)
+        elif node_type == 'TOWN':
+            return (int(fields.get('ID', 0)).to_bytes(4, "little")
+                    + self._string(fields.get('NAME', ''))
+                    + int(fields.get('X', 0)).to_bytes(2, "little")
+                    + int(fields.get('Y', 0)).to_bytes(2, "little")
+                    + int(fields.get('Z', 0)).to_bytes(1, "little"))
+        elif node_type == 'WAYPOINT':
+            return (self._string(fields.get('NAME', ''))
+                    + int(fields.get('X', 0)).to_bytes(2, "little")
+                    + int(fields.get('Y', 0)).to_bytes(2, "little")
+                    + int(fields.get('Z', 0)).to_bytes(1, "little"))
+        return bytes()    # TOWNS, WAYPOINTS
+
+    def _get_root_data(self, fields):
+        """
+        Encode file identifier and root node header.
+        """
+        byte_data = bytes()
+        for key, size in self.HEADER:
+            byte_data += int(fields.get(key, 0)).to_bytes(size, "little")
+        return (int(fields.get('identifier', 0)).to_bytes(4, "little")
+                + self.NODE_INIT + self.ROOT + OtbmScanner.escape(byte_data))
+
+    def _write_node(self, file, frame):
+        """
+        Write node start and data if it was not written yet. Returns False
+        if the node could not be encoded, nothing is written then and the
+        node must be left out with its children.
+        """
+        if frame[2]:
+            return True
+        frame[2] = True
+        node_type, fields = frame[0], frame[1]
+        stats = self._stats
+        if stats is not None:
+            start = time.perf_counter()
+        try:
+            if node_type == 'ROOT':
+                byte_data = self._get_root_data(fields)
+            else:
+                byte_data = (self.NODE_INIT + self.NODE_TYPES[node_type]
+                             + OtbmScanner.escape(self._get_node_data(node_type, fields)))
+        except Exception as e:
+            print(traceback.format_exc())
+            byte_data = None
+            self._malformed_nodes += 1
+            if stats is not None:
+                stats.add_malformed(f"{node_type}: {e!r}")
+        if stats is not None:
+            encoded = time.perf_counter()
+            stats.add_node(node_type, encoded - start, phase='encoding')
+        if byte_data is not None:
+            file.write(byte_data)
+        if stats is not None:
+            stats.phase_times['serialization'] += time.perf_counter() - encoded
+        fields.clear()
+        return byte_data is not None
+
+    def _get_next_node(self, events, file, json_file=None):
+        """
+        Iterate over json events writing each node. json_file is the file
+        events are read from, used to report progress.
+        """
+        stats = self._stats
+        stack = list()    # [node type, fields, written] of open nodes
+        skip = 0          # Depth inside unknown nodes
+        key = None
+        for event, value in events:
+            if event == 'map_key':
+                key = value
+            elif skip:
+                if event == 'start_map':
+                    skip += 1
+                elif event == 'end_map':
+                    skip -= 1
+            elif event == 'start_map':
+                if not stack:
+                    stack.append(['ROOT', dict(), False])
+                    continue
+                node_type = self._node_type(key)
+                if node_type not in self.NODE_TYPES:
+                    skip = 1
+                    if stats is not None:
+                        stats.unknown_nodes += 1
+                    continue
+                if not self._write_node(file, stack[-1]):
+                    stack.pop()    # Skip this node, the rest of its parent
+                    skip = 2       # and its parent's end
+                    continue
+                stack.append([node_type, dict(), False])
+            elif event == 'end_map':
+                frame = stack.pop()
+                if self._write_node(file, frame):
+                    file.write(self.NODE_END)
+                if stats is not None and json_file is not None:
+                    stats.progress(json_file.tell())
+            elif event in ('number', 'string', 'boolean'):
+                frame = stack[-1]
+                if frame[2]:
+                    print(f"{key} found after {frame[0]} child nodes, ignored.")
+                    self._malformed_nodes += 1
+                    if stats is not None:
+                        stats.add_malformed(f"{frame[0]}: {key} found after "
+                                            f"child nodes")
+                else:
+                    frame[1][key] = value
 
     def process_file(self):
-        with open(self.file_path, 'rb') as file:
-            for k, v in ijson.kvitems(file, 'MAP'):
-                print(k, v)
+        """
+        Read json header (identifier, map and items versions).
+        """
+        if self.file_path.suffix == self.MODEL_SUFFIX:
+            self._header.update(self._load_model().header)
+            return
+        with compressed_io.open_file(self.file_path, 'rb') as file:
+            self._get_json_header(ijson.basic_parse(file))
 
     def generate_otbm(self, output_file):
         """
-        Create output otbm file with json data.
+        Create output otbm file with json data. Nodes that can not be
+        encoded are left out with their children, see malformed_nodes.
         """
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, 'w+', encoding='utf-8') as f:
-            pass
+        self._malformed_nodes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        with compressed_io.open_file(self.file_path, 'rb') as json_file, \
+             compressed_io.open_file(output_file, 'wb') as f:
+            if self._stats is not None:
+                self._stats.start(os.path.getsize(self.file_path))
+            try:
+                if self.file_path.suffix == self.MODEL_SUFFIX:
+                    self._get_next_node(self._get_model_events(self._load_model()), f)
+                else:
+                    self._get_next_node(ijson.basic_parse(json_file), f, json_file)
+            finally:
+                if self._stats is not None:
+                    self._stats.finish()
 
 def main():
     parser = Json2Otbm()
@@ -52,4 +372,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,119 @@
+import json
+
+
+class RawJson(str):
+    """
+    Json text of a value (see JsonStreamWriter.dumps), written as is.
+    """
+
+
+class JsonStreamWriter:
+    """
+    Incremental json writer for nested dicts that are still being built.
+
+    Subtrees are written as soon as they are complete and removed from
+    their parent so they can be freed. Keys written before a subtree are
+    the ones already present in its ancestors, so the output is the same
+    json.dump would produce for the whole tree.
+    """
+
+    def __init__(self, file, compact=False):
+        self._file = file
+        self._compact = compact
+        self._open = list()         # Containers already opened in output
+        self._has_items = list()    # Whether each open container has items
+
+    @property
+    def compact(self):
+        return self._compact
+
+    @staticmethod
+    def dumps(value, depth, compact=False):
+        """
+        Json text of a value written at depth (number of containers it is
+        in), the same write_node writes for it.
+        """
+        if compact:
+            return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        data = json.dumps(value, ensure_ascii=False, indent=4)
+        return data.replace('\n', '\n' + ' ' * 4 * depth)
+
+    def _dumps(self, value, depth):
+        if isinstance(value, RawJson):
+            return value
+        return self.dumps(value, depth, self._compact)
+
+    def _write_key(self, key, depth):
+        """
+        Write item separator and key of the next item of the deepest
+        open container.
+        """
+        key = json.dumps(key, ensure_ascii=False)
+        separator = ',' if self._has_items[-1] else ''
+        if self._compact:
+            self._file.write(f'{separator}{key}:')
+        else:
+            indent = ' ' * 4 * depth
+            self._file.write(f'{separator}\n{indent}{key}: ')
+        self._has_items[-1] = True
+
+    def _write_items(self, container, depth, stop=None):
+        """
+        Write and remove every item of container before stop key.
+        """
+        for key in list(container):
+            if key == stop:
+                return
+            self._write_key(key, depth)
+            self._file.write(self._dumps(container.pop(key), depth))
+
+    def _open_container(self, key, depth):
+        if key is not None:
+            self._write_key(key, depth)
+        self._file.write('{')
+        self._has_items.append(False)
+
+    def _close_container(self, depth):
+        if self._has_items.pop() and not self._compact:
+            self._file.write('\n' + ' ' * 4 * depth)
+        self._file.write('}')
+
+    def write_node(self, path, key):
+        """
+        Write path[-1][key] and remove it from its parent.
+
+        Path is the list of nested dicts from the root to the node's parent.
+        """
+        for depth, container in enumerate(path):
+            if depth == len(self._open):
+                parent_key = None
+                if depth > 0:
+                    parent = path[depth - 1]
+                    parent_key = next(k for k, v in parent.items()
+                                      if v is container)
+                    self._write_items(parent, depth, stop=parent_key)
+                self._open_container(parent_key, depth)
+                self._open.append(container)
+        self._write_items(path[-1], len(path), stop=key)
+        self._write_key(key, len(path))
+        self._file.write(self._dumps(path[-1].pop(key), len(path)))
+
+    def close(self, root):
+        """
+        Write every remaining item and close open containers.
+        """
+        if not self._open:
+            self._open_container(None, 0)
+            self._open.append(root)
+        for depth in range(len(self._open) - 1, -1, -1):
+            container = self._open.pop()
+            self._write_items(container, depth + 1)
+            self._close_container(depth)
+            if depth > 0:
+                parent = self._open[-1]
+                for k, v in list(parent.items()):
+                    if v is container:
+                        del parent[k]
+                        break
+                    self._write_key(k, depth)
+                    self._file.write(self._dumps(parent.pop(k), depth))
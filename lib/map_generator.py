@@ -0,0 +1,309 @@
+import numpy as np
+import os
+
+from lib.otbm_scanner import OtbmScanner
+
+
+class MapGenerator:
+    """
+    Procedural OTBM map generator.
+
+    Terrain is made from fractal value noise computed with NumPy in chunks
+    of one tile area (AREA_SIZE x AREA_SIZE tiles). Each chunk is encoded
+    and written to the otbm file as soon as it is generated, so memory use
+    does not depend on the map size.
+
+    Floor 7 is the surface (water, sand, grass and mountains by height,
+    trees and bushes on grass), floors above it have mountain tops and
+    floors below it caves. The same parameters and seed always produce the
+    same map.
+
+    Item ids are the ones of 7.x items.otb files. With item types (see
+    lib.item_types) they are checked against them and the map header gets
+    their items.otb version.
+    """
+    AREA_SIZE = 256
+
+    NODE_INIT = 0xfe
+    NODE_END = 0xff
+    NODE_ESCAPE = 0xfd
+
+    # Node types
+    ROOT = 0x00
+    MAP_DATA = 0x02
+    TILE_AREA = 0x04
+    TILE = 0x05
+    ITEM = 0x06
+    TOWNS = 0x0c
+    TOWN = 0x0d
+    WAYPOINTS = 0x0f
+    WAYPOINT = 0x10
+
+    # Attributes
+    DESCRIPTION = 0x01
+    IDENTIFIER = 0x09
+    SPAWN_FILE = 0x0b
+    HOUSE_FILE = 0x0d
+
+    MAP_VERSION = 2
+    ITEMS_MAJOR_VERSION = 3
+    ITEMS_MINOR_VERSION = 57
+
+    # Item ids (7.x items.otb)
+    GROUND = dict(water=4608, sand=231, grass=4526, mountain=919, cave=351)
+    VEGETATION = (2700, 2701, 2702, 2703, 2705, 2767, 2768)
+
+    # Surface height limits (noise is in [0, 1))
+    WATER_LEVEL = 0.38
+    SAND_LEVEL = 0.42
+    MOUNTAIN_LEVEL = 0.72
+    FLOOR_HEIGHT = 0.06     # Mountain height of each floor above surface
+    CAVE_LEVEL = 0.6        # Cave noise limit, lower values are rock
+
+    def __init__(self, width=1024, height=1024, floors=(7,), seed=0,
+                 towns=4, waypoints=8, vegetation=0.3, scale=128.0,
+                 octaves=5, items=None):
+        """
+        width, height: Map size in tiles.
+        floors: Floors to generate (0 highest, 7 surface, 15 lowest).
+        towns, waypoints: Number of towns and waypoints, placed on land.
+        vegetation: Probability of a tree or bush in grass tiles.
+        scale: Size in tiles of the biggest terrain features.
+        octaves: Noise layers, each one half the size of the previous one.
+        items: ItemTypes of the target items.otb, or None.
+        """
+        assert 0 < width <= 0xffff and 0 < height <= 0xffff, "Wrong map size!"
+        assert all(0 <= z <= 15 for z in floors), "Wrong floors!"
+        self.width = width
+        self.height = height
+        self.floors = sorted(set(floors))
+        self.seed = seed
+        self.towns = towns
+        self.waypoints = waypoints
+        self.vegetation = vegetation
+        self.scale = scale
+        self.octaves = octaves
+        self.items = items
+        if items is not None:
+            assert all(items.is_ground(ground) for ground in self.GROUND.values()), \
+                "Ground ids are not grounds in items.otb!"
+            assert all(item in items for item in self.VEGETATION), \
+                "Vegetation ids not found in items.otb!"
+        self.tile_count = 0    # Tiles written by last generate()
+
+    def _hash(self, x, y, salt):
+        """
+        Pseudo random uint32 of each integer position, for salt and seed.
+        """
+        with np.errstate(over='ignore'):
+            h = (x.astype(np.uint32) * np.uint32(0x27d4eb2d)
+                 ^ y.astype(np.uint32) * np.uint32(0x165667b1)
+                 ^ np.uint32((self.seed * 0x9e3779b1 + salt * 0x85ebca77) & 0xffffffff))
+            h ^= h >> np.uint32(15)
+            h *= np.uint32(0x2c1b3c6d)
+            h ^= h >> np.uint32(12)
+            h *= np.uint32(0x297a2d39)
+            h ^= h >> np.uint32(15)
+        return h
+
+    def _random(self, x, y, salt):
+        """
+        Pseudo random float in [0, 1) of each integer position.
+        """
+        return self._hash(x, y, salt) / np.float32(2 ** 32)
+
+    def _noise(self, x, y, salt):
+        """
+        Fractal value noise in [0, 1) at absolute tile positions x, y. It
+        only depends on the position, so chunks match at their borders.
+        """
+        total = np.zeros(np.broadcast(x, y).shape, np.float32)
+        x = np.asarray(x, np.float32)
+        y = np.asarray(y, np.float32)
+        amplitude = 1.0
+        scale = self.scale
+        for octave in range(self.octaves):
+            fx = x / np.float32(scale)
+            fy = y / np.float32(scale)
+            ix = np.floor(fx)
+            iy = np.floor(fy)
+            tx = fx - ix
+            ty = fy - iy
+            tx = tx * tx * (3 - 2 * tx)     # Smoothstep
+            ty = ty * ty * (3 - 2 * ty)
+            ix = ix.astype(np.int64)
+            iy = iy.astype(np.int64)
+            octave_salt = salt * 16 + octave
+            top = (self._random(ix, iy, octave_salt) * (1 - tx)
+                   + self._random(ix + 1, iy, octave_salt) * tx)
+            bottom = (self._random(ix, iy + 1, octave_salt) * (1 - tx)
+                      + self._random(ix + 1, iy + 1, octave_salt) * tx)
+            total += (top * (1 - ty) + bottom * ty) * np.float32(amplitude)
+            amplitude /= 2
+            scale = max(scale / 2, 1.0)
+        return total / np.float32(2 - 2 ** (1 - self.octaves))
+
+    def _get_terrain(self, x, y, z):
+        """
+        Ground and item ids (0 for none) of the tiles at positions x, y of
+        floor z.
+        """
+        ground = np.zeros(x.shape, np.uint16)
+        item = np.zeros(x.shape, np.uint16)
+        height = self._noise(x, y, salt=1)
+        if z == 7:
+            ground[:] = self.GROUND['grass']
+            ground[height < self.SAND_LEVEL] = self.GROUND['sand']
+            ground[height < self.WATER_LEVEL] = self.GROUND['water']
+            ground[height >= self.MOUNTAIN_LEVEL] = self.GROUND['mountain']
+            grass = ground == self.GROUND['grass']
+            plants = grass & (self._noise(x, y, salt=2) > 0.45) \
+                & (self._random(x, y, salt=3) < self.vegetation)
+            vegetation = np.array(self.VEGETATION, np.uint16)
+            choice = self._hash(x, y, salt=4) % np.uint32(len(vegetation))
+            item[plants] = vegetation[choice[plants]]
+        elif z < 7:
+            top = height >= self.MOUNTAIN_LEVEL + (7 - z) * self.FLOOR_HEIGHT
+            ground[top] = self.GROUND['mountain']
+        else:
+            caves = self._noise(x, y, salt=16 + z) >= self.CAVE_LEVEL
+            ground[caves] = self.GROUND['cave']
+        return ground, item
+
+    def _encode_tiles(self, x, y, ground, item):
+        """
+        Encode tile nodes (with their item, if any) of tiles with ground.
+
+        Nodes are built as columns of bytes, each data byte preceded by an
+        escape column that is only kept if the byte needs it.
+        """
+        tiles = ground > 0
+        x, y, ground, item = x[tiles], y[tiles], ground[tiles], item[tiles]
+        has_item = item > 0
+        columns = ((self.NODE_INIT, True, False),
+                   (self.TILE, True, False),
+                   (x & 0xff, True, True),
+                   (y & 0xff, True, True),
+                   (self.IDENTIFIER, True, False),
+                   (ground & 0xff, True, True),
+                   (ground >> 8, True, True),
+                   (self.NODE_INIT, has_item, False),
+                   (self.ITEM, has_item, False),
+                   (item & 0xff, has_item, True),
+                   (item >> 8, has_item, True),
+                   (self.NODE_END, has_item, False),
+                   (self.NODE_END, True, False))
+        count = len(x)
+        values = list()
+        keep = list()
+        for value, kept, escaped in columns:
+            value = np.broadcast_to(np.asarray(value).astype(np.uint8), (count,))
+            kept = np.broadcast_to(kept, (count,))
+            if escaped:
+                values.append(np.full(count, self.NODE_ESCAPE, np.uint8))
+                keep.append(kept & (value >= self.NODE_ESCAPE))
+            values.append(value)
+            keep.append(kept)
+        return count, np.stack(values, axis=1)[np.stack(keep, axis=1)].tobytes()
+
+    def _node(self, node_type, byte_data=b''):
+        return bytes((self.NODE_INIT, node_type)) + OtbmScanner.escape(byte_data)
+
+    @staticmethod
+    def _string(value):
+        data = value.encode('ascii')
+        return len(data).to_bytes(2, "little") + data
+
+    @staticmethod
+    def _position(x, y, z):
+        return (int(x).to_bytes(2, "little") + int(y).to_bytes(2, "little")
+                + int(z).to_bytes(1, "little"))
+
+    def _get_land(self, count, salt):
+        """
+        Random surface positions on sand or grass, up to count (fewer if
+        not enough land is found).
+        """
+        rand = np.random.default_rng((self.seed, salt))
+        candidates = max(count * 64, 1024)
+        x = rand.integers(0, self.width, candidates)
+        y = rand.integers(0, self.height, candidates)
+        ground, _ = self._get_terrain(x, y, 7)
+        land = np.isin(ground, (self.GROUND['sand'], self.GROUND['grass']))
+        return list(zip(x[land][:count].tolist(), y[land][:count].tolist()))
+
+    def _get_towns(self):
+        """
+        Town temple positions, spread over the map.
+        """
+        towns = list()
+        distance = (self.width * self.height / max(self.towns, 1)) ** 0.5 / 2
+        for x, y in self._get_land(self.towns * 32, salt=1):
+            if len(towns) == self.towns:
+                break
+            if all((x - tx) ** 2 + (y - ty) ** 2 >= distance ** 2 for tx, ty in towns):
+                towns.append((x, y))
+        return towns
+
+    def generate(self, file_path):
+        """
+        Write generated map to an otbm file. Returns the number of tiles.
+        """
+        size = self.AREA_SIZE
+        local_x, local_y = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+        local_x = local_x.ravel()
+        local_y = local_y.ravel()
+        self.tile_count = 0
+        items_version = (self.ITEMS_MAJOR_VERSION, self.ITEMS_MINOR_VERSION)
+        if self.items is not None:
+            items_version = self.items.version[:2]
+
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path, 'wb', buffering=1 << 20) as f:
+            f.write(bytes(4))    # Identifier
+            f.write(self._node(self.ROOT,
+                               self.MAP_VERSION.to_bytes(4, "little")
+                               + self.width.to_bytes(2, "little")
+                               + self.height.to_bytes(2, "little")
+                               + items_version[0].to_bytes(4, "little")
+                               + items_version[1].to_bytes(4, "little")))
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            f.write(self._node(self.MAP_DATA,
+                               bytes((self.DESCRIPTION,))
+                               + self._string(f"Generated map, seed {self.seed}")
+                               + bytes((self.SPAWN_FILE,)) + self._string(f"{name}-spawn.xml")
+                               + bytes((self.HOUSE_FILE,)) + self._string(f"{name}-house.xml")))
+
+            for z in self.floors:
+                for base_x in range(0, self.width, size):
+                    for base_y in range(0, self.height, size):
+                        x = local_x + base_x
+                        y = local_y + base_y
+                        inside = (x < self.width) & (y < self.height)
+                        ground, item = self._get_terrain(x[inside], y[inside], z)
+                        count, tiles = self._encode_tiles(local_x[inside], local_y[inside],
+                                                          ground, item)
+                        if not count:
+                            continue
+                        self.tile_count += count
+                        f.write(self._node(self.TILE_AREA, self._position(base_x, base_y, z)))
+                        f.write(tiles)
+                        f.write(bytes((self.NODE_END,)))
+
+            f.write(self._node(self.TOWNS))
+            for town_id, (x, y) in enumerate(self._get_towns(), 1):
+                f.write(self._node(self.TOWN, town_id.to_bytes(4, "little")
+                                              + self._string(f"Town {town_id}")
+                                              + self._position(x, y, 7)))
+                f.write(bytes((self.NODE_END,)))
+            f.write(bytes((self.NODE_END,)))
+
+            f.write(self._node(self.WAYPOINTS))
+            for number, (x, y) in enumerate(self._get_land(self.waypoints, salt=2), 1):
+                f.write(self._node(self.WAYPOINT, self._string(f"Waypoint {number}")
+                                                  + self._position(x, y, 7)))
+                f.write(bytes((self.NODE_END,)))
+            f.write(bytes((self.NODE_END,)))
+
+            f.write(bytes((self.NODE_END, self.NODE_END)))    # Map and root nodes
+        return self.tile_count
@@ -0,0 +1,484 @@
+import numpy as np
+import struct
+
+from array import array
+
+from lib import otbm_attributes
+
+
+class MapModel:
+    """
+    Columnar in-memory map model.
+
+    Tiles are stored in a structured NumPy array with absolute positions,
+    items in CSR layout: items of tile i are items[tile_offsets[i]:
+    tile_offsets[i+1]], in the same order they have in the map (containers
+    before their contents, see 'parent' column).
+
+    Values without a column (texts, teleport destinations, depot ids...) are
+    kept in tile_extra / item_extra dicts, keyed by tile / item index.
+
+    Models can be saved to a binary file (.otbmb) and loaded back with
+    memory mapping, see save() and load().
+    """
+    AREA_DTYPE = np.dtype([('x', 'u2'), ('y', 'u2'), ('z', 'u1')])
+    TILE_DTYPE = np.dtype([
+        ('x', 'u2'),            # Absolute position
+        ('y', 'u2'),
+        ('z', 'u1'),
+        ('area', 'u4'),         # Tile area index
+        ('house_tile', '?'),
+        ('house_id', 'u4'),
+        ('has_flags', '?'),
+        ('flags', 'u4'),
+        ('ground', 'u2'),       # Ground item id, 0 if none
+    ])
+    ITEM_DTYPE = np.dtype([
+        ('id', 'u2'),
+        ('count', 'u1'),
+        ('action_id', 'u2'),
+        ('unique_id', 'u2'),
+        ('charges', 'u2'),
+        ('parent', 'i4'),       # Container item index, -1 if none
+    ])
+
+    # Tile flags json keys and bits ('flags' column), see lib.otbm_attributes
+    FLAGS = otbm_attributes.FLAGS
+    KNOWN_FLAGS = otbm_attributes.KNOWN_FLAGS
+    OTHER_FLAGS = otbm_attributes.OTHER_FLAGS
+
+    # Json keys stored in item columns, 0 values are kept in item_extra
+    ITEM_COLUMNS = (('IDENTIFIER', 'id'),
+                    ('COUNT', 'count'),
+                    ('ACTION_ID', 'action_id'),
+                    ('UNIQUE_ID', 'unique_id'),
+                    ('RUNE_CHARGES', 'charges'))
+
+    # Binary file, little endian: file header, section table (offset and
+    # number of elements of each section) and 8 bytes aligned sections
+    SUFFIX = '.otbmb'
+    MAGIC = b'OTBMMDL\x00'
+    VERSION = 1
+
+    # Extra values: tile_extra, item_extra, header and map_data entries
+    TILE_EXTRA = 0
+    ITEM_EXTRA = 1
+    MAP_EXTRA = 2    # Key is the '/' separated json path
+    INT = 0
+    STRING = 1
+    DICT = 2
+    EXTRA_DTYPE = np.dtype([
+        ('owner', 'u1'),
+        ('index', 'u4'),        # Tile / item index
+        ('key', 'u4'),          # String table index
+        ('kind', 'u1'),
+        ('value', 'i8'),        # Integer or string table index
+    ])
+
+    _FILE_HEADER = struct.Struct('<8sI')    # Magic, version
+    _SECTION = struct.Struct('<QQ')         # Offset, number of elements
+    _SECTIONS = (('strings', np.dtype('u1')),     # Utf-8 string table
+                 ('string_offsets', np.dtype('<u8')),
+                 ('areas', AREA_DTYPE.newbyteorder('<')),
+                 ('tiles', TILE_DTYPE.newbyteorder('<')),
+                 ('items', ITEM_DTYPE.newbyteorder('<')),
+                 ('tile_offsets', np.dtype('<i8')),
+                 ('extras', EXTRA_DTYPE.newbyteorder('<')))
+
+    _TILE_KEYS = frozenset(('X', 'Y', 'HOUSE_ID', 'IDENTIFIER', OTHER_FLAGS)
+                           + tuple(key for key, _ in FLAGS))
+    _ITEM_KEYS = frozenset(key for key, _ in ITEM_COLUMNS)
+
+    def __init__(self):
+        self.header = dict()        # Identifier, map and items versions
+        self.map_data = dict()      # Map node data other than tile areas
+        self.areas = np.zeros(0, self.AREA_DTYPE)
+        self.tiles = np.zeros(0, self.TILE_DTYPE)
+        self.items = np.zeros(0, self.ITEM_DTYPE)
+        self.tile_offsets = np.zeros(1, np.int64)
+        self.tile_extra = dict()
+        self.item_extra = dict()
+
+        # Columns being filled, see finish()
+        self._area_columns = {name: array('q') for name in self.AREA_DTYPE.names}
+        self._tile_columns = {name: array('q') for name in self.TILE_DTYPE.names}
+        self._item_columns = {name: array('q') for name in self.ITEM_DTYPE.names}
+        self._tile_offsets = array('q', [0])
+
+    @property
+    def tile_count(self):
+        return len(self.tiles)
+
+    @property
+    def item_count(self):
+        return len(self.items)
+
+    def add_area(self, area):
+        """
+        Add tile area from its json dict (X, Y, Z). Tiles added before and
+        not yet assigned to an area belong to it.
+        """
+        for key, column in (('X', 'x'), ('Y', 'y'), ('Z', 'z')):
+            self._area_columns[column].append(area.get(key, 0))
+
+    def add_tile(self, area, tile, house_tile=False):
+        """
+        Add tile (and its items) from its json dict. Area is the json dict
+        of the tile area it belongs to.
+        """
+        columns = self._tile_columns
+        index = len(columns['x'])
+        extra = dict()
+        columns['x'].append(area.get('X', 0) + tile.get('X', 0))
+        columns['y'].append(area.get('Y', 0) + tile.get('Y', 0))
+        columns['z'].append(area.get('Z', 0))
+        columns['area'].append(len(self._area_columns['x']))
+        columns['house_tile'].append(house_tile)
+        columns['house_id'].append(tile.get('HOUSE_ID', 0))
+        columns['has_flags'].append('PROTECTION_ZONE' in tile)
+        flags = int(tile.get(self.OTHER_FLAGS, 0))
+        for key, flag in self.FLAGS:
+            if tile.get(key):
+                flags |= flag
+        columns['flags'].append(flags)
+        ground = tile.get('IDENTIFIER')
+        columns['ground'].append(ground or 0)
+        if ground == 0:
+            extra['IDENTIFIER'] = 0
+
+        for key, value in tile.items():
+            if key.startswith('ITEM_'):
+                self._add_item(value, -1)
+            elif key not in self._TILE_KEYS:
+                extra[key] = value
+        if extra:
+            self.tile_extra[index] = extra
+        self._tile_offsets.append(len(self._item_columns['id']))
+
+    def _add_item(self, item, parent):
+        columns = self._item_columns
+        index = len(columns['id'])
+        extra = dict()
+        for key, column in self.ITEM_COLUMNS:
+            value = item.get(key)
+            columns[column].append(value or 0)
+            if value == 0:
+                extra[key] = 0
+        columns['parent'].append(parent)
+        for key, value in item.items():
+            if key.startswith('ITEM_'):
+                self._add_item(value, index)
+            elif key not in self._ITEM_KEYS:
+                extra[key] = value
+        if extra:
+            self.item_extra[index] = extra
+
+    def extend(self, model):
+        """
+        Add the areas, tiles and items added to another model (not finished
+        yet), after the ones added to this one.
+        """
+        def shifted(values, shift):
+            data = np.frombuffer(values, dtype=np.int64) if values else np.zeros(0, np.int64)
+            return np.where(data < 0, data, data + shift).tobytes()
+
+        areas = len(self._area_columns['x'])
+        tiles = len(self._tile_columns['x'])
+        items = len(self._item_columns['id'])
+        for columns, added in ((self._area_columns, model._area_columns),
+                               (self._tile_columns, model._tile_columns),
+                               (self._item_columns, model._item_columns)):
+            for name, values in added.items():
+                if columns is self._tile_columns and name == 'area':
+                    columns[name].frombytes(shifted(values, areas))
+                elif columns is self._item_columns and name == 'parent':
+                    columns[name].frombytes(shifted(values, items))    # -1 is kept
+                else:
+                    columns[name].extend(values)
+        self._tile_offsets.frombytes(shifted(model._tile_offsets[1:], items))
+        self.tile_extra.update((index + tiles, extra)
+                               for index, extra in model.tile_extra.items())
+        self.item_extra.update((index + items, extra)
+                               for index, extra in model.item_extra.items())
+
+    def finish(self):
+        """
+        Move added areas, tiles and items to their NumPy arrays.
+        """
+        for name, columns, dtype in (('areas', self._area_columns, self.AREA_DTYPE),
+                                     ('tiles', self._tile_columns, self.TILE_DTYPE),
+                                     ('items', self._item_columns, self.ITEM_DTYPE)):
+            data = np.zeros(len(columns[dtype.names[0]]), dtype)
+            for column, values in columns.items():
+                data[column] = np.frombuffer(values, dtype=np.int64) if values else 0
+                del values[:]
+            setattr(self, name, data)
+        self.tile_offsets = np.frombuffer(self._tile_offsets, dtype=np.int64).copy()
+        self._tile_offsets = array('q', [0])
+        return self
+
+    @classmethod
+    def from_json(cls, json_data):
+        """
+        Create a map model from Otbm2Json json data.
+        """
+        model = cls()
+        for key, value in json_data.items():
+            if key != 'MAP':
+                model.header[key] = value
+        for key, value in json_data.get('MAP', {}).items():
+            if key.startswith('TILE_AREA_'):
+                for tile_key, tile in value.items():
+                    if tile_key.startswith('TILE_'):
+                        model.add_tile(value, tile)
+                    elif tile_key.startswith('HOUSE_TILE_'):
+                        model.add_tile(value, tile, house_tile=True)
+                model.add_area(value)
+            else:
+                model.map_data[key] = value
+        return model.finish()
+
+    def _item_json(self, item, extra):
+        """
+        Json dict of an item given its ITEM_COLUMNS values and its extra
+        values.
+        """
+        node = dict()
+        for (key, _), value in zip(self.ITEM_COLUMNS, item):
+            if value:
+                node[key] = value
+            elif key in extra:
+                node[key] = extra[key]
+        for key, value in extra.items():
+            if key not in node:
+                node[key] = value
+        return node
+
+    def iter_areas(self):
+        """
+        Json key and json dict of each tile area, with its tiles and items.
+        """
+        tile_cnt = 0
+        house_tile_cnt = 0
+        item_columns = [column for _, column in self.ITEM_COLUMNS]
+        limits = np.searchsorted(self.tiles['area'], np.arange(len(self.areas) + 1))
+        for area_index, area in enumerate(self.areas.tolist()):
+            area_node = dict(zip(('X', 'Y', 'Z'), area))
+            start, end = limits[area_index], limits[area_index + 1]
+            tiles = self.tiles[start:end].tolist()
+            offsets = self.tile_offsets[start:end + 1].tolist()
+            items = self.items[offsets[0]:offsets[-1]]
+            parents = items['parent'].tolist()
+            items = items[item_columns].tolist()
+            for index, tile in enumerate(tiles):
+                x, y, _, _, house_tile, house_id, has_flags, flags, ground = tile
+                node = {'X': x - area_node['X'], 'Y': y - area_node['Y']}
+                if house_tile:
+                    house_tile_cnt += 1
+                    area_node[f'HOUSE_TILE_{house_tile_cnt}'] = node
+                    node['HOUSE_ID'] = house_id
+                else:
+                    tile_cnt += 1
+                    area_node[f'TILE_{tile_cnt}'] = node
+                if has_flags:
+                    for key, flag in self.FLAGS:
+                        node[key] = int(bool(flags & flag))
+                    if flags & ~self.KNOWN_FLAGS:
+                        node[self.OTHER_FLAGS] = flags & ~self.KNOWN_FLAGS
+                if ground:
+                    node['IDENTIFIER'] = ground
+                node.update(self.tile_extra.get(start + index, {}))
+
+                # Items, containers nodes are added before their contents
+                item_nodes = dict()
+                for item_cnt, item_index in enumerate(range(offsets[index],
+                                                            offsets[index + 1]), 1):
+                    local = item_index - offsets[0]
+                    item_node = self._item_json(items[local],
+                                                self.item_extra.get(item_index, {}))
+                    item_nodes[item_index] = item_node
+                    parent = parents[local]
+                    container = node if parent < 0 else item_nodes[parent]
+                    container[f'ITEM_{item_cnt}'] = item_node
+            yield f'TILE_AREA_{area_index + 1}', area_node
+
+    def iter_map(self):
+        """
+        Json keys and values of the map node, in Otbm2Json order: map
+        properties, tile areas (see iter_areas), towns and waypoints.
+        """
+        for key, value in self.map_data.items():
+            if not isinstance(value, dict):
+                yield key, value
+        yield from self.iter_areas()
+        for key, value in self.map_data.items():
+            if isinstance(value, dict):
+                yield key, value
+
+    def to_json(self):
+        """
+        Create Otbm2Json json data from the map model.
+        """
+        json_data = dict(self.header)
+        json_data['MAP'] = dict(self.iter_map())
+        return json_data
+
+    def _get_extras(self, strings):
+        """
+        Extra values as EXTRA_DTYPE records, strings are added to strings
+        (string -> index).
+        """
+        records = list()
+
+        def add(owner, index, key, value):
+            key_id = strings.setdefault(key, len(strings))
+            if isinstance(value, dict):
+                records.append((owner, index, key_id, self.DICT, 0))
+                for child_key, child in value.items():
+                    add(owner, index, f'{key}/{child_key}', child)
+            elif isinstance(value, str):
+                records.append((owner, index, key_id, self.STRING,
+                                strings.setdefault(value, len(strings))))
+            elif isinstance(value, int):
+                records.append((owner, index, key_id, self.INT, value))
+            else:
+                raise ValueError(f"{key}: {value!r} can not be saved")
+
+        for key, value in self.header.items():
+            add(self.MAP_EXTRA, 0, key, value)
+        for key, value in self.map_data.items():
+            add(self.MAP_EXTRA, 0, f'MAP/{key}', value)
+        for owner, extras in ((self.TILE_EXTRA, self.tile_extra),
+                              (self.ITEM_EXTRA, self.item_extra)):
+            for index, extra in extras.items():
+                for key, value in extra.items():
+                    add(owner, index, key, value)
+        return np.array(records, self.EXTRA_DTYPE)
+
+    def save(self, file_path):
+        """
+        Write model to a binary file, see load().
+        """
+        strings = dict()
+        extras = self._get_extras(strings)
+        encoded = [string.encode('utf-8') for string in strings]
+        string_offsets = np.zeros(len(encoded) + 1, np.uint64)
+        np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+        data = dict(strings=np.frombuffer(b''.join(encoded), np.uint8),
+                    string_offsets=string_offsets,
+                    areas=self.areas, tiles=self.tiles, items=self.items,
+                    tile_offsets=self.tile_offsets, extras=extras)
+
+        with open(file_path, 'wb') as f:
+            f.write(self._FILE_HEADER.pack(self.MAGIC, self.VERSION))
+            table = f.tell()
+            f.write(bytes(self._SECTION.size * len(self._SECTIONS)))
+            sections = list()
+            for name, dtype in self._SECTIONS:
+                f.write(bytes(-f.tell() % 8))
+                sections.append(self._SECTION.pack(f.tell(), len(data[name])))
+                f.write(np.ascontiguousarray(data[name], dtype).tobytes())
+            f.seek(table)
+            f.write(b''.join(sections))
+
+    @classmethod
+    def load(cls, file_path, mmap=True):
+        """
+        Read model from a binary file created with save().
+
+        With mmap, areas, tiles and items arrays are read only views of the
+        memory mapped file, records are not parsed or copied. Only extra
+        values are decoded.
+        """
+        if mmap:
+            data = np.memmap(file_path, dtype=np.uint8, mode='r')
+        else:
+            data = np.fromfile(file_path, dtype=np.uint8)
+        try:
+            magic, version = cls._FILE_HEADER.unpack_from(data, 0)
+        except struct.error:
+            magic = version = None
+        if (magic, version) != (cls.MAGIC, cls.VERSION):
+            raise ValueError(f"{file_path} is not a map model file!")
+
+        sections = dict()
+        offset = cls._FILE_HEADER.size
+        for name, dtype in cls._SECTIONS:
+            start, count = cls._SECTION.unpack_from(data, offset)
+            offset += cls._SECTION.size
+            end = start + count * dtype.itemsize
+            if end > len(data):
+                raise ValueError(f"{file_path} is truncated!")
+            sections[name] = data[start:end].view(dtype)
+
+        model = cls()
+        model.areas = sections['areas']
+        model.tiles = sections['tiles']
+        model.items = sections['items']
+        model.tile_offsets = sections['tile_offsets']
+        blob = sections['strings'].tobytes()
+        offsets = sections['string_offsets'].tolist()
+        strings = [blob[start:end].decode('utf-8')
+                   for start, end in zip(offsets, offsets[1:])]
+
+        for owner, index, key, kind, value in sections['extras'].tolist():
+            key = strings[key]
+            value = strings[value] if kind == cls.STRING else value
+            if owner == cls.MAP_EXTRA:
+                *path, key = key.split('/')
+                node = model.header
+                if path and path[0] == 'MAP':
+                    node = model.map_data
+                    path = path[1:]
+                for name in path:
+                    node = node[name]
+                node[key] = dict() if kind == cls.DICT else value
+            else:
+                extras = model.tile_extra if owner == cls.TILE_EXTRA else model.item_extra
+                extras.setdefault(index, dict())[key] = value
+        return model
+
+    def item_tiles(self):
+        """
+        Tile index of each item.
+        """
+        return np.repeat(np.arange(self.tile_count), np.diff(self.tile_offsets))
+
+    def select_tiles(self, x0=None, y0=None, x1=None, y1=None, z=None,
+                     house_id=None, flags=None):
+        """
+        Indexes of tiles matching every given filter. Bounding box limits are
+        inclusive, flags matches tiles having all the given flag bits.
+        """
+        tiles = self.tiles
+        mask = np.ones(len(tiles), dtype=bool)
+        for column, value, compare in (('x', x0, np.greater_equal),
+                                       ('y', y0, np.greater_equal),
+                                       ('x', x1, np.less_equal),
+                                       ('y', y1, np.less_equal),
+                                       ('z', z, np.equal),
+                                       ('house_id', house_id, np.equal)):
+            if value is not None:
+                mask &= compare(tiles[column], value)
+        if flags is not None:
+            mask &= (tiles['flags'] & flags) == flags
+        return np.flatnonzero(mask)
+
+    def find_items(self, item_ids):
+        """
+        Indexes of items with any of the given ids.
+        """
+        return np.flatnonzero(np.isin(self.items['id'], item_ids))
+
+    def item_positions(self, item_indexes):
+        """
+        Absolute (x, y, z) tile positions of the given items.
+        """
+        tiles = self.tiles[self.item_tiles()[item_indexes]]
+        return np.stack((tiles['x'], tiles['y'], tiles['z']), axis=-1)
+
+    def count_items(self):
+        """
+        Item ids and number of items of each id.
+        """
+        return np.unique(self.items['id'], return_counts=True)
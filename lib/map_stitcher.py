@@ -0,0 +1,318 @@
+
+from collections import defaultdict, namedtuple
+from contextlib import ExitStack
+
+from lib import compressed_io
+from lib.otbm_index import OtbmIndex
+from lib.otbm_scanner import OtbmScanner
+
+
+StitchSource = namedtuple('StitchSource', [
+    'file_path',
+    'region',    # (x0, y0, x1, y1, z0, z1) inclusive limits, None for all
+    'offset',    # (dx, dy, dz) added to positions
+])
+
+
+class MapStitcher:
+    """
+    Crop and merge OTBM maps without decoding them.
+
+    Tile area nodes are copied as raw bytes from the source files. When an
+    offset is applied only the area base position is rewritten, as long as
+    it keeps areas aligned (x and y multiples of AREA_SIZE). Tiles are only
+    walked (not decoded) in areas cut by a crop region, moved by an
+    unaligned offset or overlapped by a later map: their raw tile nodes are
+    filtered and regrouped, rewriting the 2 bytes tile position if needed.
+
+    Maps added later are drawn over earlier ones: their tiles replace
+    tiles at the same position, and their towns and waypoints replace ones
+    with the same id or name. Header and map data (description, house and
+    spawn files) are the first map's, size grows to fit every map.
+
+    Item attributes with positions (teleport destinations) and house and
+    spawn xml files are not moved.
+    """
+    AREA_SIZE = 256
+
+    NODE_ESCAPE = 0xfd
+    NODE_INIT = b'\xfe'
+    NODE_END = b'\xff'
+
+    def __init__(self, index_cache=True):
+        self.index_cache = index_cache    # Keep indexes in sidecar files
+        self._sources = list()
+
+    def add(self, file_path, region=None, offset=(0, 0, 0)):
+        """
+        Add a map (or the region of it, see StitchSource) moved by offset.
+        """
+        if region is not None:
+            x0, y0, x1, y1, z0, z1 = region
+            assert x0 <= x1 and y0 <= y1 and z0 <= z1, "Wrong region!"
+        self._sources.append(StitchSource(file_path, region, tuple(offset)))
+
+    def _skip_escaped(self, buffer, offset, count):
+        """
+        Read count payload bytes at offset of raw node bytes. Returns them
+        unescaped and the offset after them.
+        """
+        data = bytearray()
+        while len(data) < count:
+            if buffer[offset] == self.NODE_ESCAPE:
+                offset += 1
+            data.append(buffer[offset])
+            offset += 1
+        return bytes(data), offset
+
+    @staticmethod
+    def _position(x, y, z):
+        return (x.to_bytes(2, "little") + y.to_bytes(2, "little")
+                + z.to_bytes(1, "little"))
+
+    def _inside(self, source, x, y, z):
+        if source.region is None:
+            return True
+        x0, y0, x1, y1, z0, z1 = source.region
+        return x0 <= x <= x1 and y0 <= y <= y1 and z0 <= z <= z1
+
+    def _target(self, source, x, y, z):
+        """
+        Target area base and tile position of source position.
+        """
+        dx, dy, dz = source.offset
+        x, y, z = x + dx, y + dy, z + dz
+        if not (0 <= x <= 0xffff and 0 <= y <= 0xffff and 0 <= z <= 15):
+            raise ValueError(f"Position {x, y, z} out of map limits")
+        size = self.AREA_SIZE
+        return (x - x % size, y - y % size, z), x % size, y % size
+
+    def _area_state(self, source, area):
+        """
+        Whether an area is skipped ('out'), copied as a whole ('whole') or
+        walked tile by tile ('tiles'), ignoring later maps.
+        """
+        size = self.AREA_SIZE
+        if source.region is not None:
+            x0, y0, x1, y1, z0, z1 = source.region
+            if not (z0 <= area.z <= z1 and area.x <= x1 and area.x + size > x0
+                    and area.y <= y1 and area.y + size > y0):
+                return 'out'
+            if not (x0 <= area.x and area.x + size - 1 <= x1
+                    and y0 <= area.y and area.y + size - 1 <= y1):
+                return 'tiles'
+        dx, dy, _ = source.offset
+        if area.x % size or area.y % size or dx % size or dy % size:
+            return 'tiles'
+        return 'whole'
+
+    def _area_targets(self, source, area):
+        """
+        Target area bases an area's tiles can go to.
+        """
+        size = self.AREA_SIZE
+        dx, dy, dz = source.offset
+        x0, y0, x1, y1 = area.x, area.y, area.x + size - 1, area.y + size - 1
+        if source.region is not None:
+            x0, y0 = max(x0, source.region[0]), max(y0, source.region[1])
+            x1, y1 = min(x1, source.region[2]), min(y1, source.region[3])
+        return {(x - x % size, y - y % size, area.z + dz)
+                for x in (x0 + dx, x1 + dx) for y in (y0 + dy, y1 + dy)}
+
+    def _iter_tiles(self, scanner, source, area):
+        """
+        Yield (target area base, x, y, tile node start, position end, tile
+        node end) of an area's tiles inside source's region. Offsets are
+        file offsets, tile node bytes after position end are copied as is.
+        """
+        buffer = scanner.buffer
+        region = source.region
+        if region is None:
+            region = (0, 0, 0xffff, 0xffff, 0, 15)
+        x0, y0, x1, y1, z0, z1 = region
+        if not z0 <= area.z <= z1:
+            return
+        dx, dy, dz = source.offset
+        size = self.AREA_SIZE
+        escape = self.NODE_ESCAPE
+        depth = 0
+        for event, _, _, offset in scanner.nodes(area.offset, area.offset + area.length,
+                                                 payloads=False):
+            if event == OtbmScanner.NODE_INIT:
+                depth += 1
+                if depth == 2:
+                    start = offset
+                continue
+            if depth == 2:
+                x, y = buffer[start + 2], buffer[start + 3]
+                position_end = start + 4
+                if x >= escape or y >= escape:
+                    (x, y), position_end = self._skip_escaped(buffer, start + 2, 2)
+                x, y = area.x + x, area.y + y
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    if dx or dy or dz:
+                        key, x, y = self._target(source, x, y, area.z)
+                    else:
+                        key = (x - x % size, y - y % size, area.z)
+                        x, y = x % size, y % size
+                    yield key, x, y, start, position_end, offset + 1
+            depth -= 1
+
+    def _get_towns(self, scanner, index, source, node_type, towns):
+        """
+        Add towns (by id) or waypoints (by name) of a map inside source's
+        region to towns, as (payload before position, position) tuples.
+        """
+        for node in index.nodes:
+            if node.node_type != node_type:
+                continue
+            for event, child_type, payload, _ in scanner.nodes(node.offset,
+                                                               node.offset + node.length):
+                if event != OtbmScanner.NODE_INIT or child_type == node_type:
+                    continue
+                payload = bytes(payload)
+                if child_type == OtbmScanner.TOWN:
+                    key = int.from_bytes(payload[:4], "little")
+                    start = 4
+                else:
+                    key = None
+                    start = 0
+                length = int.from_bytes(payload[start:start + 2], "little")
+                end = start + 2 + length
+                if key is None:
+                    key = payload[start + 2:end]
+                x = int.from_bytes(payload[end:end + 2], "little")
+                y = int.from_bytes(payload[end + 2:end + 4], "little")
+                z = payload[end + 4]
+                if self._inside(source, x, y, z):
+                    dx, dy, dz = source.offset
+                    towns[key] = (payload[:end], (x + dx, y + dy, z + dz))
+
+    def _copy_area(self, file, buffer, area, key):
+        """
+        Write raw tile area node with key as base position.
+        """
+        data = buffer[area.offset:area.offset + area.length]
+        if key == (area.x, area.y, area.z):
+            file.write(data)
+            return
+        _, end = self._skip_escaped(data, 2, 5)
+        file.write(self.NODE_INIT + bytes((OtbmScanner.TILE_AREA,))
+                   + OtbmScanner.escape(self._position(*key)))
+        file.write(data[end:])
+
+    def _write_list(self, file, node_type, child_type, towns):
+        file.write(self.NODE_INIT + bytes((node_type,)))
+        for data, position in towns.values():
+            file.write(self.NODE_INIT + bytes((child_type,))
+                       + OtbmScanner.escape(data + self._position(*position)) + self.NODE_END)
+        file.write(self.NODE_END)
+
+    def write(self, file_path):
+        """
+        Write added maps to an otbm file (compressed if it has a .gz, .xz or
+        .bz2 suffix). Returns the number of tiles written.
+        """
+        assert self._sources, "No maps added!"
+        with ExitStack() as stack:
+            maps = list()
+            for source in self._sources:
+                scanner = stack.enter_context(OtbmScanner(source.file_path))
+                index = OtbmIndex.open(source.file_path, self.index_cache)
+                maps.append((source, scanner, index))
+
+            # Target areas of each map, tiles of areas also covered by later
+            # maps are walked to find out which ones are replaced
+            targets = list()
+            for source, _, index in maps:
+                keys = set()
+                for area in index:
+                    if self._area_state(source, area) != 'out':
+                        keys |= self._area_targets(source, area)
+                targets.append(keys)
+            earlier = set()    # Targets of previous maps
+            owners = dict()    # Target area -> bytearray of last map + 1 per tile
+            for number, (source, scanner, index) in enumerate(maps):
+                for area in index:
+                    if self._area_state(source, area) == 'out' \
+                            or not self._area_targets(source, area) & earlier:
+                        continue
+                    for key, x, y, *_ in self._iter_tiles(scanner, source, area):
+                        if key in earlier:
+                            owners.setdefault(key, bytearray(self.AREA_SIZE ** 2))[
+                                x * self.AREA_SIZE + y] = number + 1
+                earlier |= targets[number]
+
+            header = dict(maps[0][2].header)
+            width = height = 0
+            towns, waypoints = dict(), dict()
+            for source, scanner, index in maps:
+                dx, dy, _ = source.offset
+                x1 = index.header.get('map_width', 0) - 1
+                y1 = index.header.get('map_height', 0) - 1
+                if source.region is not None:
+                    x1, y1 = min(x1, source.region[2]), min(y1, source.region[3])
+                width, height = max(width, x1 + 1 + dx), max(height, y1 + 1 + dy)
+                self._get_towns(scanner, index, source, OtbmScanner.TOWNS, towns)
+                self._get_towns(scanner, index, source, OtbmScanner.WAYPOINTS, waypoints)
+            header['map_width'] = min(max(width, 0), 0xffff)
+            header['map_height'] = min(max(height, 0), 0xffff)
+
+            tile_count = 0
+            with compressed_io.open_file(file_path, 'wb') as f:
+                f.write(header.get('identifier', 0).to_bytes(4, "little"))
+                root = b''.join(header.get(key, 0).to_bytes(size, "little")
+                                for key, size in OtbmScanner.HEADER)
+                f.write(self.NODE_INIT + bytes((OtbmScanner.ROOT,)) + OtbmScanner.escape(root))
+                f.write(self._get_map_data(*maps[0][1:]))
+
+                for number, (source, scanner, index) in enumerate(maps):
+                    buffer = scanner.buffer
+                    for area in index:
+                        state = self._area_state(source, area)
+                        if state == 'out':
+                            continue
+                        if state == 'whole':
+                            key, _, _ = self._target(source, area.x, area.y, area.z)
+                            if max(owners.get(key, b'\0')) <= number + 1:    # Not overlapped
+                                tile_count += area.tiles + area.house_tiles
+                                self._copy_area(f, buffer, area, key)
+                                continue
+
+                        tiles = defaultdict(list)
+                        for key, x, y, start, position_end, end in \
+                                self._iter_tiles(scanner, source, area):
+                            owner = owners.get(key)
+                            if owner is not None and owner[x * self.AREA_SIZE + y] > number + 1:
+                                continue    # Replaced by a later map
+                            position = bytes((x, y))
+                            if x >= self.NODE_ESCAPE or y >= self.NODE_ESCAPE:
+                                position = OtbmScanner.escape(position)
+                            tiles[key].append(b''.join((buffer[start:start + 2], position,
+                                                        buffer[position_end:end])))
+                        for key, nodes in tiles.items():
+                            tile_count += len(nodes)
+                            f.write(self.NODE_INIT + bytes((OtbmScanner.TILE_AREA,))
+                                    + OtbmScanner.escape(self._position(*key)))
+                            f.write(b''.join(nodes))
+                            f.write(self.NODE_END)
+
+                self._write_list(f, OtbmScanner.TOWNS, OtbmScanner.TOWN, towns)
+                self._write_list(f, OtbmScanner.WAYPOINTS, OtbmScanner.WAYPOINT,
+                                 waypoints)
+                f.write(self.NODE_END + self.NODE_END)    # Map and root nodes
+        return tile_count
+
+    @staticmethod
+    def _get_map_data(scanner, index):
+        """
+        Raw map node start and data (without its children).
+        """
+        map_node = next((node for node in index.nodes
+                         if node.node_type == OtbmScanner.MAP_DATA), None)
+        if map_node is None:
+            return MapStitcher.NODE_INIT + bytes((OtbmScanner.MAP_DATA,))
+        end = min((node.offset for node in index.nodes
+                   if map_node.offset < node.offset < map_node.offset + map_node.length),
+                  default=map_node.offset + map_node.length - 1)
+        return bytes(scanner.buffer[map_node.offset:end])
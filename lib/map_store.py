@@ -0,0 +1,295 @@
+import json
+import os
+import sqlite3
+
+from lib import compressed_io
+from lib.json_stream import JsonStreamWriter
+
+
+class MapStore:
+    """
+    SQLite map store.
+
+    Decoded tile areas, tiles, items, towns and waypoints are inserted as
+    they are read (see Otbm2Json.generate_store) in batches of BATCH_SIZE
+    tiles, one transaction each, so a map of any size can be stored with
+    bounded memory. Positions are absolute, tiles are indexed by (z, x, y)
+    and house id and items by item id.
+
+    Node data is kept as json text (without child nodes) with its json key,
+    so the whole map json can be written back from the store (see to_json).
+    Queries return tiles as ndjson records (see Otbm2Json.generate_ndjson):
+    absolute X, Y and Z, tile data and items.
+    """
+    SUFFIX = '.otbmdb'
+    BATCH_SIZE = 10000    # Tiles per transaction
+
+    _SCHEMA = (
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE map_nodes (seq INTEGER PRIMARY KEY, key TEXT)',
+        'CREATE TABLE areas (id INTEGER PRIMARY KEY, key TEXT, x INTEGER, y INTEGER, '
+        'z INTEGER, first_tile INTEGER, last_tile INTEGER)',
+        'CREATE TABLE tiles (id INTEGER PRIMARY KEY, area INTEGER, key TEXT, x INTEGER, '
+        'y INTEGER, z INTEGER, house_id INTEGER, data TEXT)',
+        'CREATE TABLE items (id INTEGER PRIMARY KEY, tile INTEGER, parent INTEGER, '
+        'key TEXT, item_id INTEGER, data TEXT)',
+        'CREATE TABLE towns (id INTEGER PRIMARY KEY, list TEXT, key TEXT, town_id INTEGER, '
+        'name TEXT, x INTEGER, y INTEGER, z INTEGER, data TEXT)',
+        'CREATE TABLE waypoints (id INTEGER PRIMARY KEY, list TEXT, key TEXT, name TEXT, '
+        'x INTEGER, y INTEGER, z INTEGER, data TEXT)',
+    )
+    # Created once every row is inserted, building them is faster than
+    # updating them on each insert
+    _INDEXES = (
+        'CREATE INDEX tiles_position ON tiles (z, x, y)',
+        'CREATE INDEX tiles_house ON tiles (house_id) WHERE house_id IS NOT NULL',
+        'CREATE INDEX items_item_id ON items (item_id)',
+        'CREATE INDEX items_tile ON items (tile)',
+    )
+
+    def __init__(self, file_path, create=False):
+        """
+        Open a store file, create=True replaces it with an empty store.
+        """
+        self.file_path = file_path
+        if create:
+            for suffix in ('', '-journal', '-wal', '-shm'):
+                if os.path.exists(f"{file_path}{suffix}"):
+                    os.remove(f"{file_path}{suffix}")
+        elif not os.path.isfile(file_path):
+            raise FileNotFoundError(file_path)
+        self._db = sqlite3.connect(file_path)
+        if create:
+            # A store is rebuilt from its map if lost, durability is not needed
+            self._db.execute('PRAGMA journal_mode = OFF')
+            self._db.execute('PRAGMA synchronous = OFF')
+            with self._db:
+                for statement in self._SCHEMA:
+                    self._db.execute(statement)
+
+        # Rows waiting to be inserted, see _flush
+        self._tiles = list()
+        self._items = list()
+        self._areas = list()
+        self._map_nodes = list()
+        self._tile_id = 0
+        self._item_id = 0
+        self._area_start = 0    # Last tile id of previous area
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _flush(self):
+        """
+        Insert waiting rows in a single transaction.
+        """
+        with self._db:
+            self._db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 self._tiles)
+            self._db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                                 self._items)
+            self._db.executemany('INSERT INTO areas VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 self._areas)
+            self._db.executemany('INSERT INTO map_nodes (key) VALUES (?)',
+                                 self._map_nodes)
+        self._tiles.clear()
+        self._items.clear()
+        self._areas.clear()
+        self._map_nodes.clear()
+
+    @staticmethod
+    def _node_data(node):
+        """
+        Json text of node data, without child items.
+        """
+        return json.dumps({key: value for key, value in node.items()
+                           if not key.startswith('ITEM_')}, ensure_ascii=False)
+
+    def _add_items(self, node, tile_id, parent):
+        for key, item in node.items():
+            if key.startswith('ITEM_') and isinstance(item, dict):
+                self._item_id += 1
+                self._items.append((self._item_id, tile_id, parent, key,
+                                    item.get('IDENTIFIER', 0), self._node_data(item)))
+                self._add_items(item, tile_id, self._item_id)
+
+    def add_tile(self, area_key, area, key, tile):
+        """
+        Add tile (with its items) of tile area area_key. Tiles of an area
+        must be added before the area.
+        """
+        self._tile_id += 1
+        house_id = tile.get('HOUSE_ID', 0) if key.startswith('HOUSE_TILE_') else None
+        self._tiles.append((self._tile_id, int(area_key.rpartition('_')[2]), key,
+                            area.get('X', 0) + tile.get('X', 0),
+                            area.get('Y', 0) + tile.get('Y', 0),
+                            area.get('Z', 0), house_id, self._node_data(tile)))
+        self._add_items(tile, self._tile_id, None)
+        if len(self._tiles) >= self.BATCH_SIZE:
+            self._flush()
+
+    def add_area(self, key, area):
+        """
+        Add tile area, once its tiles are added.
+        """
+        self._areas.append((int(key.rpartition('_')[2]), key, area.get('X', 0),
+                            area.get('Y', 0), area.get('Z', 0), self._area_start + 1,
+                            self._tile_id))
+        self._area_start = self._tile_id
+        self._map_nodes.append((key,))
+
+    def add_list(self, key, node):
+        """
+        Add towns (TOWNS node) or waypoints (WAYPOINTS_n node).
+        """
+        self._flush()    # Keep map nodes order
+        places = [(key, place_key, place) for place_key, place in node.items()
+                  if isinstance(place, dict)]
+        with self._db:
+            if key == 'TOWNS':
+                self._db.executemany(
+                    'INSERT INTO towns (list, key, town_id, name, x, y, z, data) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(key, place_key, place.get('ID'), place.get('NAME'), place.get('X'),
+                      place.get('Y'), place.get('Z'), json.dumps(place, ensure_ascii=False))
+                     for key, place_key, place in places])
+            else:
+                self._db.executemany(
+                    'INSERT INTO waypoints (list, key, name, x, y, z, data) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(key, place_key, place.get('NAME'), place.get('X'), place.get('Y'),
+                      place.get('Z'), json.dumps(place, ensure_ascii=False))
+                     for key, place_key, place in places])
+            self._db.execute('INSERT INTO map_nodes (key) VALUES (?)', (key,))
+
+    def finish(self, json_data):
+        """
+        Save the rest of the map json (header and map data, without tile
+        areas, towns and waypoints) and build indexes.
+        """
+        self._flush()
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             ('json', json.dumps(json_data, ensure_ascii=False)))
+            for statement in self._INDEXES:
+                self._db.execute(statement)
+        self._db.execute('ANALYZE')
+        return self
+
+    @property
+    def json_data(self):
+        """
+        Map json without tile areas, towns and waypoints.
+        """
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'json'").fetchone()
+        return json.loads(row[0]) if row else dict()
+
+    @property
+    def header(self):
+        return {key: value for key, value in self.json_data.items() if key != 'MAP'}
+
+    @property
+    def tile_count(self):
+        return self._db.execute('SELECT count(*) FROM tiles').fetchone()[0]
+
+    @property
+    def item_count(self):
+        return self._db.execute('SELECT count(*) FROM items').fetchone()[0]
+
+    def _iter_tiles(self, where, params, record):
+        """
+        Yield (tile key, tile dict with items) of tiles matching where,
+        ordered by id. With record, tiles are ndjson records.
+        """
+        tiles = self._db.execute(f'SELECT tiles.id, key, x, y, z, data FROM tiles '
+                                 f'WHERE {where} ORDER BY tiles.id', params)
+        items = self._db.execute(f'SELECT items.id, items.tile, items.parent, items.key, '
+                                 f'items.data FROM items JOIN tiles ON items.tile = tiles.id '
+                                 f'WHERE {where} ORDER BY items.id', params)
+        item = next(items, None)
+        for tile_id, key, x, y, z, data in tiles:
+            tile = json.loads(data)
+            if record:
+                tile = {'X': x, 'Y': y, 'Z': z,
+                        **{k: v for k, v in tile.items() if k not in ('X', 'Y')}}
+            nodes = dict()    # Item id -> item dict
+            while item is not None and item[1] == tile_id:
+                item_id, _, parent, item_key, item_data = item
+                nodes[item_id] = json.loads(item_data)
+                (tile if parent is None else nodes[parent])[item_key] = nodes[item_id]
+                item = next(items, None)
+            yield key, tile
+
+    def tiles(self, x0, y0, x1, y1, z):
+        """
+        Tiles inside the given region (inclusive limits) of floor z.
+        """
+        for _, tile in self._iter_tiles('tiles.z = ? AND tiles.x BETWEEN ? AND ? '
+                                        'AND tiles.y BETWEEN ? AND ?',
+                                        (z, x0, x1, y0, y1), True):
+            yield tile
+
+    def house_tiles(self, house_id):
+        """
+        House tiles of a house.
+        """
+        for _, tile in self._iter_tiles('tiles.house_id = ?', (house_id,), True):
+            yield tile
+
+    def find_items(self, item_id):
+        """
+        Yield ((x, y, z), item dict) of items with the given id. Item dicts
+        do not include items inside them.
+        """
+        for x, y, z, data in self._db.execute(
+                'SELECT tiles.x, tiles.y, tiles.z, items.data FROM items '
+                'JOIN tiles ON items.tile = tiles.id WHERE items.item_id = ? '
+                'ORDER BY items.id', (item_id,)):
+            yield (x, y, z), json.loads(data)
+
+    def towns(self):
+        return [json.loads(data) for data, in
+                self._db.execute('SELECT data FROM towns ORDER BY id')]
+
+    def waypoints(self):
+        return [json.loads(data) for data, in
+                self._db.execute('SELECT data FROM waypoints ORDER BY id')]
+
+    def _get_map_node(self, key):
+        """
+        Json dict of a map node (tile area, towns or waypoints).
+        """
+        if key.startswith('TILE_AREA_'):
+            area_id, x, y, z, first, last = self._db.execute(
+                'SELECT id, x, y, z, first_tile, last_tile FROM areas WHERE key = ?',
+                (key,)).fetchone()
+            node = {'X': x, 'Y': y, 'Z': z}
+            node.update(self._iter_tiles('tiles.id BETWEEN ? AND ?', (first, last), False))
+            return node
+        table = 'towns' if key == 'TOWNS' else 'waypoints'
+        return {place_key: json.loads(data) for place_key, data in self._db.execute(
+                    f'SELECT key, data FROM {table} WHERE list = ? ORDER BY id', (key,))}
+
+    def to_json(self, file_path, compact=False):
+        """
+        Write the map json (the same Otbm2Json.generate_json writes) to a
+        file, compressed if it has a .gz, .xz or .bz2 suffix. Map nodes are
+        read and written one at a time.
+        """
+        root = self.json_data
+        map_node = root.setdefault('MAP', dict())
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with compressed_io.open_file(file_path, 'w', encoding='utf-8') as f:
+            writer = JsonStreamWriter(f, compact)
+            for key, in self._db.execute('SELECT key FROM map_nodes ORDER BY seq'):
+                map_node[key] = self._get_map_node(key)
+                writer.write_node([root, map_node], key)
+            writer.close(root)
@@ -0,0 +1,122 @@
+import xml.etree.ElementTree as ET
+
+from collections import Counter, defaultdict
+
+
+class MapXml:
+    """
+    House and spawn xml files of a map.
+
+    Files are read with a streaming parser, each house or spawn element is
+    cleared once read so memory use only depends on the data kept: houses
+    by id and spawns by center position (bucketed in a grid of AREA_SIZE
+    cells for region queries).
+
+    House tiles of the map are joined to houses by house id, see
+    add_house_tile (Otbm2Json calls it for each decoded HOUSE_TILE).
+    """
+    AREA_SIZE = 256    # Spawn grid cell size, in tiles
+
+    HOUSE_ATTRIBUTES = (('name', 'NAME', str),
+                        ('entryx', 'ENTRY_X', int),
+                        ('entryy', 'ENTRY_Y', int),
+                        ('entryz', 'ENTRY_Z', int),
+                        ('rent', 'RENT', int),
+                        ('townid', 'TOWN_ID', int),
+                        ('size', 'SIZE', int))
+    CREATURE_ATTRIBUTES = (('name', 'NAME', str),
+                           ('x', 'X', int),
+                           ('y', 'Y', int),
+                           ('z', 'Z', int),
+                           ('spawntime', 'SPAWN_TIME', int),
+                           ('direction', 'DIRECTION', int))
+
+    def __init__(self):
+        self.houses = dict()           # House id -> house data
+        self.spawns = dict()           # Center (x, y, z) -> spawn data
+        self.house_tiles = Counter()   # House id -> number of house tiles
+        self._grid = defaultdict(list)    # (cell x, cell y, z) -> spawn centers
+
+    @staticmethod
+    def _get_attributes(element, attributes):
+        data = dict()
+        for name, key, kind in attributes:
+            value = element.get(name)
+            if value is not None:
+                try:
+                    data[key] = kind(value)
+                except ValueError:
+                    data[key] = value
+        return data
+
+    @staticmethod
+    def _iter_elements(file_path, tag):
+        """
+        Yield each tag element of an xml file once it is read, then clear it.
+        """
+        root = None
+        for event, element in ET.iterparse(file_path, events=('start', 'end')):
+            if root is None:
+                root = element
+            elif event == 'end' and element.tag == tag:
+                yield element
+                root.clear()    # Free read elements
+
+    def load_houses(self, file_path):
+        """
+        Read houses from a house xml file. Returns the number of houses.
+        """
+        count = 0
+        for element in self._iter_elements(file_path, 'house'):
+            house = self._get_attributes(element, self.HOUSE_ATTRIBUTES)
+            house_id = int(element.get('houseid', 0))
+            self.houses[house_id] = house
+            count += 1
+        return count
+
+    def load_spawns(self, file_path):
+        """
+        Read spawns from a spawn xml file. Returns the number of spawns.
+        """
+        count = 0
+        for element in self._iter_elements(file_path, 'spawn'):
+            center = (int(element.get('centerx', 0)), int(element.get('centery', 0)),
+                      int(element.get('centerz', 0)))
+            spawn = dict(RADIUS=int(element.get('radius', 0)), MONSTERS=list(),
+                         NPCS=list())
+            for creature in element:
+                if creature.tag in ('monster', 'npc'):
+                    spawn[f'{creature.tag.upper()}S'].append(
+                        self._get_attributes(creature, self.CREATURE_ATTRIBUTES))
+            if center not in self.spawns:
+                self._grid[(center[0] // self.AREA_SIZE, center[1] // self.AREA_SIZE,
+                            center[2])].append(center)
+            self.spawns[center] = spawn
+            count += 1
+        return count
+
+    def add_house_tile(self, house_id):
+        self.house_tiles[house_id] += 1
+
+    def house_sizes(self):
+        """
+        Number of house tiles (sqm) of each house, houses of the house file
+        without tiles in the map have 0.
+        """
+        sizes = dict.fromkeys(self.houses, 0)
+        sizes.update(self.house_tiles)
+        return sizes
+
+    def query_spawns(self, x0, y0, x1, y1, z):
+        """
+        Spawns with center inside the given region (inclusive limits) of
+        floor z, as a center -> spawn data dict.
+        """
+        size = self.AREA_SIZE
+        found = dict()
+        for cell_x in range(x0 // size, x1 // size + 1):
+            for cell_y in range(y0 // size, y1 // size + 1):
+                for center in self._grid.get((cell_x, cell_y, z), ()):
+                    if x0 <= center[0] <= x1 and y0 <= center[1] <= y1:
+                        found[center] = self.spawns[center]
+        return found
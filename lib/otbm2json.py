@@ -1,11 +1,35 @@
+import ijson
+import io
 import json
 import os
+import shutil
+import tempfile
+import time
 import traceback
+import xml.etree.ElementTree as ET
 
-from collections import defaultdict
-from functools import partial
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from lib import compressed_io
+from lib import otbm_attributes
+from lib.json_stream import JsonStreamWriter, RawJson
+from lib.map_store import MapStore
+from lib.map_xml import MapXml
+from lib.otbm_index import OtbmIndex
+from lib.otbm_scanner import OtbmScanner
+from lib.parse_stats import ParseStats
+
+
+NodeEvent = namedtuple('NodeEvent', [
+    'node_type',     # MAP, TILE_AREA, TILE, HOUSE_TILE, ITEM, TOWNS, TOWN...
+    'key',           # Json key (TILE_AREA_1, TILE_5, ITEM_2...)
+    'depth',         # Root node children have depth 1
+    'attributes',    # Decoded node data
+    'position',      # Absolute (x, y, z) or None, items have their tile's
+])
+
 
 class Otbm2Json:
     """
@@ -18,11 +42,31 @@ class Otbm2Json:
     ITEMS_MAJOR_VERSION = 4
     ITEMS_MINOR_VERSION = 4
 
+    # Smaller maps are always decoded sequentially, see workers
+    PARALLEL_MIN_SIZE = 1 << 20    # Bytes
+
+    _ATTRIBUTES = otbm_attributes.BY_CODE
+    _STRING_LENGTH = otbm_attributes.STRING_LENGTH
+
     def __init__(self):
         self._otbm_file_path = None    # Input file
         self._json_file_path = None    # Output file
+        self._index = None             # Input file tile area index
+        self._index_cache = True       # Keep index in a sidecar file
+        self._workers = 1              # Processes decoding tile areas
+        self._stats = None             # ParseStats, None if disabled
+        self._load_xml = False         # Read map's house and spawn files
+        self._map_xml = None           # MapXml of last processed map
+        self._items = None             # ItemTypes of the map's items.otb
+        self._map_version = None       # Root node map version, once read
+        self._malformed_nodes = 0      # Nodes whose data could not be read
         self._json_data = defaultdict(list)
-        self._node_list = list()
+        self._node_stack = list()    # (node type, key, node dict) of open nodes
+        self._json_writer = None     # Set while streaming json output
+        self._map_model = None       # Set while generating a map model
+        self._map_store = None       # Set while generating a map store
+        self._tile_file = None       # Set while writing ndjson output
+        self._tile_records = 0       # Records written to ndjson output
 
         # Json keys counter
         self._tile_area_cnt = 0
@@ -40,10 +84,118 @@ class Otbm2Json:
 
     @otbm_file_path.setter
     def otbm_file_path(self, value):
+        """
+        Input otbm file, it can be compressed (.otbm.gz, .otbm.xz or
+        .otbm.bz2, see lib.compressed_io).
+        """
         new_path = Path(value)
         assert new_path.is_file(), "File not found!"
-        assert new_path.suffix == ".otbm", "Wrong file format!"
+        assert compressed_io.base_suffix(new_path) == ".otbm", "Wrong file format!"
         self._otbm_file_path = new_path
+        self._index = None
+
+    @property
+    def index_cache(self):
+        return self._index_cache
+
+    @index_cache.setter
+    def index_cache(self, value):
+        self._index_cache = bool(value)
+
+    @property
+    def load_xml(self):
+        return self._load_xml
+
+    @load_xml.setter
+    def load_xml(self, value):
+        """
+        Read the house and spawn xml files of the map (HOUSE_FILE and
+        SPAWN_FILE, next to the otbm file) while it is processed, see
+        map_xml.
+        """
+        self._load_xml = bool(value)
+
+    @property
+    def map_xml(self):
+        """
+        MapXml with houses (joined to the map's house tiles) and spawns of
+        the last processed map, None if load_xml is False.
+        """
+        return self._map_xml
+
+    @property
+    def items(self):
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        """
+        ItemTypes (see lib.item_types) of the map's items.otb, None if
+        unknown. OTBM version 1 maps store the count or fluid type of some
+        items right after their id, they can only be decoded with it
+        (SUBTYPE key).
+        """
+        self._items = value
+        self._index = None    # Descriptions of version 1 maps depend on it
+
+    @property
+    def malformed_nodes(self):
+        """
+        Number of nodes whose data could not be read (their error is
+        printed and the node is kept with the data read before it).
+        """
+        return self._malformed_nodes
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, value):
+        """
+        Number of processes used to decode tile areas, None or 0 to use one
+        per CPU. At most one per CPU is used, and maps smaller than
+        PARALLEL_MIN_SIZE are decoded sequentially: workers send decoded
+        areas back pickled, which costs about a third of the sequential
+        decoding time in this process (see benchmarks/README.md).
+        """
+        if not value:
+            value = os.cpu_count() or 1
+        assert value >= 1, "Wrong number of workers!"
+        self._workers = int(value)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        """
+        ParseStats instance to collect parsing statistics, None to disable.
+        """
+        assert value is None or isinstance(value, ParseStats), "Wrong stats!"
+        self._stats = value
+
+    @property
+    def index(self):
+        """
+        Tile area index (see lib.otbm_index) of the otbm file.
+
+        On first use it is loaded from the map's .otbmidx sidecar file if
+        that is up to date, otherwise it is built with a structural pass
+        over the file and saved (unless index_cache is False).
+        """
+        if self._index is None:
+            self._index = OtbmIndex.open(self.otbm_file_path, self._index_cache,
+                                         self._items)
+        return self._index
+
+    @property
+    def header(self):
+        """
+        Identifier and map header fields of the otbm file, from its index.
+        """
+        return dict(self.index.header)
 
     @property
     def json_file_path(self):
@@ -51,435 +203,958 @@ class Otbm2Json:
 
     @json_file_path.setter
     def json_file_path(self, value):
+        """
+        Output json file, created (with its directory) if it does not exist.
+        It is compressed if it has a compression suffix (.json.gz...).
+        """
         new_path = Path(value)
-        assert new_path.is_file(), "File not found!"
-        assert new_path.suffix == ".json", "Wrong file format!"
+        assert compressed_io.base_suffix(new_path) == ".json", "Wrong file format!"
         self._json_file_path = new_path
 
-    def _merge_nodes(self, a_node, b_node):
+    def _get_identifier(self, scanner):
         """
-        Merge second node into the first one (dict).
-        Taken from https://stackoverflow.com/questions/7204805/how-to-merge-dictionaries-of-dictionaries
+        Read identifier bytes and add them to json data.
+        """
+        self._json_data['identifier'] = scanner.identifier
+
+    def _get_otbm_header(self, byte_data):
+        """"
+        Read root node header bytes and add them to json data.
+        """
+        offset = 0
+        for key, size in (('map_version', self.MAP_VERSION),
+                          ('map_width', self.MAP_WIDTH),
+                          ('map_height', self.MAP_HEIGHT),
+                          ('items_major_version', self.ITEMS_MAJOR_VERSION),
+                          ('items_minor_version', self.ITEMS_MINOR_VERSION)):
+            self._json_data[key] = int.from_bytes(
+                                     byte_data[offset:offset+size],
+                                     "little"
+                                   )
+            offset += size
+        self._map_version = self._json_data['map_version']
+
+    def _get_map_version(self, scanner):
+        """
+        Read map version from the scanner's root node if it is not known yet
+        (only needed to decode items of OTBM version 1 maps, see items).
+        """
+        if self._map_version is None and self._items is not None:
+            self._map_version = scanner.parse_header(
+                scanner.read_payload(OtbmScanner.IDENTIFIER))['map_version']
+
+    def _new_parser(self):
+        """
+        Parser for a part of the same map, sharing its item types.
+        """
+        parser = type(self)()
+        parser._items = self._items
+        parser._map_version = self._map_version
+        return parser
+
+    def _get_node_properties(self, node, byte_data, offset=0):
+        """
+        Add properties (OTBM attributes from offset to the end of byte_data)
+        to node.
+
+        Each attribute is read with the struct layout of its code, see
+        lib/otbm_attributes.py.
+        """
+        end = len(byte_data)
+        while offset < end:
+            code = byte_data[offset]
+            attribute = self._ATTRIBUTES.get(code)
+            if attribute is None:
+                raise ValueError(f"Unknown attribute 0x{code:02x} at byte {offset}")
+            offset += 1
+            layout = attribute.layout
+            if layout is None:    # String
+                lenght, = self._STRING_LENGTH.unpack_from(byte_data, offset)
+                offset += 2
+                if offset + lenght > end:
+                    raise ValueError(f"{attribute.keys[0]} out of node data")
+                values = (str(byte_data[offset:offset+lenght], 'ascii'),)
+                offset += lenght
+            else:
+                values = layout.unpack_from(byte_data, offset)
+                offset += layout.size
+
+            if code == otbm_attributes.DESCRIPTION:
+                self._description_cnt += 1
+                node[f'DESCRIPTION_{self._description_cnt}'] = values[0]
+            elif code == otbm_attributes.TILE_FLAGS:
+                flag = values[0]
+                for key, bit in otbm_attributes.FLAGS:
+                    node[key] = int(bool(flag & bit))
+                if flag & ~otbm_attributes.KNOWN_FLAGS:
+                    node[otbm_attributes.OTHER_FLAGS] = flag & ~otbm_attributes.KNOWN_FLAGS
+            else:
+                node.update(zip(attribute.keys, values))
+
+    def _get_node_data(self, node_type, node, byte_data):
+        """
+        Add data to node. TODO: Change method's name
         """
         try:
-            for k, v in a_node.items():
-                if k in b_node:
-                    b_node[k] = self._merge_nodes(v, b_node[k])
-            a_node.update(b_node)
-        except:
-            pass
-        return a_node
-
-    def _add_data(self, node_list, data):
-        """
-        Add data to nested json dict.
-
-        Example:
-            Input:
-                node_list = ["MAP", "TILE_AREA", "TILE"]
-                data = "0xda12"
-            Output:
-                res = {"Map":
-                          "TILE_AREA":
-                              "TILE": "0xda12"}
-
-        """
-        if len(node_list) > 0:
-            return {node_list[0] : self._add_data(node_list[1:], data)}
-        else:
-            return data
+            if node_type == "MAP":
+                self._get_node_properties(node, byte_data)
+            elif node_type == "TILE_AREA":
+                node['X'] = int.from_bytes(byte_data[:2], "little")
+                node['Y'] = int.from_bytes(byte_data[2:4], "little")
+                node['Z'] = int.from_bytes(byte_data[4:5], "little")
+            elif node_type == "TILE":
+                # Position is relative to parent area node's
+                node['X'] = int.from_bytes(byte_data[:1], "little")
+                node['Y'] = int.from_bytes(byte_data[1:2], "little")
+                self._get_node_properties(node, byte_data, 2)
+            elif node_type == "ITEM":
+                item_id = int.from_bytes(byte_data[:2], "little")
+                node['IDENTIFIER'] = item_id
+                if self._map_version == 0 and self._items is not None \
+                        and self._items.has_subtype(item_id):
+                    node['SUBTYPE'] = byte_data[2]
+                    self._get_node_properties(node, byte_data, 3)
+                else:
+                    self._get_node_properties(node, byte_data, 2)
+            elif node_type == "TOWNS":
+                pass    # Nothing to do here
+            elif node_type == "TOWN":
+                node['ID'] = int.from_bytes(byte_data[:4], "little")
+                lenght = int.from_bytes(byte_data[4:6], "little")
+                node['NAME'] = str(byte_data[6:6+lenght], 'ascii')
+                node['X'] = int.from_bytes(byte_data[6+lenght:6+lenght+2], "little")
+                node['Y'] = int.from_bytes(byte_data[6+lenght+2:6+lenght+4], "little")
+                node['Z'] = int.from_bytes(byte_data[6+lenght+4:6+lenght+5], "little")
+            elif node_type == "HOUSE_TILE":
+                node['X'] = int.from_bytes(byte_data[:1], "little")
+                node['Y'] = int.from_bytes(byte_data[1:2], "little")
+                node['HOUSE_ID'] = int.from_bytes(byte_data[2:6], "little")
+                self._get_node_properties(node, byte_data, 6)
+            elif node_type == "WAYPOINTS":
+                pass    # Nothing to do here
+            elif node_type == "WAYPOINT":
+                lenght = int.from_bytes(byte_data[:2], "little")
+                node['NAME'] = str(byte_data[2:2+lenght], 'ascii')
+                node['X'] = int.from_bytes(byte_data[2+lenght:2+lenght+2], "little")
+                node['Y'] = int.from_bytes(byte_data[2+lenght+2:2+lenght+4], "little")
+                node['Z'] = int.from_bytes(byte_data[2+lenght+4:2+lenght+5], "little")
+        except Exception as e:
+            print(traceback.format_exc())
+            self._malformed_nodes += 1
+            if self._stats is not None:
+                self._stats.add_malformed(f"{node_type}: {e!r}")
 
-    def _get_identifier(self, iterator):
+    def _open_node(self, node_type, key):
         """
-        Iterate over identifier bytes and add them to json data.
+        Add a new empty node to the current one and make it the current node.
         """
-        identifier = bytes()
-        for _ in range(self.IDENTIFIER):
-            identifier += next(iterator)
-        self._json_data['identifier'] = int.from_bytes(identifier, "little")
+        parent = self._node_stack[-1][2] if self._node_stack else self._json_data
+        node = dict()
+        parent[key] = node
+        self._node_stack.append((node_type, key, node))
+        return node, parent
 
-    def _get_otbm_header(self, iterator):
-        """"
-        Iterate over header bytes and add them to json data.
-        """
-        map_version = bytes()
-        map_width = bytes()
-        map_height = bytes()
-        items_major_version = bytes()
-        items_minor_version = bytes()
-
-        next(iterator)  # Skip first 0xFE node (0xFE00)
-        next(iterator)  # Skip first 0x00 node (0xFE00)
-
-        for _ in range(self.MAP_VERSION):
-            map_version += next(iterator)
-        self._json_data['map_version'] = int.from_bytes(map_version, "little")
-
-        for _ in range(self.MAP_WIDTH):
-            map_width += next(iterator)
-        self._json_data['map_width'] = int.from_bytes(map_width, "little")
-
-        for _ in range(self.MAP_WIDTH):
-            map_height += next(iterator)
-        self._json_data['map_height'] = int.from_bytes(map_height, "little")
-
-        for _ in range(self.ITEMS_MAJOR_VERSION):
-            items_major_version += next(iterator)
-        self._json_data['items_major_version'] = int.from_bytes(
-                                                  items_major_version,
-                                                  "little"
-                                                )
-
-        for _ in range(self.ITEMS_MINOR_VERSION):
-            items_minor_version += next(iterator)
-        self._json_data['items_minor_version'] = int.from_bytes(
-                                                  items_minor_version,
-                                                  "little"
-                                                )
-
-    def _get_node_properties(self, node_list, byte_data):
-        """
-        Add properties to node.
-        """
-        description = b'\x01'       # N bytes
-        ext_file = b'\x02'          # Apparently not used
-        tile_flags = b'\x03'        # 4 bytes
-        action_id = b'\x04'         # 2 bytes
-        unique_id = b'\x05'         # 2 bytes
-        text = b'\x06'              # N bytes
-        teleport_dest = b'\x08'     # 2, 2, 1 bytes (x, y, z)
-        identifier = b'\x09'        # 2 bytes
-        depot_id = b'\x0a'          # 2 bytes
-        ext_spawn_file = b'\x0b'    # N bytes
-        ext_house_file = b'\x0d'    # N bytes
-        housedoorid = b'\x0e'       # 1 byte
-        count = b'\x0f'             # 1 byte
-        rune_charges = b'\x16'      # 2 bytes
-
-        if not byte_data:
+    def _close_tile_area(self, key):
+        """
+        Write finished tile area to json output and free it.
+        """
+        path = [self._json_data] + [node for _, _, node in self._node_stack]
+        self._json_writer.write_node(path, key)
+
+    def _write_tile_record(self, area, tile):
+        """
+        Write tile as a ndjson record with absolute position.
+        """
+        record = {'X': area.get('X', 0) + tile.get('X', 0),
+                  'Y': area.get('Y', 0) + tile.get('Y', 0),
+                  'Z': area.get('Z', 0)}
+        for key, value in tile.items():
+            if key not in record:
+                record[key] = value
+        self._tile_file.write(json.dumps(record, ensure_ascii=False,
+                                         separators=(',', ':')))
+        self._tile_file.write('\n')
+        self._tile_records += 1
+
+    def _close_tile_record(self, node_type, key):
+        """
+        Write finished tile to ndjson output and free it (and finished tile
+        areas).
+        """
+        if node_type not in ('TILE', 'HOUSE_TILE', 'TILE_AREA'):
             return
+        parent = self._node_stack[-1][2]
+        if node_type != 'TILE_AREA':
+            self._write_tile_record(parent, parent[key])
+        del parent[key]
 
-        node = None
-        property_type = byte_data[:1]
-        if property_type == description:
-            self._description_cnt += 1
-            node_list.append(f'DESCRIPTION_{self._description_cnt}')
-            lenght = int.from_bytes(byte_data[1:3], "little")
-            node = self._add_data(node_list, str(byte_data[3:lenght+3].decode('ascii')))
-            self._merge_nodes(self._json_data, node)
-            # Get Spawn and House files
-            node_list.pop()
-            self._get_node_properties(node_list, byte_data[lenght+3:])
-        elif property_type == ext_file:
-            node_list.append('EXT_FILE')
-            lenght = int.from_bytes(byte_data[1:3], "little")
-            node = self._add_data(node_list, str(byte_data[3:lenght+3].decode('ascii')))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == tile_flags:
-            flag = int.from_bytes(byte_data[1:2], "little")
-            protection_zone = int((flag & int.from_bytes(b'\x01\x00\x00\x00', "little")) / 1)
-            no_pvp = int((flag & int.from_bytes(b'\x04\x00\x00\x00', "little")) / 4)
-            no_logout = int((flag & int.from_bytes(b'\x08\x00\x00\x00', "little")) / 8)
-            pvp_zone = int((flag & int.from_bytes(b'\x10\x00\x00\x00', "little")) / 10)
-            node_list.append('PROTECTION_ZONE')
-            node = self._add_data(node_list, protection_zone)
-            self._merge_nodes(self._json_data, node)
-            node_list.pop()
-            node_list.append('NO_PVP')
-            node = self._add_data(node_list, no_pvp)
-            self._merge_nodes(self._json_data, node)
-            node_list.pop()
-            node_list.append('NO_LOGOUT')
-            node = self._add_data(node_list, no_logout)
-            self._merge_nodes(self._json_data, node)
-            node_list.pop()
-            node_list.append('PVP_ZONE')
-            node = self._add_data(node_list, pvp_zone)
-            self._merge_nodes(self._json_data, node)
-        elif property_type == action_id:
-            node_list.pop()
-            node_list.append('ACTION_ID')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:3], "little"))
-            self._merge_nodes(self._json_data, node)
-            self._get_node_properties(node_list, byte_data[3:])
-        elif property_type == unique_id:
-            node_list.pop()
-            node_list.append('UNIQUE_ID')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:3], "little"))
-            self._merge_nodes(self._json_data, node)
-            self._get_node_properties(node_list, byte_data[3:])
-        elif property_type == text:
-            node_list.pop()
-            node_list.append('TEXT')
-            lenght = int.from_bytes(byte_data[1:3], "little")
-            node = self._add_data(node_list, str(byte_data[3:lenght+3].decode('ascii')))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == teleport_dest:
-            node_list.append('DESTINATION_X')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:3],"little"))
-            self._merge_nodes(self._json_data, node)
-            node_list.pop()
-            node_list.append('DESTINATION_Y')
-            node = self._add_data(node_list, int.from_bytes(byte_data[3:5],"little"))
-            self._merge_nodes(self._json_data, node)
-            node_list.pop()
-            node_list.append('DESTINATION_Z')
-            node = self._add_data(node_list, int.from_bytes(
-                                                      byte_data[5:6],
-                                                      "little"
-                                                    ))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == identifier:
-            node_list.append('IDENTIFIER')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:], "little"))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == depot_id:
-            node_list.append('DEPOT_ID')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:3],"little"))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == ext_spawn_file:
-            node_list.append('SPAWN_FILE')
-            lenght = int.from_bytes(byte_data[1:3], "little")
-            node = self._add_data(node_list, str(byte_data[3:lenght+3].decode('ascii')))
-            self._merge_nodes(self._json_data, node)
-            # Get house file
-            node_list.pop()
-            self._get_node_properties(node_list, byte_data[lenght+3:])
-        elif property_type == ext_house_file:
-            node_list.append('HOUSE_FILE')
-            lenght = int.from_bytes(byte_data[1:3], "little")
-            node = self._add_data(node_list, str(byte_data[3:lenght+3].decode('ascii')))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == housedoorid:
-            node_list.append('HOUSE_DOOR_ID')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:2], "little"))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == count:
-            node_list.append('COUNT')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:2], "little"))
-            self._merge_nodes(self._json_data, node)
-        elif property_type == rune_charges:
-            node_list.pop()
-            node_list.append('RUNE_CHARGES')
-            node = self._add_data(node_list, int.from_bytes(byte_data[1:3], "little"))
-            self._merge_nodes(self._json_data, node)
-
-
-    def _get_node_data(self, byte_data):
+    def _close_model_node(self, node_type, key, node):
         """
-        Add data to node. TODO: Change method's name
+        Add finished tile or tile area to map model and free it.
         """
-        if self._node_list:
-            # Remove node number
-            if len(self._node_list) > 1:
-                node_type = "_".join(self._node_list[-1].split("_")[:-1])
-            else:
-                node_type = "MAP"
-            tmp_node_list = self._node_list.copy()
-            try:
-                if node_type == "MAP":
-                    self._get_node_properties(tmp_node_list, byte_data)
-                elif node_type == "TILE_AREA":
-                    tmp_node_list.append('X')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[:2],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Y')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[2:4],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Z')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[4:],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    self._get_node_properties(tmp_node_list, byte_data[4:])
-                elif node_type == "TILE":
-                    # Position is relative to parent area node's
-                    tmp_node_list = self._node_list.copy()
-                    tmp_node_list.append('X')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[:1],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    
-                    tmp_node_list.append('Y')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[1:2],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    self._get_node_properties(tmp_node_list, byte_data[2:])
-                elif node_type == "ITEM":
-                    tmp_node_list.append('IDENTIFIER')
-                    node = self._add_data(tmp_node_list, int.from_bytes(
-                                                              byte_data[:2],
-                                                              "little"
-                                                            ))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    self._get_node_properties(tmp_node_list, byte_data[2:])
-
-                elif node_type == "TOWNS":
-                    pass    # Nothing to do here
-                elif node_type == "TOWN":
-                    tmp_node_list.append('ID')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[:2], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('NAME')
-                    lenght = int.from_bytes(byte_data[4:6], "little")
-                    node = self._add_data(tmp_node_list, str(byte_data[6:6+lenght].decode('ascii')))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('X')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[6+lenght:6+lenght+2], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Y')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[6+lenght+2:6+lenght+4], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Z')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[6+lenght+4:6+lenght+5], "little"))
-                    self._merge_nodes(self._json_data, node)
-                elif node_type == "HOUSE_TILE":
-                    tmp_node_list.append('X')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[:1], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Y')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[1:2], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('HOUSE_ID')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[2:6], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    self._get_node_properties(tmp_node_list, byte_data[6:])
-                elif node_type == "WAYPOINTS":
-                    pass    # Nothing to do here
-                elif node_type == "WAYPOINT":
-                    tmp_node_list.append('NAME')
-                    lenght = int.from_bytes(byte_data[:2], "little")
-                    node = self._add_data(tmp_node_list, str(byte_data[2:2+lenght].decode('ascii')))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('X')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[2+lenght:2+lenght+2], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Y')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[2+lenght+2:2+lenght+4], "little"))
-                    self._merge_nodes(self._json_data, node)
-                    tmp_node_list.pop()
-                    tmp_node_list.append('Z')
-                    node = self._add_data(tmp_node_list, int.from_bytes(byte_data[2+lenght+4:2+lenght+5], "little"))
-                    self._merge_nodes(self._json_data, node)
-                del tmp_node_list
-            except Exception as e:
-                print(traceback.format_exc())
+        if node_type not in ('TILE', 'HOUSE_TILE', 'TILE_AREA'):
+            return
+        parent = self._node_stack[-1][2]
+        if node_type == 'TILE_AREA':
+            self._map_model.add_area(node)
         else:
-            pass
+            self._map_model.add_tile(parent, node, node_type == 'HOUSE_TILE')
+        del parent[key]
 
+    def _start_map_xml(self):
+        self._map_xml = MapXml() if self._load_xml else None
 
-    def _get_next_node(self, iterator):
+    def _add_map_xml_node(self, node_type, node):
         """
-        Iterate over bytes until next node (0xFE) and get its type (+1 byte).
+        Read map's xml files (MAP node) or join house tiles to houses.
         """
-        node_init = b'\xfe'
-        node_end = b'\xff'
-        map_data = b'\x02'
-        tile_area = b'\x04'
-        tile = b'\x05'
-        item = b'\x06'
-        towns = b'\x0c'
-        town = b'\x0d'
-        house_tile = b'\x0e'
-        waypoints = b'\x0f'
-        waypoint = b'\x10'
+        if node_type == 'HOUSE_TILE':
+            self._map_xml.add_house_tile(node.get('HOUSE_ID', 0))
+        elif node_type == 'MAP':
+            directory = Path(self.otbm_file_path).parent
+            for key, load in (('HOUSE_FILE', self._map_xml.load_houses),
+                              ('SPAWN_FILE', self._map_xml.load_spawns)):
+                if not node.get(key):
+                    continue
+                try:
+                    load(directory / node[key])
+                except (OSError, ET.ParseError) as e:
+                    print(f"{node[key]} not loaded: {e}")
 
-        try:
-            byte_data = bytes()
-            while True:
-                byte = next(iterator)
-                if byte == node_init:
-                    if byte_data:
-                        self._get_node_data(byte_data)
-                    if self._node_list:
-                        byte_data = bytes()
-                    node_type = next(iterator)
-                    if node_type == map_data: 
-                        self._node_list.append('MAP')
-                    elif node_type == tile_area:
-                        self._tile_area_cnt += 1
-                        self._node_list.append(f'TILE_AREA_{self._tile_area_cnt}')
-                    elif node_type == tile:
-                        self._tile_cnt += 1
-                        self._node_list.append(f'TILE_{self._tile_cnt}')
-                        self._item_cnt = 0
-                    elif node_type == item:
-                        self._item_cnt += 1
-                        self._node_list.append(f'ITEM_{self._item_cnt}')
-                    elif node_type == towns:
-                        self._node_list.append('TOWNS')
-                    elif node_type == town:
-                        self._town_cnt += 1
-                        self._node_list.append(f'TOWN_{self._town_cnt}')
-                    elif node_type == house_tile:
-                        self._house_tile_cnt += 1
-                        self._node_list.append(f'HOUSE_TILE_{self._house_tile_cnt}')
-                        self._item_cnt = 0
-                    elif node_type == waypoints:
-                        self._waypoints_cnt += 1
-                        self._node_list.append(f'WAYPOINTS_{self._waypoints_cnt}')
-                    elif node_type == waypoint:
-                        self._waypoint_cnt += 1
-                        self._node_list.append(f'WAYPOINT_{self._waypoint_cnt}')
-                    else:
-                        pass  # TODO: Process byte (?)
-                elif byte == node_end:
-                    if self._node_list:
-                        if byte_data != b'':
-                            node = self._add_data(list(self._node_list), str(byte_data))
-                            self._get_node_data(byte_data)
-                            byte_data = bytes()
-                        else:
-                            node = self._add_data(list(self._node_list), {})
-                        key = list(node.keys())[0]
-                        self._merge_nodes(self._json_data, node)
-                        self._node_list.pop()   # Pop current node
+    def _get_node_key(self, node_type):
+        """
+        Get node type name and json key of a node type byte, updating json
+        keys counters. Returns (None, None) for unknown node types.
+        """
+        map_data = 0x02
+        tile_area = 0x04
+        tile = 0x05
+        item = 0x06
+        towns = 0x0c
+        town = 0x0d
+        house_tile = 0x0e
+        waypoints = 0x0f
+        waypoint = 0x10
+
+        if node_type == map_data:
+            return 'MAP', 'MAP'
+        elif node_type == tile_area:
+            self._tile_area_cnt += 1
+            return 'TILE_AREA', f'TILE_AREA_{self._tile_area_cnt}'
+        elif node_type == tile:
+            self._tile_cnt += 1
+            self._item_cnt = 0
+            return 'TILE', f'TILE_{self._tile_cnt}'
+        elif node_type == item:
+            self._item_cnt += 1
+            return 'ITEM', f'ITEM_{self._item_cnt}'
+        elif node_type == towns:
+            return 'TOWNS', 'TOWNS'
+        elif node_type == town:
+            self._town_cnt += 1
+            return 'TOWN', f'TOWN_{self._town_cnt}'
+        elif node_type == house_tile:
+            self._house_tile_cnt += 1
+            self._item_cnt = 0
+            return 'HOUSE_TILE', f'HOUSE_TILE_{self._house_tile_cnt}'
+        elif node_type == waypoints:
+            self._waypoints_cnt += 1
+            return 'WAYPOINTS', f'WAYPOINTS_{self._waypoints_cnt}'
+        elif node_type == waypoint:
+            self._waypoint_cnt += 1
+            return 'WAYPOINT', f'WAYPOINT_{self._waypoint_cnt}'
+        return None, None    # TODO: Process unknown node types (?)
+
+    def _close_store_node(self, node_type, key, node):
+        """
+        Add finished tile, tile area, towns or waypoints to map store and
+        free it.
+        """
+        if node_type not in ('TILE', 'HOUSE_TILE', 'TILE_AREA', 'TOWNS', 'WAYPOINTS'):
+            return
+        parent_key, parent = self._node_stack[-1][1:]
+        if node_type == 'TILE_AREA':
+            self._map_store.add_area(key, node)
+        elif node_type in ('TOWNS', 'WAYPOINTS'):
+            self._map_store.add_list(key, node)
+        else:
+            self._map_store.add_tile(parent_key, parent, key, node)
+        del parent[key]
+
+    def _get_next_node(self, nodes):
+        """
+        Iterate over scanner node events, adding each node and its data.
+        """
+        stats = self._stats
+        for event, node_type, byte_data, offset in nodes:
+            if stats is not None:
+                start = time.perf_counter()
+            if event == OtbmScanner.NODE_INIT:
+                node_type, key = self._get_node_key(node_type)
+                if node_type is None:
+                    self._node_stack.append((None, None, dict()))    # Not added to json
+                    if stats is not None:
+                        stats.unknown_nodes += 1
+                    continue
+                node, _ = self._open_node(node_type, key)
+                if stats is not None:
+                    decode_start = time.perf_counter()
+                    stats.phase_times['tree'] += decode_start - start
+                if byte_data:
+                    self._get_node_data(node_type, node, byte_data)
+                if self._map_xml is not None:
+                    self._add_map_xml_node(node_type, node)
+                if stats is not None:
+                    stats.add_node(node_type, time.perf_counter() - decode_start)
+                    stats.progress(offset)
+            elif self._node_stack:
+                node_type, key, node = self._node_stack.pop()   # Close current node
+                if self._map_model is not None:
+                    self._close_model_node(node_type, key, node)
+                    phase = 'tree'
+                elif self._map_store is not None:
+                    self._close_store_node(node_type, key, node)
+                    phase = 'serialization'
+                elif node_type == 'TILE_AREA' and self._json_writer is not None:
+                    self._close_tile_area(key)
+                    phase = 'serialization'
+                elif self._tile_file is not None:
+                    self._close_tile_record(node_type, key)
+                    phase = 'serialization'
                 else:
-                    if byte != b'':
-                        byte_data += byte
-                    if byte == b'\xfd':
-                        next(iterator)    # Skip next byte
-        except StopIteration:
+                    phase = 'tree'
+                if stats is not None:
+                    stats.phase_times[phase] += time.perf_counter() - start
+
+
+    def _decode_area(self, scanner, area, parent):
+        """
+        Decode a single tile area node into parent dict. Nodes are numbered
+        as they are when the whole map is processed.
+        """
+        self._tile_area_cnt = area.number - 1
+        self._tile_cnt = area.tiles_before
+        self._house_tile_cnt = area.house_tiles_before
+        self._description_cnt = area.descriptions_before
+        self._get_map_version(scanner)
+        self._node_stack.append((None, None, parent))
+        try:
+            self._get_next_node(scanner.nodes(area.offset,
+                                              area.offset + area.length))
+        finally:
+            self._node_stack.pop()
+
+    def query(self, x0, y0, x1, y1, z):
+        """
+        Get tiles inside the given region (inclusive limits) of floor z.
+
+        Only tile areas intersecting the region are decoded. Returns a dict
+        of tile areas containing the region's tiles, with the same keys
+        (TILE_AREA_n, TILE_n, HOUSE_TILE_n) they have in the whole map json.
+        """
+        areas = dict()
+        parser = self._new_parser()
+        with OtbmScanner(self.otbm_file_path) as scanner:
+            scanner.map()    # Shared with the index if it is built
+            for area in self.index.query(x0, y0, x1, y1, z):
+                parser._decode_area(scanner, area, areas)
+
+        for area_key, area in list(areas.items()):
+            for key, tile in list(area.items()):
+                if not isinstance(tile, dict):
+                    continue
+                x = area['X'] + tile.get('X', 0)
+                y = area['Y'] + tile.get('Y', 0)
+                if not (x0 <= x <= x1 and y0 <= y <= y1):
+                    del area[key]
+            if not any(isinstance(tile, dict) for tile in area.values()):
+                del areas[area_key]
+        return areas
+
+    def _add_area(self, key, area):
+        """
+        Add tile area decoded by a worker process (or another parser) to the
+        current node. Workers may return it already serialized for the
+        current output, see _decode_areas.
+        """
+        if isinstance(area, _TileRecords):
+            self._tile_file.write(area.text)
+            self._tile_records += area.count
             return
+        if self._map_model is not None and not isinstance(area, dict):
+            self._map_model.extend(area)
+            return
+        parent = self._node_stack[-1][2]
+        parent[key] = area
+        if self._map_xml is not None:
+            for tile_key, tile in area.items():
+                if tile_key.startswith('HOUSE_TILE_'):
+                    self._map_xml.add_house_tile(tile.get('HOUSE_ID', 0))
+        if self._map_model is not None:
+            for tile_key, tile in area.items():
+                if tile_key.startswith('TILE_'):
+                    self._map_model.add_tile(area, tile)
+                elif tile_key.startswith('HOUSE_TILE_'):
+                    self._map_model.add_tile(area, tile, house_tile=True)
+            self._map_model.add_area(area)
+            del parent[key]
+        elif self._map_store is not None:
+            for tile_key, tile in area.items():
+                if tile_key.startswith(('TILE_', 'HOUSE_TILE_')):
+                    self._map_store.add_tile(key, area, tile_key, tile)
+            self._map_store.add_area(key, area)
+            del parent[key]
+        elif self._json_writer is not None:
+            self._close_tile_area(key)
+        elif self._tile_file is not None:
+            for tile_key, tile in area.items():
+                if tile_key.startswith(('TILE_', 'HOUSE_TILE_')):
+                    self._write_tile_record(area, tile)
+            del parent[key]
+
+    def _parallel_workers(self, size):
+        """
+        Processes to decode a map of size bytes with, 1 to decode it
+        sequentially.
+        """
+        if size < self.PARALLEL_MIN_SIZE:
+            return 1
+        return min(self._workers, os.cpu_count() or 1)
+
+    def _split_areas(self, areas, workers):
+        """
+        Split tile areas in chunks of similar size in bytes, several per
+        worker so they stay busy when areas have different sizes.
+        """
+        chunk_size = sum(area.length for area in areas) / (workers * 4)
+        chunk = list()
+        size = 0
+        for area in areas:
+            chunk.append(area)
+            size += area.length
+            if size >= chunk_size:
+                yield chunk
+                chunk = list()
+                size = 0
+        if chunk:
+            yield chunk
+
+    def _process_map(self, scanner, decode_areas):
+        """
+        Decode map node in this process and its tile areas with
+        decode_areas, a function given the map's tile areas that yields the
+        (key, area dict) of each of them, in the same order. Returns False
+        if the map does not have the expected structure.
+        """
+        index = self.index
+        map_node = next((node for node in index.nodes
+                         if node.node_type == OtbmScanner.MAP_DATA), None)
+        if map_node is None:
+            return False
+        children = sorted((node for node in index.nodes
+                           if map_node.offset < node.offset
+                           < map_node.offset + map_node.length),
+                          key=lambda node: node.offset)
+        if not children:
+            return False
+
+        self._get_identifier(scanner)
+        self._get_otbm_header(scanner.read_payload(OtbmScanner.IDENTIFIER))
+        # Map node data, it is kept open while its children are added
+        self._get_next_node(scanner.nodes(map_node.offset, children[0].offset))
+
+        areas = [area for area in index.areas
+                 if map_node.offset < area.offset
+                 < map_node.offset + map_node.length]
+        decoded = iter(decode_areas(areas))
+        for node in children:
+            if node.node_type == OtbmScanner.TILE_AREA:
+                self._add_area(*next(decoded))
+                if self._stats is not None:
+                    self._stats.progress(node.offset + node.length)
+            else:
+                self._get_next_node(scanner.nodes(node.offset,
+                                                  node.offset + node.length))
+        self._node_stack.pop()    # Map node
+
+        if areas:
+            self._tile_area_cnt = areas[-1].number
+            self._tile_cnt = areas[-1].tiles_before + areas[-1].tiles
+            self._house_tile_cnt = areas[-1].house_tiles_before + areas[-1].house_tiles
+            self._description_cnt = areas[-1].descriptions_before + areas[-1].descriptions
+        return True
+
+    def _worker_output(self):
+        """
+        Form in which workers return decoded tile areas, see _decode_areas.
+        Areas are only sent as dicts when this process needs their tiles
+        (house tiles of map xml files, map stores, json tree).
+        """
+        if self._map_xml is not None or self._map_store is not None:
+            return None
+        if self._map_model is not None:
+            return 'model'
+        if self._json_writer is not None:
+            return 'compact_json' if self._json_writer.compact else 'json'
+        if self._tile_file is not None:
+            return 'ndjson'
+        return None
+
+    def _decode_areas_parallel(self, executor, file_path, areas, workers):
+        """
+        Decode tile areas of file_path (the mapped file) in a process pool,
+        yielding them in file order.
+        """
+        stats = self._stats
+        chunks = list(self._split_areas(areas, workers))
+        results = executor.map(_decode_areas,
+                               [file_path] * len(chunks),
+                               chunks,
+                               [stats is not None] * len(chunks),
+                               [self._items] * len(chunks),
+                               [self._worker_output()] * len(chunks))
+        for items, chunk_stats, malformed_nodes in results:
+            self._malformed_nodes += malformed_nodes
+            if chunk_stats is not None:
+                stats.merge(chunk_stats)
+            yield from items
+
+    def _process_file_parallel(self, scanner, workers):
+        """
+        Decode map node in this process and its tile areas in a process pool.
+        Returns False if the map does not have the expected structure.
+        """
+        # Workers map the file this scanner maps (the decompressed copy of
+        # compressed files), it exists until the scanner is closed
+        file_path = scanner.mapped_path
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return self._process_map(
+                scanner, lambda areas: self._decode_areas_parallel(executor, file_path,
+                                                                   areas, workers))
+
+    @staticmethod
+    def _renumber_descriptions(node, shift):
+        """
+        Node json dict with its description keys (and those of its child
+        items) shifted by shift.
+        """
+        renumbered = dict()
+        for key, value in node.items():
+            name, _, number = key.rpartition('_')
+            if name == 'DESCRIPTION':
+                key = f'DESCRIPTION_{int(number) + shift}'
+            elif name == 'ITEM' and isinstance(value, dict):
+                value = Otbm2Json._renumber_descriptions(value, shift)
+            renumbered[key] = value
+        return renumbered
+
+    @staticmethod
+    def _renumber_area(area, old, new):
+        """
+        Tile area json dict of old index area with the tile and description
+        keys of new one.
+        """
+        shift = new.descriptions_before - old.descriptions_before
+        renumbered = dict()
+        for key, value in area.items():
+            name, _, number = key.rpartition('_')
+            if name == 'TILE':
+                key = f'TILE_{int(number) - old.tiles_before + new.tiles_before}'
+            elif name == 'HOUSE_TILE':
+                key = f'HOUSE_TILE_{int(number) - old.house_tiles_before + new.house_tiles_before}'
+            if name in ('TILE', 'HOUSE_TILE') and shift and isinstance(value, dict):
+                value = Otbm2Json._renumber_descriptions(value, shift)
+            renumbered[key] = value
+        return renumbered
+
+    @staticmethod
+    def _find_old_area(old_items, number, pending):
+        """
+        Json dict of tile area number from old_items, an iterator over the
+        (key, value) items of the old json's map node. Areas are in file
+        order, the last one read is kept in pending (a list) until an area
+        after it is looked for. None if it is not found.
+        """
+        while True:
+            if pending:
+                old_number, area = pending[0]
+                if old_number > number:
+                    return None
+                pending.clear()
+                if old_number == number:
+                    return area
+            key, value = next(old_items, (None, None))
+            if key is None:
+                return None
+            name, _, old_number = key.rpartition('_')
+            if name == 'TILE_AREA' and old_number.isdigit():
+                pending.append((int(old_number), value))
+
+    def _patch_areas(self, scanner, areas, old_items, unchanged, decoded):
+        """
+        Yield (key, area dict) of tile areas, read from old_items (see
+        _find_old_area) when they did not change (unchanged: area number ->
+        old index area) and decoded otherwise. Numbers of decoded areas are
+        added to decoded.
+        """
+        pending = list()
+        for area in areas:
+            old = unchanged.get(area.number)
+            old_area = None
+            if old is not None:
+                old_area = self._find_old_area(old_items, old.number, pending)
+            if old_area is not None:
+                yield f'TILE_AREA_{area.number}', self._renumber_area(old_area, old, area)
+                continue
+            nodes = dict()
+            parser = self._new_parser()
+            parser.stats = self._stats
+            parser._decode_area(scanner, area, nodes)
+            self._malformed_nodes += parser._malformed_nodes
+            decoded.append(area.number)
+            yield from nodes.items()
+
+    def patch_json(self, old_otbm_file, compact=False):
+        """
+        Update json file, an export of old_otbm_file (a previous version of
+        the otbm file), to the otbm file.
+
+        Only tile areas that changed between both versions (see
+        OtbmIndex.pair_areas) are decoded. The json file is read as a stream
+        (ijson) while the new one is written the same way generate_json
+        streams it: the rest of the areas are copied from the json file one
+        at a time, so memory is bounded by the biggest tile area. Unchanged
+        areas that were moved before others are decoded too. The result is
+        the same as generate_json's. Returns the number of decoded tile
+        areas.
+        """
+        json_file = self._json_file_path
+        handle, patched_file = tempfile.mkstemp(
+            suffix='.json' + (compressed_io.compression(json_file) or ''),
+            dir=os.path.dirname(os.path.abspath(json_file)))
+        os.close(handle)
+        decoded = list()
+        try:
+            with OtbmScanner(self.otbm_file_path) as scanner:
+                scanner.map()    # Shared with the index if it is built
+                old_index = OtbmIndex.open(old_otbm_file, self._index_cache, self._items)
+                unchanged = {area.number: old
+                             for area, old in self.index.pair_areas(old_index)
+                             if area is not None and old is not None
+                             and area.digest == old.digest}
 
+                self._start_map_xml()
+                if self._stats is not None:
+                    self._stats.start(len(scanner))
+                with compressed_io.open_file(json_file, 'rb') as old_file, \
+                        compressed_io.open_file(patched_file, 'w', encoding='utf-8') as f:
+                    old_items = ijson.kvitems(old_file, 'MAP', use_float=True)
+                    self._json_writer = JsonStreamWriter(f, compact)
+                    try:
+                        patched = self._process_map(
+                            scanner, lambda areas: self._patch_areas(
+                                scanner, areas, old_items, unchanged, decoded))
+                        if patched:
+                            self._json_writer.close(self._json_data)
+                    finally:
+                        self._json_writer = None
+                        if self._stats is not None:
+                            self._stats.finish()
+            if patched:
+                shutil.copymode(json_file, patched_file)
+                os.replace(patched_file, json_file)
+        finally:
+            if os.path.exists(patched_file):
+                os.remove(patched_file)
+        if not patched:
+            self.process_file()
+            self.generate_json(compact)
+            return len(self.index)
+        return len(decoded)
+
+    def _iter_events(self, nodes, depth, types, region):
+        """
+        Yield node events of scanner nodes, see iter_nodes.
+        """
+        stack = list()    # (node type, position) of open nodes
+        area = None       # Base position of current tile area
+        for event, node_type, byte_data, _ in nodes:
+            if event != OtbmScanner.NODE_INIT:
+                if stack:
+                    stack.pop()
+                continue
+            node_type, key = self._get_node_key(node_type)
+            position = stack[-1][1] if stack and node_type == 'ITEM' else None
+            if node_type == 'TILE_AREA':
+                position = area = (int.from_bytes(byte_data[:2], "little"),
+                                   int.from_bytes(byte_data[2:4], "little"),
+                                   int.from_bytes(byte_data[4:5], "little"))
+            elif node_type in ('TILE', 'HOUSE_TILE') and area is not None:
+                position = (area[0] + byte_data[0], area[1] + byte_data[1],
+                            area[2])
+            stack.append((node_type, position))
+
+            if node_type is None or (types is not None and node_type not in types):
+                continue
+            attributes = dict()
+            if byte_data:
+                self._get_node_data(node_type, attributes, byte_data)
+            if node_type in ('TOWN', 'WAYPOINT'):
+                position = (attributes.get('X'), attributes.get('Y'),
+                            attributes.get('Z'))
+            if region is not None and node_type != 'TILE_AREA':
+                if position is None:
+                    continue
+                x0, y0, x1, y1, z = region
+                if not (x0 <= position[0] <= x1 and y0 <= position[1] <= y1
+                        and position[2] == z):
+                    continue
+            yield NodeEvent(node_type, key, depth + len(stack) - 1,
+                            attributes, position)
+
+    def iter_nodes(self, types=None, region=None):
+        """
+        Iterate over map nodes as they are read, without building the json
+        tree.
+
+        Yields a NodeEvent for each node, in file order (parents before their
+        children).
+
+        types: Node type names to yield (MAP, TILE_AREA, TILE, HOUSE_TILE,
+               ITEM, TOWNS, TOWN, WAYPOINTS, WAYPOINT), all if None. Data of
+               other nodes is not decoded.
+        region: (x0, y0, x1, y1, z) inclusive limits. Only tile areas
+                intersecting it are read (see index) and only nodes with a
+                position inside it are yielded, tile areas excepted.
+        """
+        if types is not None:
+            types = set(types)
+        parser = self._new_parser()
+        with OtbmScanner(self.otbm_file_path) as scanner:
+            parser._get_map_version(scanner)
+            if region is None:
+                yield from parser._iter_events(scanner.nodes(), 0, types, None)
+                return
+
+            scanner.map()    # Shared with the index if it is built
+            index = self.index
+            ranges = list()
+            for area in index.query(*region):
+                ranges.append((area.offset, area.offset + area.length, area))
+            for node in index.nodes:
+                if node.node_type in (OtbmScanner.TOWNS, OtbmScanner.WAYPOINTS):
+                    ranges.append((node.offset, node.offset + node.length, None))
+            for start, end, area in sorted(ranges, key=lambda r: r[0]):
+                if area is not None:
+                    parser._tile_area_cnt = area.number - 1
+                    parser._tile_cnt = area.tiles_before
+                    parser._house_tile_cnt = area.house_tiles_before
+                    parser._description_cnt = area.descriptions_before
+                yield from parser._iter_events(scanner.nodes(start, end), 2,
+                                               types, region)
 
     def process_file(self):
-        with open(self.otbm_file_path, 'rb') as file:
-            data_iterator = iter(partial(file.read1, 1), bytes())
-            self._get_identifier(data_iterator)
-            self._get_otbm_header(data_iterator)
-            self._get_next_node(data_iterator)
+        """
+        Parse otbm file. If workers is greater than 1 tile areas of big maps
+        are decoded in parallel, output is the same as the sequential one.
+        """
+        self._start_map_xml()
+        with OtbmScanner(self.otbm_file_path) as scanner:
+            # Compressed maps are streamed, their size is unknown until read
+            size = 0 if scanner.streamed else len(scanner)
+            if self._stats is not None:
+                self._stats.start(size)
+            try:
+                workers = self._parallel_workers(size or os.path.getsize(self.otbm_file_path))
+                if workers > 1 and self._process_file_parallel(scanner, workers):
+                    return
+                self._get_identifier(scanner)
+                nodes = scanner.nodes()
+                event, node_type, byte_data, _ = next(nodes, (None,) * 4)
+                if event != OtbmScanner.NODE_INIT or node_type != OtbmScanner.ROOT:
+                    raise ValueError(f"{self.otbm_file_path} is not an otbm map!")
+                self._get_otbm_header(byte_data)    # Root node (0xFE00)
+                self._get_next_node(nodes)
+                if 'MAP' not in self._json_data:
+                    raise ValueError(f"{self.otbm_file_path} has no map node!")
+            finally:
+                if self._stats is not None:
+                    self._stats.finish()
 
 
-    def generate_json(self):
+    def generate_json(self, compact=False, streaming=False):
         """
         Create output json file with otbm data.
+
+        compact: Write json without indentation or whitespace.
+        streaming: Parse the otbm file while writing, each tile area is
+                   written as soon as it ends and then freed, so memory is
+                   bounded by the biggest tile area instead of the whole map.
+                   process_file does not need to be called before, map data
+                   is not kept once written.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self._json_file_path)), exist_ok=True)
+        with compressed_io.open_file(self._json_file_path, 'w', encoding='utf-8') as f:
+            if streaming:
+                self._json_writer = JsonStreamWriter(f, compact)
+                try:
+                    self.process_file()
+                    self._json_writer.close(self._json_data)
+                finally:
+                    self._json_writer = None
+                return
+            start = time.perf_counter()
+            if compact:
+                json.dump(self._json_data, f, ensure_ascii=False,
+                          separators=(',', ':'))
+            else:
+                json.dump(self._json_data, f, ensure_ascii=False, indent=4)
+            if self._stats is not None:
+                elapsed = time.perf_counter() - start
+                self._stats.phase_times['serialization'] += elapsed
+                self._stats.phase_times['total'] += elapsed
+
+    def generate_ndjson(self, output_file):
+        """
+        Create a ndjson file (one json object per line) with a record for
+        each tile: absolute X, Y and Z followed by the tile's data and
+        items, as they are in the json output. Other map data (header,
+        towns, waypoints...) is not written.
+
+        Tiles are written as soon as they end and then freed, process_file
+        does not need to be called before. Returns the number of tiles
+        written.
         """
-        os.makedirs(os.path.dirname(self._json_file_path), exist_ok=True)
-        with open(self._json_file_path, 'w+', encoding='utf-8') as f:
-            json.dump(self._json_data, f, ensure_ascii=False, indent=4)
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        with compressed_io.open_file(output_file, 'w', encoding='utf-8',
+                                     newline='\n') as f:
+            self._tile_file = f
+            self._tile_records = 0
+            try:
+                self.process_file()
+            finally:
+                self._tile_file = None
+        return self._tile_records
+
+    def generate_model(self):
+        """
+        Create a map model (see lib.map_model) with otbm data. Requires numpy.
+
+        Tiles are added to the model as soon as they end, the json tree is
+        not built. process_file does not need to be called before.
+        """
+        from lib.map_model import MapModel
+
+        self._map_model = MapModel()
+        try:
+            self.process_file()
+            model = self._map_model
+        finally:
+            self._map_model = None
+        for key, value in self._json_data.items():
+            if key == 'MAP':
+                model.map_data.update(value)
+            else:
+                model.header[key] = value
+        return model.finish()
+
+    def generate_store(self, output_file):
+        """
+        Create a map store (see lib.map_store), a SQLite file with the map
+        indexed for queries that can also be written back as json.
+
+        Tiles, towns and waypoints are inserted as soon as they end, the
+        json tree is not built. process_file does not need to be called
+        before. Returns the map store, open.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        store = MapStore(output_file, create=True)
+        self._map_store = store
+        try:
+            self.process_file()
+        except BaseException:
+            store.close()
+            raise
+        finally:
+            self._map_store = None
+        start = time.perf_counter()
+        store.finish(self._json_data)
+        if self._stats is not None:
+            elapsed = time.perf_counter() - start
+            self._stats.phase_times['serialization'] += elapsed
+            self._stats.phase_times['total'] += elapsed
+        return store
+
+    def generate_binary(self, output_file):
+        """
+        Create a map model binary file (see MapModel.save) with otbm data,
+        a compact alternative to json that loads without parsing (see
+        MapModel.load, Json2Otbm reads it too). Requires numpy.
+
+        Returns the map model.
+        """
+        model = self.generate_model()
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        start = time.perf_counter()
+        model.save(output_file)
+        if self._stats is not None:
+            elapsed = time.perf_counter() - start
+            self._stats.phase_times['serialization'] += elapsed
+            self._stats.phase_times['total'] += elapsed
+        return model
+
+
+_TileRecords = namedtuple('_TileRecords', ['text', 'count'])    # Ndjson lines of a tile area
+
+
+def _decode_area_output(parser, scanner, area, output):
+    """
+    Decode a tile area in the given output form, see _decode_areas.
+    """
+    decoded = dict()
+    if output == 'ndjson':
+        parser._tile_file = io.StringIO()
+        parser._tile_records = 0
+        parser._decode_area(scanner, area, decoded)
+        return [(f'TILE_AREA_{area.number}',
+                 _TileRecords(parser._tile_file.getvalue(), parser._tile_records))]
+    if output == 'model':
+        from lib.map_model import MapModel
+
+        parser._map_model = MapModel()
+        parser._decode_area(scanner, area, decoded)
+        return [(f'TILE_AREA_{area.number}', parser._map_model)]
+
+    parser._decode_area(scanner, area, decoded)
+    if output is None:
+        return list(decoded.items())
+    start = time.perf_counter()
+    decoded = [(key, RawJson(JsonStreamWriter.dumps(value, 2, output == 'compact_json')))
+               for key, value in decoded.items()]
+    if parser.stats is not None:
+        parser.stats.phase_times['serialization'] += time.perf_counter() - start
+    return decoded
+
+
+def _decode_areas(file_path, areas, stats=False, items=None, output=None):
+    """
+    Decode tile areas of an otbm file (worker process). Returns decoded
+    (key, area) items, parse statistics if stats is True and the number of
+    malformed nodes.
+
+    Areas are json dicts if output is None. Otherwise they are serialized
+    here, so the main process only has to write them: json text ('json' or
+    'compact_json', written at tile area depth), ndjson lines ('ndjson') or
+    an unfinished MapModel of their tiles ('model').
+    """
+    parser = Otbm2Json()
+    parser.items = items
+    if stats:
+        parser.stats = ParseStats()
+    decoded = list()
+    with OtbmScanner(file_path) as scanner:
+        for area in areas:
+            decoded += _decode_area_output(parser, scanner, area, output)
+    if stats:
+        return decoded, parser.stats.as_dict(), parser.malformed_nodes
+    return decoded, None, parser.malformed_nodes
@@ -0,0 +1,101 @@
+import struct
+
+from collections import namedtuple
+
+
+Attribute = namedtuple('Attribute', [
+    'code',      # Attribute byte
+    'keys',      # Json keys of its values
+    'layout',    # struct.Struct of its values, None for strings
+])
+
+STRING_LENGTH = struct.Struct('<H')    # Strings are prefixed by their length
+
+_U8 = struct.Struct('<B')
+_I8 = struct.Struct('<b')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_I32 = struct.Struct('<i')
+
+# Attribute codes with special handling
+DESCRIPTION = 0x01      # Numbered json keys (DESCRIPTION_1, DESCRIPTION_2...)
+TILE_FLAGS = 0x03       # Split in one json key per flag bit
+
+# Tile flags bits, json keys in the same order as TILE_FLAGS attribute keys
+PROTECTION_ZONE = 0x01
+NO_PVP = 0x04
+NO_LOGOUT = 0x08
+PVP_ZONE = 0x10
+FLAGS = (('PROTECTION_ZONE', PROTECTION_ZONE),
+         ('NO_PVP', NO_PVP),
+         ('NO_LOGOUT', NO_LOGOUT),
+         ('PVP_ZONE', PVP_ZONE))
+KNOWN_FLAGS = sum(bit for _, bit in FLAGS)
+OTHER_FLAGS = 'FLAGS'    # Json key of the other bits (REFRESH...), only if set
+
+ATTRIBUTES = (
+    Attribute(DESCRIPTION, ('DESCRIPTION',), None),
+    Attribute(0x02, ('EXT_FILE',), None),
+    Attribute(TILE_FLAGS, tuple(key for key, _ in FLAGS) + (OTHER_FLAGS,), _U32),
+    Attribute(0x04, ('ACTION_ID',), _U16),
+    Attribute(0x05, ('UNIQUE_ID',), _U16),
+    Attribute(0x06, ('TEXT',), None),
+    Attribute(0x07, ('SPECIAL_DESCRIPTION',), None),
+    Attribute(0x08, ('DESTINATION_X', 'DESTINATION_Y', 'DESTINATION_Z'),
+              struct.Struct('<HHB')),
+    Attribute(0x09, ('IDENTIFIER',), _U16),
+    Attribute(0x0a, ('DEPOT_ID',), _U16),
+    Attribute(0x0b, ('SPAWN_FILE',), None),
+    Attribute(0x0c, ('CHARGES',), _U8),    # Old maps rune charges
+    Attribute(0x0d, ('HOUSE_FILE',), None),
+    Attribute(0x0e, ('HOUSE_DOOR_ID',), _U8),
+    Attribute(0x0f, ('COUNT',), _U8),
+    Attribute(0x10, ('DURATION',), _U32),
+    Attribute(0x11, ('DECAYING_STATE',), _U8),
+    Attribute(0x12, ('WRITTEN_DATE',), _U32),
+    Attribute(0x13, ('WRITTEN_BY',), None),
+    Attribute(0x14, ('SLEEPER_GUID',), _U32),
+    Attribute(0x15, ('SLEEP_START',), _U32),
+    Attribute(0x16, ('RUNE_CHARGES',), _U16),
+    Attribute(0x17, ('CONTAINER_ITEMS',), _U32),
+    Attribute(0x18, ('NAME',), None),
+    Attribute(0x19, ('ARTICLE',), None),
+    Attribute(0x1a, ('PLURAL_NAME',), None),
+    Attribute(0x1b, ('WEIGHT',), _U32),
+    Attribute(0x1c, ('ATTACK',), _I32),
+    Attribute(0x1d, ('DEFENSE',), _I32),
+    Attribute(0x1e, ('EXTRA_DEFENSE',), _I32),
+    Attribute(0x1f, ('ARMOR',), _I32),
+    Attribute(0x20, ('HIT_CHANCE',), _I8),
+    Attribute(0x21, ('SHOOT_RANGE',), _U8),
+)
+
+BY_CODE = {attribute.code: attribute for attribute in ATTRIBUTES}
+BY_KEY = {key: attribute for attribute in ATTRIBUTES for key in attribute.keys}
+
+
+def count_descriptions(byte_data, offset=0):
+    """
+    Number of DESCRIPTION attributes in node data, attributes from offset to
+    the end of byte_data are skipped with their layouts. Counting stops at
+    the first attribute that can not be read, as decoding does.
+    """
+    count = 0
+    end = len(byte_data)
+    while offset < end:
+        attribute = BY_CODE.get(byte_data[offset])
+        if attribute is None:
+            break
+        offset += 1
+        if attribute.layout is not None:
+            offset += attribute.layout.size
+            continue
+        if offset + STRING_LENGTH.size > end:
+            break
+        length, = STRING_LENGTH.unpack_from(byte_data, offset)
+        offset += STRING_LENGTH.size + length
+        if offset > end:
+            break
+        if attribute.code == DESCRIPTION:
+            count += 1
+    return count
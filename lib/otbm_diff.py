@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+from lib.otbm2json import Otbm2Json
+from lib.otbm_index import OtbmIndex
+from lib.otbm_scanner import OtbmScanner
+
+
+MapDiff = namedtuple('MapDiff', [
+    'added',      # Absolute (x, y, z) positions of tiles only in the new map
+    'removed',    # Tiles only in the old map
+    'changed',    # Tiles in both maps with different data or items
+    'areas',      # (old area, new area) index areas that changed
+])
+
+
+class OtbmDiff:
+    """
+    Differences between two versions of an OTBM map.
+
+    Tile areas are compared by the hash of their raw bytes (see OtbmIndex),
+    only areas that changed are decoded to find the tiles that changed, so
+    comparing two versions of a big map takes time proportional to the
+    edit.
+    """
+
+    def __init__(self, old_file_path, new_file_path, index_cache=True):
+        self.old_file_path = old_file_path
+        self.new_file_path = new_file_path
+        self.index_cache = index_cache    # Keep indexes in sidecar files
+
+    def changed_areas(self):
+        """
+        (old area, new area) index areas that are not equal in both maps,
+        None for areas only in one of them.
+        """
+        old_index = OtbmIndex.open(self.old_file_path, self.index_cache)
+        new_index = OtbmIndex.open(self.new_file_path, self.index_cache)
+        return [(old, new) for new, old in new_index.pair_areas(old_index)
+                if old is None or new is None or old.digest != new.digest]
+
+    @staticmethod
+    def _get_tiles(scanner, area):
+        """
+        Tiles of an index area, by absolute position.
+        """
+        tiles = dict()
+        if area is None:
+            return tiles
+        decoded = dict()
+        Otbm2Json()._decode_area(scanner, area, decoded)
+        for area_node in decoded.values():
+            for key, tile in area_node.items():
+                if isinstance(tile, dict):
+                    tiles[(area_node['X'] + tile.get('X', 0),
+                           area_node['Y'] + tile.get('Y', 0),
+                           area_node['Z'])] = tile
+        return tiles
+
+    def compare(self):
+        """
+        Get added, removed and changed tiles. Positions are sorted by floor
+        and position.
+        """
+        added, removed, changed = list(), list(), list()
+        areas = self.changed_areas()
+        with OtbmScanner(self.old_file_path) as old_scanner, \
+             OtbmScanner(self.new_file_path) as new_scanner:
+            for old_area, new_area in areas:
+                old_tiles = self._get_tiles(old_scanner, old_area)
+                new_tiles = self._get_tiles(new_scanner, new_area)
+                for position, tile in new_tiles.items():
+                    if position not in old_tiles:
+                        added.append(position)
+                    elif old_tiles[position] != tile:
+                        changed.append(position)
+                removed.extend(position for position in old_tiles
+                               if position not in new_tiles)
+
+        def order(position):
+            return position[2], position[1], position[0]
+
+        return MapDiff(sorted(added, key=order), sorted(removed, key=order),
+                       sorted(changed, key=order), areas)
@@ -0,0 +1,345 @@
+import hashlib
+import os
+import struct
+
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+from lib import compressed_io
+from lib import otbm_attributes
+from lib.otbm_scanner import OtbmScanner
+
+
+TileArea = namedtuple('TileArea', [
+    'number',           # Json key number (TILE_AREA_<number>)
+    'x', 'y', 'z',      # Area base position
+    'offset',           # Offset of the node's 0xFE byte
+    'length',           # Node length in bytes, up to its 0xFF byte included
+    'tiles',            # Number of TILE nodes
+    'house_tiles',      # Number of HOUSE_TILE nodes
+    'tiles_before',     # TILE nodes in previous areas
+    'house_tiles_before',
+    'digest',           # Hash of the node's bytes
+    'descriptions',     # DESCRIPTION attributes of its tiles and items
+    'descriptions_before',    # DESCRIPTION attributes of previous nodes
+])
+
+Node = namedtuple('Node', ['node_type', 'offset', 'length'])
+
+
+class OtbmIndex:
+    """
+    Tile area index of an OTBM file.
+
+    Maps each TILE_AREA base position to its byte offset and length so a
+    region can be decoded without reading the rest of the map. Areas are
+    bucketed in a grid of AREA_SIZE cells, a query only looks at the cells
+    that intersect it.
+
+    The index also keeps the file header fields and the offsets of the
+    root, map and map children nodes. It can be saved to a sidecar file
+    (<map>.otbmidx, or <map>.otbm.gz.otbmidx for compressed maps) and
+    loaded back while the map does not change, see open().
+
+    Each area keeps a hash of its raw bytes, areas of two versions of a map
+    with the same base position and hash are equal (see pair_areas).
+
+    Each area also keeps its number of tiles, house tiles and descriptions
+    and the number of them before it, so json keys (TILE_n, HOUSE_TILE_n,
+    DESCRIPTION_n) of an area decoded alone are the ones it has in the whole
+    map json.
+    """
+    AREA_SIZE = 256    # Tiles per area side
+
+    SUFFIX = '.otbmidx'
+    MAGIC = b'OTBMIDX\x00'
+    VERSION = 3
+
+    # Sidecar file layout, little endian
+    _FILE_HEADER = struct.Struct('<8sIQQ16s')    # Magic, version, size, mtime, hash
+    _MAP_HEADER = struct.Struct('<IIHHII')       # Identifier, root node header
+    _COUNT = struct.Struct('<I')
+    _NODE = struct.Struct('<BQQ')                # Type, offset, length
+    _AREA = struct.Struct('<HHBQQII16sII')       # X, Y, Z, offset, length, tiles, house tiles, digest, descriptions (and before)
+
+    _DIGEST_SIZE = 16
+
+    # Bytes before the attributes of nodes that may have descriptions
+    _ATTRIBUTES_OFFSET = {OtbmScanner.MAP_DATA: 0, OtbmScanner.TILE: 2,
+                          OtbmScanner.HOUSE_TILE: 6, OtbmScanner.ITEM: 2}
+
+    _SAMPLES = 64              # Blocks hashed by fingerprint()
+    _SAMPLE_SIZE = 1 << 12
+
+    def __init__(self):
+        self.header = dict()    # Identifier and root node header fields
+        self._nodes = list()
+        self._areas = list()
+        self._grid = defaultdict(list)    # (cell x, cell y, z) -> area indexes
+
+    def __len__(self):
+        return len(self._areas)
+
+    def __iter__(self):
+        return iter(self._areas)
+
+    @property
+    def areas(self):
+        return self._areas
+
+    @property
+    def nodes(self):
+        """
+        Root, map and map children nodes (tile areas, towns, waypoints).
+        """
+        return self._nodes
+
+    def add_node(self, node_type, offset, length):
+        node = Node(node_type, offset, length)
+        self._nodes.append(node)
+        return node
+
+    def add_area(self, x, y, z, offset, length, tiles, house_tiles, digest=b'',
+                 descriptions=0, descriptions_before=None):
+        """
+        Add a tile area, areas must be added in file order. Descriptions
+        before it default to those of previous areas.
+        """
+        tiles_before = house_tiles_before = 0
+        if self._areas:
+            last = self._areas[-1]
+            tiles_before = last.tiles_before + last.tiles
+            house_tiles_before = last.house_tiles_before + last.house_tiles
+        if descriptions_before is None:
+            descriptions_before = 0
+            if self._areas:
+                descriptions_before = last.descriptions_before + last.descriptions
+        area = TileArea(len(self._areas) + 1, x, y, z, offset, length,
+                        tiles, house_tiles, tiles_before, house_tiles_before,
+                        digest, descriptions, descriptions_before)
+        self._areas.append(area)
+        size = self.AREA_SIZE
+        for cell_x in range(x // size, (x + size - 1) // size + 1):
+            for cell_y in range(y // size, (y + size - 1) // size + 1):
+                self._grid[(cell_x, cell_y, z)].append(area.number - 1)
+        return area
+
+    def query(self, x0, y0, x1, y1, z):
+        """
+        Tile areas intersecting the given region (inclusive limits), in file
+        order.
+        """
+        size = self.AREA_SIZE
+        found = set()
+        for cell_x in range(x0 // size, x1 // size + 1):
+            for cell_y in range(y0 // size, y1 // size + 1):
+                for index in self._grid.get((cell_x, cell_y, z), ()):
+                    area = self._areas[index]
+                    if area.x <= x1 and area.x + size > x0 \
+                            and area.y <= y1 and area.y + size > y0:
+                        found.add(index)
+        return [self._areas[index] for index in sorted(found)]
+
+    def pair_areas(self, other):
+        """
+        Pair each tile area with the area of other index (another version of
+        the map) that has the same base position, in file order if several
+        areas have it. Yields (area, other area) tuples, None for areas
+        without pair; areas only found in other are yielded last.
+        """
+        others = defaultdict(list)
+        for area in reversed(other.areas):
+            others[(area.x, area.y, area.z)].append(area)
+        for area in self._areas:
+            candidates = others.get((area.x, area.y, area.z))
+            yield area, candidates.pop() if candidates else None
+        for area in other.areas:
+            if area in others.get((area.x, area.y, area.z), ()):
+                yield None, area
+
+    @staticmethod
+    def _count_descriptions(scanner, node_type, start, skip, items, map_version):
+        """
+        DESCRIPTION attributes of the node starting at start, whose
+        attributes start after skip payload bytes.
+        """
+        payload = scanner.read_payload(start)
+        if node_type == OtbmScanner.ITEM and map_version == 0 and items is not None \
+                and items.has_subtype(int.from_bytes(payload[:2], "little")):
+            skip += 1    # Count or fluid type, see Otbm2Json.items
+        return otbm_attributes.count_descriptions(payload, skip)
+
+    @classmethod
+    def build(cls, scanner, items=None):
+        """
+        Create index with a structural pass over the scanner's file, only
+        root and tile area payloads are read (and payloads that may have
+        descriptions). items are the map's item types, only used by OTBM
+        version 1 maps, see Otbm2Json.items.
+        """
+        scanner.map()    # Payloads are read by offset
+        index = cls()
+        index.header['identifier'] = scanner.identifier
+        map_version = OtbmScanner.parse_header(
+            scanner.read_payload(OtbmScanner.IDENTIFIER)).get('map_version')
+        stack = list()    # [node type, offset, tiles, house tiles, descriptions before]
+        descriptions = 0
+        attributes_offset = cls._ATTRIBUTES_OFFSET
+        find = scanner.find
+        pending = None    # (type, offset, attributes offset) of node being read
+        for event, node_type, _, offset in scanner.nodes(payloads=False):
+            if pending is not None:
+                # Its payload is only read if it has a 0x01 byte after its
+                # fixed fields (escapes can only make the search start early)
+                if find(b'\x01', pending[1] + 2 + pending[2], offset) >= 0:
+                    descriptions += cls._count_descriptions(scanner, *pending,
+                                                            items, map_version)
+                pending = None
+            if event == OtbmScanner.NODE_INIT:
+                if stack and stack[-1][0] == OtbmScanner.TILE_AREA:
+                    if node_type == OtbmScanner.TILE:
+                        stack[-1][2] += 1
+                    elif node_type == OtbmScanner.HOUSE_TILE:
+                        stack[-1][3] += 1
+                stack.append([node_type, offset, 0, 0, descriptions])
+                skip = attributes_offset.get(node_type)
+                if skip is not None:
+                    pending = (node_type, offset, skip)
+            elif stack:
+                node_type, start, tiles, house_tiles, descriptions_before = stack.pop()
+                length = offset + 1 - start
+                if len(stack) <= 2:
+                    index.add_node(node_type, start, length)
+                if not stack:
+                    payload = scanner.read_payload(start)
+                    index.header.update(OtbmScanner.parse_header(payload))
+                elif node_type == OtbmScanner.TILE_AREA:
+                    payload = scanner.read_payload(start)
+                    digest = hashlib.blake2b(scanner.buffer[start:start + length],
+                                             digest_size=cls._DIGEST_SIZE)
+                    index.add_area(int.from_bytes(payload[:2], "little"),
+                                   int.from_bytes(payload[2:4], "little"),
+                                   int.from_bytes(payload[4:5], "little"),
+                                   start, length, tiles, house_tiles,
+                                   digest.digest(), descriptions - descriptions_before,
+                                   descriptions_before)
+        return index
+
+    @classmethod
+    def fingerprint(cls, scanner):
+        """
+        File size, modification time and content hash of the scanner's file.
+
+        The hash covers evenly spaced blocks of the file as stored (and its
+        whole contents for small files) so it takes the same time for any
+        map size, compressed files are not decompressed. Together with size
+        and mtime it detects edited maps.
+        """
+        stat = os.stat(scanner.file_path)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(scanner.file_path, 'rb') as f:
+            if stat.st_size <= cls._SAMPLES * cls._SAMPLE_SIZE:
+                digest.update(f.read())
+            else:
+                step = (stat.st_size - cls._SAMPLE_SIZE) // (cls._SAMPLES - 1)
+                for sample in range(cls._SAMPLES):
+                    f.seek(sample * step)
+                    digest.update(f.read(cls._SAMPLE_SIZE))
+        return stat.st_size, stat.st_mtime_ns, digest.digest()
+
+    def save(self, file_path, fingerprint):
+        """
+        Write index to a sidecar file.
+        """
+        size, mtime, digest = fingerprint
+        header = self.header
+        with open(file_path, 'wb') as f:
+            f.write(self._FILE_HEADER.pack(self.MAGIC, self.VERSION,
+                                           size, mtime, digest))
+            f.write(self._MAP_HEADER.pack(header.get('identifier', 0),
+                                          header.get('map_version', 0),
+                                          header.get('map_width', 0),
+                                          header.get('map_height', 0),
+                                          header.get('items_major_version', 0),
+                                          header.get('items_minor_version', 0)))
+            f.write(self._COUNT.pack(len(self._nodes)))
+            f.write(b''.join(self._NODE.pack(*node) for node in self._nodes))
+            f.write(self._COUNT.pack(len(self._areas)))
+            f.write(b''.join(self._AREA.pack(area.x, area.y, area.z,
+                                             area.offset, area.length,
+                                             area.tiles, area.house_tiles,
+                                             area.digest, area.descriptions,
+                                             area.descriptions_before)
+                             for area in self._areas))
+
+    @classmethod
+    def load(cls, file_path, fingerprint):
+        """
+        Read index from a sidecar file. Returns None if the file does not
+        exist, is not valid or was built for a different map (fingerprint).
+        """
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            magic, version, size, mtime, digest = \
+                cls._FILE_HEADER.unpack_from(data, 0)
+            if (magic, version) != (cls.MAGIC, cls.VERSION) \
+                    or (size, mtime, digest) != tuple(fingerprint):
+                return None
+            offset = cls._FILE_HEADER.size
+            index = cls()
+            index.header = dict(zip(('identifier',) + tuple(
+                                         key for key, _ in OtbmScanner.HEADER),
+                                    cls._MAP_HEADER.unpack_from(data, offset)))
+            offset += cls._MAP_HEADER.size
+            count, = cls._COUNT.unpack_from(data, offset)
+            offset += cls._COUNT.size
+            for node in cls._NODE.iter_unpack(
+                    data[offset:offset + count * cls._NODE.size]):
+                index.add_node(*node)
+            offset += count * cls._NODE.size
+            count, = cls._COUNT.unpack_from(data, offset)
+            offset += cls._COUNT.size
+            end = offset + count * cls._AREA.size
+            if end != len(data):
+                return None
+            for area in cls._AREA.iter_unpack(data[offset:end]):
+                index.add_area(*area)
+        except struct.error:
+            return None
+        return index
+
+    @classmethod
+    def open(cls, file_path, cache=True, items=None):
+        """
+        Get index of an OTBM file, loading it from its sidecar file if it is
+        up to date. Otherwise it is built and, if cache is True, saved.
+
+        Descriptions of OTBM version 1 maps depend on item types (items),
+        indexes built with them are not cached.
+        """
+        file_path = Path(file_path)
+        if compressed_io.compression(file_path):
+            sidecar = file_path.with_name(file_path.name + cls.SUFFIX)
+        else:
+            sidecar = file_path.with_suffix(cls.SUFFIX)
+        with OtbmScanner(file_path) as scanner:
+            fingerprint = cls.fingerprint(scanner)
+            if cache and items is not None \
+                    and scanner.parse_header(scanner.read_payload(
+                        OtbmScanner.IDENTIFIER)).get('map_version') == 0:
+                cache = False
+            if cache:
+                index = cls.load(sidecar, fingerprint)
+                if index is not None:
+                    return index
+            index = cls.build(scanner, items)
+        if cache:
+            try:
+                index.save(sidecar, fingerprint)
+            except OSError as e:
+                print(f"Index not saved: {e}")
+        return index
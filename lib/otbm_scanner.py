@@ -0,0 +1,347 @@
+import mmap
+import re
+
+from pathlib import Path
+
+from lib import compressed_io
+
+
+class OtbmScanner:
+    """
+    Memory-mapped OTBM node scanner.
+
+    Node boundaries (0xFE/0xFF) and escapes (0xFD) are located in bulk
+    with a precompiled byte class search over the mapped file instead of
+    reading it one byte at a time. Payloads without escaped bytes are
+    returned as memoryview slices of the map (zero-copy); only payloads
+    containing escapes are copied into a new buffer.
+
+    Compressed files (.gz, .xz, .bz2, see lib.compressed_io) can not be
+    mapped. Whole file passes (nodes() with default limits) read them from
+    their decompressed stream instead, payloads are then copied. Random
+    access (buffer, len, find, other nodes() limits...) maps a temporary
+    decompressed copy, shared by the open scanners of the file and removed
+    once the last of them is closed.
+
+    The scanner must be used as a context manager (or opened and closed
+    explicitly). Views returned by ``nodes`` are only valid while the
+    scanner is open and must not be kept once it is closed.
+    """
+    NODE_ESCAPE = 0xfd
+    NODE_INIT = 0xfe
+    NODE_END = 0xff
+
+    # Node types
+    ROOT = 0x00
+    MAP_DATA = 0x02
+    TILE_AREA = 0x04
+    TILE = 0x05
+    ITEM = 0x06
+    TOWNS = 0x0c
+    TOWN = 0x0d
+    HOUSE_TILE = 0x0e
+    WAYPOINTS = 0x0f
+    WAYPOINT = 0x10
+
+    IDENTIFIER = 4    # Number of bytes
+
+    # Root node header fields and their size in bytes
+    HEADER = (('map_version', 4),
+              ('map_width', 2),
+              ('map_height', 2),
+              ('items_major_version', 4),
+              ('items_minor_version', 4))
+
+    # Node markers, escaped (preceded by NODE_ESCAPE) inside payloads
+    SPECIAL_BYTES = re.compile(b'[\xfd-\xff]')
+
+    def __init__(self, file_path):
+        self._file_path = Path(file_path)
+        self._file = None
+        self._mmap = None
+        self._view = None
+        self._identifier = None    # First bytes of a compressed file
+        self._copy = None          # Decompressed copy of a compressed file
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @property
+    def buffer(self):
+        """
+        Whole file contents as a memoryview.
+        """
+        self.map()
+        return self._view
+
+    @property
+    def streamed(self):
+        """
+        Whether the file is compressed and has not been mapped, so its
+        size is not known yet.
+        """
+        return self._view is None
+
+    @property
+    def mapped_path(self):
+        """
+        Path of the mapped file, a decompressed copy for compressed files.
+        It exists while the scanner is open.
+        """
+        self.map()
+        return self._copy or self._file_path
+
+    def __len__(self):
+        self.map()
+        return len(self._view)
+
+    def open(self):
+        if compressed_io.compression(self._file_path):
+            with compressed_io.open_file(self._file_path) as f:
+                self._identifier = f.read(self.IDENTIFIER)
+            return    # Mapped on first random access
+        self._map(self._file_path)
+
+    def _map(self, file_path):
+        self._file = open(file_path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped
+            self._mmap = bytes()
+        self._view = memoryview(self._mmap)
+
+    def map(self):
+        """
+        Map the decompressed copy of a compressed file, if not mapped yet.
+        Random access methods map it on first use.
+        """
+        if self._view is None:
+            self._copy = compressed_io.decompressed_copy(self._file_path)
+            self._map(self._copy)
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if isinstance(self._mmap, mmap.mmap):
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass    # Views still referenced, closed once collected
+        self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._copy is not None:
+            compressed_io.release_copy(self._file_path, self._copy)
+            self._copy = None
+
+    @property
+    def identifier(self):
+        """
+        File identifier (first 4 bytes, little endian).
+        """
+        if self._view is None:
+            return int.from_bytes(self._identifier, "little")
+        return int.from_bytes(self._view[:self.IDENTIFIER], "little")
+
+    @classmethod
+    def parse_header(cls, byte_data):
+        """
+        Root node header fields from its (unescaped) payload.
+        """
+        header = dict()
+        offset = 0
+        for key, size in cls.HEADER:
+            header[key] = int.from_bytes(byte_data[offset:offset+size], "little")
+            offset += size
+        return header
+
+    @classmethod
+    def escape(cls, byte_data):
+        """
+        Payload bytes as they are written, node markers escaped (the
+        opposite of the unescaping nodes() does).
+        """
+        return cls.SPECIAL_BYTES.sub(b'\xfd\\g<0>', byte_data)
+
+    def find(self, data, start, end):
+        """
+        Offset of the first occurrence of data between start and end, -1 if
+        not found.
+        """
+        self.map()
+        return self._mmap.find(data, start, end)
+
+    def read_payload(self, offset):
+        """
+        Unescaped payload of the node starting at offset (its 0xFE byte).
+        """
+        for event, _, payload, _ in self.nodes(offset):
+            return bytes(payload)
+        return bytes()
+
+    def nodes(self, start=IDENTIFIER, end=None, payloads=True):
+        """
+        Iterate over node events between start and end offsets.
+
+        Yields (event, node_type, payload, offset) tuples:
+            - (NODE_INIT, node_type, payload, offset) once the payload of a
+              node is complete, that is, when its first child or its end is
+              reached. Offset points to the node's 0xFE byte.
+            - (NODE_END, None, None, offset) when a node ends. Offset points
+              to the node's 0xFF byte.
+
+        Payloads are unescaped: 0xFD bytes are removed and the byte that
+        follows each of them is kept. If payloads is False they are not
+        read at all and None is yielded instead, which is faster when only
+        the node structure is needed.
+        """
+        if self._view is None:
+            if start == self.IDENTIFIER and end is None:
+                yield from self._stream_nodes(payloads)
+                return
+            self.map()
+        buf = self._mmap
+        view = self._view
+        search = self.SPECIAL_BYTES.search
+        if end is None:
+            end = len(view)
+
+        node_type = None    # Type of the node whose payload is being read
+        node_offset = 0
+        segment = 0         # Start of the pending payload segment
+        chunks = None       # Unescaped payload, only used if escapes found
+        pos = start
+        while pos < end:
+            match = search(buf, pos, end)
+            if match is None:
+                break
+            mark = match.start()
+            marker = buf[mark]
+
+            if marker == self.NODE_ESCAPE:
+                if node_type is not None and payloads:
+                    if chunks is None:
+                        chunks = bytearray(view[segment:mark])
+                    else:
+                        chunks += view[segment:mark]
+                    chunks += view[mark + 1:mark + 2]
+                    segment = mark + 2
+                pos = mark + 2
+                continue
+
+            if node_type is not None:
+                if not payloads:
+                    payload = None
+                elif chunks is None:
+                    payload = view[segment:mark]
+                else:
+                    chunks += view[segment:mark]
+                    payload = chunks
+                yield self.NODE_INIT, node_type, payload, node_offset
+                node_type = None
+                chunks = None
+
+            if marker == self.NODE_INIT:
+                if mark + 1 >= end:
+                    break
+                node_type = buf[mark + 1]
+                node_offset = mark
+                segment = pos = mark + 2
+            else:
+                yield self.NODE_END, None, None, mark
+                pos = mark + 1
+
+        if node_type is not None:
+            # Truncated file, flush what was read of the last node
+            if not payloads:
+                payload = None
+            elif chunks is None:
+                payload = view[segment:end]
+            else:
+                chunks += view[segment:end]
+                payload = chunks
+            yield self.NODE_INIT, node_type, payload, node_offset
+
+    def _stream_nodes(self, payloads):
+        """
+        nodes() of a whole compressed file, read from its decompressed
+        stream one chunk at a time. Payloads are bytes.
+        """
+        search = self.SPECIAL_BYTES.search
+        node_type = None
+        node_offset = 0
+        chunks = None       # Payload read before the current chunk or escapes
+        with compressed_io.open_file(self._file_path) as stream:
+            data = stream.read(compressed_io.BUFFER_SIZE)
+            base = 0        # File offset of data
+            segment = pos = self.IDENTIFIER
+            while True:
+                match = search(data, pos)
+                if match is None or match.start() + 1 >= len(data):
+                    # Marker (and the byte after it) may be in the next chunk
+                    chunk = stream.read(compressed_io.BUFFER_SIZE)
+                    if chunk:
+                        keep = len(data) if match is None else match.start()
+                        if node_type is not None and payloads:
+                            if chunks is None:
+                                chunks = bytearray()
+                            chunks += data[segment:keep]
+                        base += keep
+                        data = data[keep:] + chunk
+                        segment = pos = 0
+                        continue
+                    if match is None:
+                        break
+                mark = match.start()
+                marker = data[mark]
+
+                if marker == self.NODE_ESCAPE:
+                    if node_type is not None and payloads:
+                        if chunks is None:
+                            chunks = bytearray()
+                        chunks += data[segment:mark]
+                        chunks += data[mark + 1:mark + 2]
+                        segment = mark + 2
+                    pos = mark + 2
+                    continue
+
+                if node_type is not None:
+                    if not payloads:
+                        payload = None
+                    elif chunks is None:
+                        payload = data[segment:mark]
+                    else:
+                        chunks += data[segment:mark]
+                        payload = bytes(chunks)
+                    yield self.NODE_INIT, node_type, payload, node_offset
+                    node_type = None
+                    chunks = None
+
+                if marker == self.NODE_INIT:
+                    if mark + 1 >= len(data):
+                        break
+                    node_type = data[mark + 1]
+                    node_offset = base + mark
+                    segment = pos = mark + 2
+                else:
+                    yield self.NODE_END, None, None, base + mark
+                    pos = mark + 1
+
+            if node_type is not None:
+                # Truncated file, flush what was read of the last node
+                payload = None
+                if payloads:
+                    payload = bytes(chunks or b'') + data[segment:]
+                yield self.NODE_INIT, node_type, payload, node_offset
@@ -0,0 +1,130 @@
+import sys
+import time
+
+from collections import Counter, defaultdict
+
+try:
+    import resource
+except ImportError:    # Not available on Windows
+    resource = None
+
+
+class ParseStats:
+    """
+    Parser instrumentation.
+
+    Set an instance as a parser's stats to enable it, parsers do not measure
+    anything while their stats is None. Counts and times are accumulated
+    over every file processed with the same instance.
+
+    node_counts: Nodes processed, by node type.
+    node_times: Seconds spent decoding (Otbm2Json) or encoding (Json2Otbm)
+                node data, by node type.
+    phase_times: Seconds spent in each phase: 'decoding' / 'encoding' (node
+                 data), 'tree' (json tree building), 'serialization' (json
+                 or otbm output) and 'total'.
+    malformed_nodes: Nodes whose data could not be processed, the first
+                     MAX_ERRORS error messages are kept in errors.
+    unknown_nodes: Nodes of unknown type, ignored.
+    """
+    MAX_ERRORS = 100
+
+    def __init__(self, progress_callback=None, progress_interval=1.0):
+        """
+        progress_callback: Called with this instance every progress_interval
+                           seconds while a file is processed.
+        """
+        self.node_counts = Counter()
+        self.node_times = defaultdict(float)
+        self.phase_times = defaultdict(float)
+        self.malformed_nodes = 0
+        self.unknown_nodes = 0
+        self.errors = list()
+        self.bytes_read = 0
+        self.total_bytes = 0
+        self.peak_memory = None    # MB, process peak resident memory
+
+        self._progress_callback = progress_callback
+        self._progress_interval = progress_interval
+        self._next_progress = None
+        self._start_time = None
+
+    @property
+    def elapsed(self):
+        return self.phase_times['total']
+
+    @property
+    def bytes_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_read / self.elapsed
+
+    def start(self, total_bytes):
+        """
+        Start processing a file of total_bytes size.
+        """
+        self.total_bytes = total_bytes
+        self.bytes_read = 0
+        self._start_time = time.perf_counter()
+        self._next_progress = self._start_time + self._progress_interval
+
+    def finish(self):
+        """
+        Finish processing current file.
+        """
+        if self._start_time is not None:
+            self.phase_times['total'] += time.perf_counter() - self._start_time
+            self._start_time = None
+        self.bytes_read = max(self.bytes_read, self.total_bytes)
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_memory = peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+    def add_node(self, node_type, seconds, phase='decoding'):
+        self.node_counts[node_type] += 1
+        self.node_times[node_type] += seconds
+        self.phase_times[phase] += seconds
+
+    def add_malformed(self, message):
+        self.malformed_nodes += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(message)
+
+    def progress(self, bytes_read):
+        """
+        Update bytes read and call progress callback if it is time to.
+        """
+        self.bytes_read = bytes_read
+        if self._progress_callback is not None:
+            now = time.perf_counter()
+            if now >= self._next_progress:
+                self._next_progress = now + self._progress_interval
+                self._progress_callback(self)
+
+    def merge(self, other):
+        """
+        Add counts and times of other stats (a ParseStats or its as_dict()).
+        """
+        if isinstance(other, ParseStats):
+            other = other.as_dict()
+        self.node_counts.update(other['node_counts'])
+        for key, value in other['node_times'].items():
+            self.node_times[key] += value
+        for key, value in other['phase_times'].items():
+            if key != 'total':
+                self.phase_times[key] += value
+        self.malformed_nodes += other['malformed_nodes']
+        self.unknown_nodes += other['unknown_nodes']
+        self.errors.extend(other['errors'][:self.MAX_ERRORS - len(self.errors)])
+
+    def as_dict(self):
+        return dict(node_counts=dict(self.node_counts),
+                    node_times=dict(self.node_times),
+                    phase_times=dict(self.phase_times),
+                    malformed_nodes=self.malformed_nodes,
+                    unknown_nodes=self.unknown_nodes,
+                    errors=list(self.errors),
+                    bytes_read=self.bytes_read,
+                    total_bytes=self.total_bytes,
+                    bytes_per_second=self.bytes_per_second,
+                    peak_memory=self.peak_memory)
@@ -0,0 +1,205 @@
+import numpy as np
+import os
+
+from xml.sax.saxutils import quoteattr
+
+from lib import otbm_attributes
+from lib.map_generator import MapGenerator
+
+
+class SpawnGenerator:
+    """
+    Monster spawn generator.
+
+    Spawns are placed over the walkable tiles of a map model (tiles with a
+    ground, not in a protection zone, not house tiles and without blocking
+    ground or items) with Poisson-disc sampling: no two spawns of a floor
+    are closer than distance.
+
+    Sampling uses a spatial hash grid of cells smaller than distance / sqrt(2)
+    (one spawn per cell at most) and only checks the cells around each
+    candidate. Cells are processed in phases of cells 3 cells apart, which
+    can not conflict, so each phase is computed for all its cells at once
+    with NumPy.
+
+    With item types (see lib.item_types), grounds and items that block
+    movement or paths are avoided too.
+    """
+    # Ground and item ids that block monsters, MapGenerator terrain by default
+    BLOCKING_IDS = ((MapGenerator.GROUND['water'], MapGenerator.GROUND['mountain'])
+                    + MapGenerator.VEGETATION[:5])    # Trees
+
+    MONSTERS = ("Rat", "Cave Rat", "Spider", "Wolf", "Bear", "Orc", "Troll")
+
+    def __init__(self, distance=12, monsters=MONSTERS, spawn_radius=3,
+                 max_monsters=3, spawn_time=60, blocking_ids=BLOCKING_IDS,
+                 attempts=10, seed=0, items=None):
+        """
+        distance: Minimum distance between spawns centers, at least 3.
+        monsters: Monster names, each spawn has one of them.
+        spawn_radius: Spawn radius, monsters are placed inside it.
+        max_monsters: Maximum monsters per spawn.
+        spawn_time: Monsters respawn time, in seconds.
+        attempts: Candidate positions tried per grid cell.
+        items: ItemTypes of the map's items.otb, or None.
+        """
+        assert distance >= 3, "Wrong spawn distance!"
+        self.distance = distance
+        self.monsters = tuple(monsters)
+        self.spawn_radius = spawn_radius
+        self.max_monsters = max_monsters
+        self.spawn_time = spawn_time
+        self.blocking_ids = tuple(blocking_ids)
+        self.attempts = attempts
+        self.seed = seed
+        self.items = items
+
+    def walkable(self, model):
+        """
+        Mask of model tiles where monsters can be placed.
+        """
+        tiles = model.tiles
+        items = model.items['id']
+        blocking_ground = np.isin(tiles['ground'], self.blocking_ids)
+        blocking_items = np.isin(items, self.blocking_ids)
+        if self.items is not None:
+            flags = self.items.BLOCK_SOLID | self.items.BLOCK_PATHFIND
+            blocking_ground |= self.items.select(tiles['ground'], flags)
+            blocking_items |= self.items.select(items, flags)
+        mask = (tiles['ground'] > 0) & ~tiles['house_tile'] \
+            & (tiles['flags'] & otbm_attributes.PROTECTION_ZONE == 0) & ~blocking_ground
+        mask[model.item_tiles()[blocking_items]] = False
+        return mask
+
+    def _sample(self, x, y, rand):
+        """
+        Poisson-disc sample of floor positions x, y (walkable tiles).
+        Returns the indexes of the sampled positions.
+        """
+        cell = int(self.distance / 2 ** 0.5)
+        x0, y0 = x.min(), y.min()
+        width, height = x.max() - x0 + 1, y.max() - y0 + 1
+        tiles = np.full((width, height), -1, np.int64)    # Position index
+        tiles[x - x0, y - y0] = np.arange(len(x))
+
+        pad = 2    # Cells checked around each cell
+        grid_width = -(-width // cell)
+        grid_height = -(-height // cell)
+        samples = np.full((grid_width + 2 * pad, grid_height + 2 * pad), -1, np.int64)
+        sample_x = np.zeros(samples.shape, np.int64)
+        sample_y = np.zeros(samples.shape, np.int64)
+        distance = self.distance ** 2
+        offsets = [(dx, dy) for dx in range(-pad, pad + 1) for dy in range(-pad, pad + 1)
+                   if dx or dy]
+
+        phases = [(px, py) for px in range(3) for py in range(3)]
+        for _ in range(self.attempts):
+            for px, py in phases:
+                cx, cy = np.meshgrid(np.arange(px, grid_width, 3),
+                                     np.arange(py, grid_height, 3), indexing='ij')
+                cx, cy = cx.ravel() + pad, cy.ravel() + pad
+                empty = samples[cx, cy] < 0
+                cx, cy = cx[empty], cy[empty]
+
+                # Random tile of each cell, it must be walkable
+                tx = (cx - pad) * cell + rand.integers(0, cell, len(cx))
+                ty = (cy - pad) * cell + rand.integers(0, cell, len(cy))
+                valid = (tx < width) & (ty < height)
+                cx, cy, tx, ty = cx[valid], cy[valid], tx[valid], ty[valid]
+                index = tiles[tx, ty]
+                valid = index >= 0
+                for dx, dy in offsets:
+                    near = samples[cx + dx, cy + dy] >= 0
+                    valid &= ~near | ((sample_x[cx + dx, cy + dy] - tx) ** 2
+                                      + (sample_y[cx + dx, cy + dy] - ty) ** 2
+                                      >= distance)
+                cx, cy = cx[valid], cy[valid]
+                samples[cx, cy] = index[valid]
+                sample_x[cx, cy] = tx[valid]
+                sample_y[cx, cy] = ty[valid]
+        return np.sort(samples[samples >= 0])
+
+    def _place(self, tiles):
+        """
+        Spawn centers over walkable tiles, (x, y, z) rows sorted by floor and
+        position.
+        """
+        rand = np.random.default_rng(self.seed)
+        centers = list()
+        for z in np.unique(tiles['z']):
+            floor = tiles[tiles['z'] == z]
+            x = floor['x'].astype(np.int64)
+            y = floor['y'].astype(np.int64)
+            sampled = self._sample(x, y, rand)
+            centers.append(np.stack((x[sampled], y[sampled],
+                                     np.full(len(sampled), z, np.int64)), axis=-1))
+        if not centers:
+            return np.zeros((0, 3), np.int64)
+        centers = np.concatenate(centers)
+        return centers[np.lexsort((centers[:, 0], centers[:, 1], centers[:, 2]))]
+
+    def place(self, model):
+        """
+        Spawn centers of model's map, (x, y, z) rows sorted by floor and
+        position.
+        """
+        return self._place(model.tiles[self.walkable(model)])
+
+    @staticmethod
+    def _position_keys(x, y, z):
+        return (np.asarray(z, np.int64) << 32) | (np.asarray(x, np.int64) << 16) \
+            | np.asarray(y, np.int64)
+
+    def _get_monsters(self, centers, tiles, rand):
+        """
+        Monster name, count and candidate offsets of each spawn, with a mask
+        of candidates on walkable tiles. The first candidate is the spawn
+        center.
+        """
+        count = len(centers)
+        radius = self.spawn_radius
+        names = rand.integers(len(self.monsters), size=count)
+        counts = rand.integers(1, self.max_monsters + 1, count)
+        offsets = rand.integers(-radius, radius + 1, (count, self.max_monsters * 4, 2))
+        offsets[:, 0] = 0
+
+        keys = np.sort(self._position_keys(tiles['x'], tiles['y'], tiles['z']))
+        x = centers[:, None, 0] + offsets[..., 0]
+        y = centers[:, None, 1] + offsets[..., 1]
+        candidates = self._position_keys(x, y, centers[:, None, 2])
+        found = np.minimum(np.searchsorted(keys, candidates), len(keys) - 1)
+        walkable = (x >= 0) & (y >= 0) & (keys[found] == candidates)
+        return names, counts, offsets, walkable
+
+    def generate(self, model, output_file):
+        """
+        Place spawns over model's map and write them to a spawn xml file,
+        spawn by spawn. Returns the number of spawns.
+        """
+        tiles = model.tiles[self.walkable(model)]
+        centers = self._place(tiles)
+        rand = np.random.default_rng((self.seed, 1))
+        names, counts, offsets, walkable = self._get_monsters(centers, tiles, rand)
+
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8', newline='\n') as f:
+            f.write('<?xml version="1.0"?>\n')
+            if not len(centers):
+                f.write('<spawns />\n')
+                return 0
+            f.write('<spawns>\n')
+            for spawn, (x, y, z) in enumerate(centers.tolist()):
+                f.write(f'\t<spawn centerx="{x}" centery="{y}" centerz="{z}" '
+                        f'radius="{self.spawn_radius}">\n')
+                name = quoteattr(self.monsters[names[spawn]])
+                used = set()
+                for (dx, dy), valid in zip(offsets[spawn].tolist(), walkable[spawn].tolist()):
+                    if len(used) == counts[spawn]:
+                        break
+                    if valid and (dx, dy) not in used:
+                        used.add((dx, dy))
+                        f.write(f'\t\t<monster name={name} x="{dx}" y="{dy}" '
+                                f'z="{z}" spawntime="{self.spawn_time}" />\n')
+                f.write('\t</spawn>\n')
+            f.write('</spawns>\n')
+        return len(centers)
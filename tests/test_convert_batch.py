@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))    # noqa: E402
+
+from OTBMGenerator import OTBMGenerator
+
+
+def convert(self, input_file, output_file, compact=False):
+    """
+    Fake conversion, the worker process dies on inputs named crash.
+    """
+    if os.path.basename(input_file).startswith('crash'):
+        os._exit(1)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'w') as f:
+        f.write('{}')
+
+
+@unittest.skipUnless(multiprocessing.get_start_method() == 'fork',
+                     "workers must inherit the patched conversion")
+class ConvertBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = os.path.join(self.tmp_dir.name, 'output')
+        for name in ('a', 'b', 'crash', 'c', 'd'):
+            with open(os.path.join(self.tmp_dir.name, f'{name}.otbm'), 'wb') as f:
+                f.write(bytes(ord(name[0])))    # Different sizes, fixed order
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_worker_dies(self):
+        with mock.patch.object(OTBMGenerator, 'convert', convert):
+            results = OTBMGenerator().convert_batch([self.tmp_dir.name], self.output_dir,
+                                                    workers=2, callback=lambda message: None)
+        failed = [result for result in results if result.error is not None]
+        self.assertEqual(len(results), 5)
+        self.assertEqual([os.path.basename(result.input_file) for result in failed],
+                         ['crash.otbm'])
+        self.assertIn('Worker process died', failed[0].error)
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['a.json', 'b.json', 'c.json', 'd.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import json
+import os
+import pickle
+import re
+import struct
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))    # noqa: E402
+
+from lib.item_types import ItemTypes
+from lib.json2otbm import Json2Otbm
+from lib.otbm2json import Otbm2Json
+
+
+STACKABLE_ITEM = 2148
+FLUID_ITEM = 2006
+GROUND_ITEM = 4526
+
+
+def write_items_otb(file_path):
+    """
+    Write a small items.otb file with a ground, a stackable and a fluid
+    container item.
+    """
+    def escape(data):
+        return re.sub(b'[\xfd-\xff]', lambda match: b'\xfd' + match.group(0), data)
+
+    def attribute(code, data):
+        return struct.pack('<BH', code, len(data)) + data
+
+    items = {GROUND_ITEM: (ItemTypes.GROUND, 0),
+             STACKABLE_ITEM: (ItemTypes.NONE, ItemTypes.STACKABLE),
+             FLUID_ITEM: (ItemTypes.FLUID, 0)}
+    with open(file_path, 'wb') as f:
+        f.write(bytes(4))
+        f.write(b'\xfe\x00' + escape(bytes(4) + attribute(
+            ItemTypes.ROOT_VERSION, struct.pack('<III', 3, 20, 62) + bytes(128))))
+        for server_id, (group, flags) in items.items():
+            f.write(b'\xfe' + bytes((group,)) + escape(
+                struct.pack('<I', flags)
+                + attribute(ItemTypes.SERVER_ID, struct.pack('<H', server_id))
+                + attribute(ItemTypes.CLIENT_ID, struct.pack('<H', server_id + 1000))
+                + attribute(ItemTypes.NAME, f'item {server_id}'.encode())) + b'\xff')
+        f.write(b'\xff')
+
+
+def write_map(file_path, areas=8):
+    """
+    Write an OTBM version 1 map (items with subtype and description) of
+    several tile areas.
+    """
+    tile_areas = dict()
+    for number in range(1, areas + 1):
+        tile_areas[f'TILE_AREA_{number}'] = {
+            'X': 256 * number, 'Y': 0, 'Z': 7,
+            'TILE_1': {'X': 1, 'Y': 2,
+                       'ITEM_1': {'IDENTIFIER': GROUND_ITEM},
+                       'ITEM_2': {'IDENTIFIER': STACKABLE_ITEM, 'SUBTYPE': number,
+                                  f'DESCRIPTION_{number + 1}': f'area {number}'}},
+            'TILE_2': {'X': 3, 'Y': 4,
+                       'ITEM_1': {'IDENTIFIER': FLUID_ITEM, 'SUBTYPE': 5}}}
+    data = {'identifier': 0, 'map_version': 0, 'map_width': 4096, 'map_height': 256,
+            'items_major_version': 1, 'items_minor_version': 4,
+            'MAP': {'DESCRIPTION_1': 'test', **tile_areas}}
+    json_file = os.path.splitext(file_path)[0] + '.json'
+    with open(json_file, 'w') as f:
+        json.dump(data, f)
+    parser = Json2Otbm()
+    parser.file_path = json_file
+    parser.process_file()
+    parser.generate_otbm(file_path)
+
+
+class ItemTypesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.items_file = os.path.join(self.tmp_dir.name, 'items.otb')
+        write_items_otb(self.items_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pickle_uncached(self):
+        types = ItemTypes.open(self.items_file, cache=False)
+        self.assertIsNone(types.cache_path)
+        loaded = pickle.loads(pickle.dumps(types))
+        self.assertTrue(loaded.has_subtype(STACKABLE_ITEM))
+        self.assertTrue(loaded.is_ground(GROUND_ITEM))
+        self.assertEqual(loaded.name(FLUID_ITEM), f'item {FLUID_ITEM}')
+        self.assertEqual(loaded.client_id(FLUID_ITEM), FLUID_ITEM + 1000)
+
+    def test_pickle_cached(self):
+        types = ItemTypes.open(self.items_file, cache=True)
+        self.assertIsNotNone(types.cache_path)
+        loaded = pickle.loads(pickle.dumps(types))
+        self.assertEqual(loaded.cache_path, types.cache_path)
+        self.assertTrue(loaded.has_subtype(STACKABLE_ITEM))
+
+    def _parse(self, map_file, items, workers):
+        parser = Otbm2Json()
+        parser.otbm_file_path = map_file
+        parser.index_cache = False
+        parser.items = items
+        parser.PARALLEL_MIN_SIZE = 0
+        with mock.patch('os.cpu_count', return_value=workers):
+            parser.workers = workers
+            parser.process_file()
+        self.assertEqual(parser.malformed_nodes, 0)
+        return json.loads(json.dumps(parser._json_data))
+
+    def test_parallel_uncached(self):
+        map_file = os.path.join(self.tmp_dir.name, 'map.otbm')
+        write_map(map_file)
+        items = ItemTypes.open(self.items_file, cache=False)
+        sequential = self._parse(map_file, items, 1)
+        self.assertEqual(sequential['MAP']['TILE_AREA_2']['TILE_3']['ITEM_2'],
+                         {'IDENTIFIER': STACKABLE_ITEM, 'SUBTYPE': 2,
+                          'DESCRIPTION_3': 'area 2'})
+        self.assertEqual(self._parse(map_file, items, 2), sequential)
+
+
+if __name__ == '__main__':
+    unittest.main()
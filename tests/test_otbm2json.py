@@ -0,0 +1,216 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))    # noqa: E402
+
+from lib import compressed_io
+from lib.json2otbm import Json2Otbm
+from lib.otbm2json import Otbm2Json
+
+
+def write_map(file_path, areas=4, changed=(), order=None):
+    """
+    Write a map of several tile areas whose map node, tiles and items have
+    descriptions. Areas in changed get an extra described item, areas are
+    written in the given order of their numbers (ascending by default).
+    """
+    tile_areas = dict()
+    description = 1
+    for number in order or range(1, areas + 1):
+        item = {'IDENTIFIER': 2148, f'DESCRIPTION_{description + 1}': f'item {number}'}
+        tile = {'X': 1, 'Y': 2, f'DESCRIPTION_{description}': f'tile {number}',
+                'ITEM_1': {'IDENTIFIER': 4526}, 'ITEM_2': item}
+        description += 2
+        if number in changed:
+            item['ITEM_3'] = {'IDENTIFIER': 2160,
+                              f'DESCRIPTION_{description}': 'changed'}
+            description += 1
+        tile_areas[f'TILE_AREA_{number}'] = {
+            'X': 256 * number, 'Y': 0, 'Z': 7, 'TILE_1': tile,
+            'TILE_2': {'X': 3, 'Y': 4, 'ITEM_1': {'IDENTIFIER': 4526}}}
+    data = {'identifier': 0, 'map_version': 2, 'map_width': 4096, 'map_height': 256,
+            'items_major_version': 3, 'items_minor_version': 20,
+            'MAP': {'DESCRIPTION_1': 'test', **tile_areas}}
+    json_file = os.path.splitext(file_path)[0] + '.json'
+    with open(json_file, 'w') as f:
+        json.dump(data, f)
+    parser = Json2Otbm()
+    parser.file_path = json_file
+    parser.process_file()
+    parser.generate_otbm(file_path)
+
+
+class DescriptionsTest(unittest.TestCase):
+    """
+    Tile areas decoded on their own (parallel decoding, query, patch_json)
+    number descriptions as the whole map does.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_map = os.path.join(self.tmp_dir.name, 'old.otbm')
+        self.new_map = os.path.join(self.tmp_dir.name, 'new.otbm')
+        write_map(self.old_map)
+        write_map(self.new_map, changed=(1, 3))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _parser(self, map_file):
+        parser = Otbm2Json()
+        parser.otbm_file_path = map_file
+        parser.index_cache = False
+        return parser
+
+    def _export(self, map_file, json_file):
+        parser = self._parser(map_file)
+        parser.json_file_path = json_file
+        parser.process_file()
+        parser.generate_json()
+        with open(json_file) as f:
+            return json.load(f)
+
+    def test_parallel(self):
+        expected = self._export(self.new_map, os.path.join(self.tmp_dir.name, 'new.json'))
+        area = expected['MAP']['TILE_AREA_4']['TILE_7']
+        self.assertEqual(area['DESCRIPTION_10'], 'tile 4')
+
+        parser = self._parser(self.new_map)
+        parser.PARALLEL_MIN_SIZE = 0
+        with mock.patch('os.cpu_count', return_value=2):
+            parser.workers = 2
+            parser.process_file()
+        self.assertEqual(json.loads(json.dumps(parser._json_data)), expected)
+
+    def test_query(self):
+        expected = self._export(self.new_map, os.path.join(self.tmp_dir.name, 'new.json'))
+        tiles = self._parser(self.new_map).query(4 * 256, 0, 4 * 256 + 255, 255, 7)
+        self.assertEqual(tiles['TILE_AREA_4']['TILE_7'],
+                         expected['MAP']['TILE_AREA_4']['TILE_7'])
+
+    def test_patch_json(self):
+        expected = self._export(self.new_map, os.path.join(self.tmp_dir.name, 'new.json'))
+        json_file = os.path.join(self.tmp_dir.name, 'patched.json')
+        self._export(self.old_map, json_file)
+
+        parser = self._parser(self.new_map)
+        parser.json_file_path = json_file
+        self.assertEqual(parser.patch_json(self.old_map), 2)
+        with open(json_file) as f:
+            self.assertEqual(json.load(f), expected)
+
+    def test_patch_json_moved_areas(self):
+        moved_map = os.path.join(self.tmp_dir.name, 'moved.otbm')
+        write_map(moved_map, order=(1, 4, 2, 3))
+        expected = self._export(moved_map, os.path.join(self.tmp_dir.name, 'moved.json'))
+        json_file = os.path.join(self.tmp_dir.name, 'patched.json')
+        self._export(self.old_map, json_file)
+
+        parser = self._parser(moved_map)
+        parser.json_file_path = json_file
+        # Area 4 is read before areas 2 and 3 in the old json, those are decoded
+        self.assertEqual(parser.patch_json(self.old_map), 2)
+        with open(json_file) as f:
+            self.assertEqual(json.load(f), expected)
+
+
+
+class ParallelOutputTest(unittest.TestCase):
+    """
+    Tile areas serialized by worker processes give the sequential output.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.map_file = os.path.join(self.tmp_dir.name, 'map.otbm')
+        write_map(self.map_file, areas=8, changed=(2, 5))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _outputs(self, workers):
+        def parser():
+            parser = Otbm2Json()
+            parser.otbm_file_path = self.map_file
+            parser.index_cache = False
+            parser.PARALLEL_MIN_SIZE = 0
+            parser.workers = workers
+            return parser
+
+        outputs = dict()
+        with mock.patch('os.cpu_count', return_value=workers):
+            for compact in (False, True):
+                json_parser = parser()
+                json_parser.json_file_path = os.path.join(
+                    self.tmp_dir.name, f'{workers}-{compact}.json')
+                json_parser.generate_json(compact, streaming=True)
+                with open(json_parser.json_file_path) as f:
+                    outputs[f'json {compact}'] = f.read()
+            ndjson_file = os.path.join(self.tmp_dir.name, f'{workers}.ndjson')
+            outputs['ndjson records'] = parser().generate_ndjson(ndjson_file)
+            with open(ndjson_file) as f:
+                outputs['ndjson'] = f.read()
+            outputs['model'] = parser().generate_model().to_json()
+        return outputs
+
+    def test_serialized_areas(self):
+        self.assertEqual(self._outputs(2), self._outputs(1))
+
+
+
+class CompressedMapTest(unittest.TestCase):
+    """
+    Compressed maps are streamed by whole file passes, copies made for
+    random access are removed once their scanners are closed.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.map_file = os.path.join(self.tmp_dir.name, 'map.otbm')
+        write_map(self.map_file, changed=(2,))
+        with open(self.map_file, 'rb') as f, gzip.open(self.map_file + '.gz', 'wb') as g:
+            shutil.copyfileobj(f, g)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _json(self, map_file, **options):
+        parser = Otbm2Json()
+        parser.otbm_file_path = map_file
+        parser.index_cache = False
+        for key, value in options.items():
+            setattr(parser, key, value)
+        parser.process_file()
+        return json.loads(json.dumps(parser._json_data))
+
+    def test_streamed(self):
+        expected = self._json(self.map_file)
+        # Small chunks, so nodes and escapes are split between them
+        with mock.patch.object(compressed_io, 'BUFFER_SIZE', 5), \
+                mock.patch.object(compressed_io, 'decompressed_copy') as copy:
+            self.assertEqual(self._json(self.map_file + '.gz'), expected)
+        copy.assert_not_called()
+
+    def test_copies_removed(self):
+        expected = self._json(self.map_file)
+        with mock.patch('os.cpu_count', return_value=2):
+            parallel = self._json(self.map_file + '.gz', PARALLEL_MIN_SIZE=0, workers=2)
+        self.assertEqual(parallel, expected)
+
+        parser = Otbm2Json()
+        parser.otbm_file_path = self.map_file + '.gz'
+        parser.index_cache = False
+        self.assertEqual(parser.query(256, 0, 511, 255, 7)['TILE_AREA_1'],
+                         expected['MAP']['TILE_AREA_1'])
+        self.assertEqual(compressed_io._copies, {})
+
+
+if __name__ == '__main__':
+    unittest.main()